@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import copy
+import re
 from datetime import datetime
 from pathlib import Path
 from typing import *
@@ -85,6 +86,14 @@ ArgType.DateTime = ArgType("datetime", validate=lambda val: isinstance(val, date
 ArgType.VarAggGroupBy = ArgType("var_agg_group_by",
                                 validate=lambda val: isinstance(val, list),
                                 from_str=lambda val: ujson.load(val))
+
+
+def is_var_agg_func(val: str) -> bool:
+    # p<q> is the q-th percentile, e.g., p90
+    return val in {"sum", "average", "count", "min", "max", "std", "variance", "median"} or \
+           (re.fullmatch(r"p\d+(\.\d+)?", val) is not None and float(val[1:]) <= 100)
+
+
 ArgType.VarAggFunc = ArgType("var_agg_func",
-                             validate=lambda val: val in {"sum", "average", "count"},
-                             from_str=lambda val: val)
+                             validate=lambda val: all(is_var_agg_func(x) for x in (val if isinstance(val, list) else [val])),
+                             from_str=lambda val: [x.strip() for x in val.split(",")] if "," in val else val)
@@ -25,6 +25,9 @@ class AdapterSchema(Schema):
     adapter = fields.Str(required=True)
     comment = fields.Str()
     inputs = OrderedDictField(keys=fields.Str(validate=validate.Regexp(keys_pattern)), values=fields.Raw(allow_none=True))
+    # number of items that producers can buffer ahead for each wired input
+    buffer_sizes = OrderedDictField(keys=fields.Str(validate=validate.Regexp(keys_pattern)),
+                                    values=fields.Int(validate=validate.Range(min=1)))
 
     class Meta:
         ordered = True
@@ -110,10 +113,18 @@ class PipelineSchema(Schema):
 
         inputs = {}
         wired = []
+        buffer_sizes = {}
         func_classes = []
         # processing data and populating inputs
         for name, adapter in data['adapters'].items():
             func_classes.append(mappings[name][0])
+            for input, buffer_size in adapter.get('buffer_sizes', {}).items():
+                # validating buffer size, which only applies to wired inputs
+                if input not in mappings[name][0].inputs:
+                    raise ValidationError(f"invalid input {input} in buffer_sizes of {data['adapters'][name]['adapter']} for {name}")
+                if not (isinstance(adapter.get('inputs', {}).get(input), str) and wired_pattern.match(adapter['inputs'][input])):
+                    raise ValidationError(f"buffer size of input {input} for {name} can only be set on a wired input")
+                buffer_sizes[(mappings[name][0].id, mappings[name][1], input)] = buffer_size
             if 'inputs' not in adapter:
                 continue
             for input, value in adapter['inputs'].items():
@@ -152,7 +163,7 @@ class PipelineSchema(Schema):
                             raise ValidationError([str(e), f"type casting failed in input {input} for {name}"])
                     inputs[WiredIOArg.get_arg_name(mappings[name][0].id, mappings[name][1], input)] = value
 
-        return Pipeline(func_classes, wired), inputs
+        return Pipeline(func_classes, wired, buffer_sizes), inputs
 
 
 class ConfigParser:
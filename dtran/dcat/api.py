@@ -1,10 +1,24 @@
+import copy
 import logging
 import os
+import threading
 import time
+from asyncio import get_event_loop
+from concurrent.futures import Executor, Future
 from datetime import datetime
-from typing import List, Dict
+from functools import partial
+from itertools import islice
+from typing import List, Dict, Iterator, Any, AsyncIterator, Callable, Optional
 
 import requests
+import ujson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# guards the creation of the clients, as adapters constructed in the threads of the pipeline share them. It is
+# reentrant because the async client creates the sync client
+INSTANCES_LOCK = threading.RLock()
+
 
 def dateTimeToXSD(dt):
     return str(dt).replace(" ", "T")
@@ -17,21 +31,119 @@ class StandardVariableForm:
 
 
 class DCatAPI:
-    instance = None
+    instances = {}
     logger = logging.getLogger("dcat_api")
     logger_api_resp = logging.getLogger("dcat_api.handle_response")
 
     BATCH_SIZE = 200
-
-    def __init__(self, dcat_url: str):
+    # number of resources fetched per request when iterating over the resources of a dataset
+    PAGE_SIZE = int(os.environ.get("DCAT_PAGE_SIZE", "1000"))
+    # limit of the single query fetching all resources of a dataset when the server does not support pagination
+    UNPAGINATED_LIMIT = 100000
+    # seconds the dataset information, standard variables and resource listings are cached
+    CACHE_TTL = float(os.environ.get("DCAT_CACHE_TTL", "600"))
+    # HTTP status codes for which read queries are retried
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, dcat_url: str, cache_ttl: float = CACHE_TTL, max_retries: int = 5, backoff_factor: float = 0.5,
+                 timeout: float = 120):
         self.dcat_url = dcat_url
         self.api_key = None
+        self.api_key_lock = threading.Lock()
+        self.cache_ttl = cache_ttl
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        # a keep-alive connection pool shared by all adapters. Failed connections are retried for every request,
+        # while failed responses are only retried for read queries (see DCatAPI.query)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                              max_retries=Retry(total=max_retries, connect=max_retries, read=0, status=0,
+                                                backoff_factor=backoff_factor))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # key => (expired time, response) of the cached queries and key => future of the queries in progress
+        self.cache = {}
+        self.in_flight = {}
+        self.cache_lock = threading.Lock()
 
     @staticmethod
-    def get_instance():
-        if DCatAPI.instance is None:
-            DCatAPI.instance = DCatAPI(os.environ['DCAT_URL'])
-        return DCatAPI.instance
+    def get_instance(dcat_url: str = None):
+        dcat_url = dcat_url or os.environ['DCAT_URL']
+        if dcat_url not in DCatAPI.instances:
+            with INSTANCES_LOCK:
+                if dcat_url not in DCatAPI.instances:
+                    DCatAPI.instances[dcat_url] = DCatAPI(dcat_url)
+        return DCatAPI.instances[dcat_url]
+
+    def query(self, endpoint: str, payload: dict) -> dict:
+        """
+        Send a read-only query to the data catalog, retrying with exponential backoff when the server is unavailable
+        or does not respond in time
+        """
+        for attempt in range(self.max_retries + 1):
+            request_headers = {
+                "Content-Type": "application/json",
+                "X-Api-Key": self.get_api_key(),
+            }
+            try:
+                resp = self.session.post(f"{self.dcat_url}/{endpoint}", headers=request_headers, json=payload,
+                                         timeout=self.timeout)
+                if resp.status_code not in self.RETRY_STATUS:
+                    assert resp.status_code == 200, resp.text
+                    return resp.json()
+                error = f"status {resp.status_code}: {resp.text[:200]}"
+            except requests.ReadTimeout as e:
+                # failed connections (including connect timeouts) are already retried by the adapter of the session,
+                # so they are not retried again here
+                error = str(e)
+            if attempt == self.max_retries:
+                raise Exception(f"Query {endpoint} failed after {self.max_retries} retries: {error}")
+            delay = self.backoff_factor * (2 ** attempt)
+            self.logger.warning(f"Retrying query {endpoint} in {delay}s ({attempt + 1}/{self.max_retries}) after {error}")
+            time.sleep(delay)
+
+    def cached_query(self, endpoint: str, payload: dict, use_cache: bool = True) -> Any:
+        """
+        Send a read-only query, sharing its response with identical queries: responses are cached for cache_ttl
+        seconds, and concurrent identical queries wait for the one in progress instead of being sent again. A copy
+        of the response is returned, so callers can modify it.
+        """
+        key = (endpoint, ujson.dumps(payload, sort_keys=True))
+        with self.cache_lock:
+            if use_cache and key in self.cache and self.cache[key][0] > time.time():
+                return copy.deepcopy(self.cache[key][1])
+            if key in self.in_flight:
+                future, is_owner = self.in_flight[key], False
+            else:
+                future, is_owner = Future(), True
+                self.in_flight[key] = future
+
+        if not is_owner:
+            return copy.deepcopy(future.result())
+
+        try:
+            resp = self.query(endpoint, payload)
+        except BaseException as e:
+            with self.cache_lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+        with self.cache_lock:
+            if use_cache:
+                self.cache[key] = (time.time() + self.cache_ttl, resp)
+            del self.in_flight[key]
+        future.set_result(resp)
+        return copy.deepcopy(resp)
+
+    def invalidate_cache(self, dataset_id: str = None):
+        """
+        Remove the cached responses of a dataset, or of every dataset if dataset_id is None
+        """
+        with self.cache_lock:
+            for key in list(self.cache.keys()):
+                if dataset_id is None or ujson.loads(key[1]).get("dataset_id") == dataset_id:
+                    del self.cache[key]
 
     def delete_datasets(self, provenance_id, dataset_ids):
         request_headers = {"Content-Type": "application/json", "X-Api-Key": self.get_api_key()}
@@ -44,11 +156,12 @@ class DCatAPI:
                 "dataset_id": resource_id,
             }
 
-            resp = requests.post(
+            resp = self.session.post(
                 f"{self.dcat_url}/datasets/delete_dataset", headers=request_headers, json=resource_defs
             )
 
             parsed_response = DCatAPI.handle_api_response(resp)
+            self.invalidate_cache(resource_id)
 
             print(f"{resource_id}: {parsed_response}")
 
@@ -64,13 +177,39 @@ class DCatAPI:
             limit: int = 100000,
     ):
         """start_time and end_time is inclusive"""
-        request_headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": self.get_api_key(),
-        }
+        resources = self.iter_resources_by_dataset_id(dataset_id, start_time, end_time, geometry,
+                                                  page_size=min(limit, self.PAGE_SIZE))
+        return list(islice(resources, limit))
+
+    def iter_resources_by_dataset_id(
+            self,
+            dataset_id: str,
+            start_time: datetime = None,
+            end_time: datetime = None,
+            geometry: str = None,
+            page_size: int = None,
+    ) -> Iterator[dict]:
+        """
+        Iterate over the resources of a dataset, fetching them page by page. start_time and end_time is inclusive
+        """
+        for resources in self.iter_resource_pages(dataset_id, start_time, end_time, geometry, page_size):
+            yield from resources
+
+    def iter_resource_pages(
+            self,
+            dataset_id: str,
+            start_time: datetime = None,
+            end_time: datetime = None,
+            geometry: str = None,
+            page_size: int = None,
+    ) -> Iterator[List[dict]]:
+        """
+        Iterate over the pages of resources of a dataset. start_time and end_time is inclusive
+        """
+        page_size = page_size or self.PAGE_SIZE
         query = {
             "dataset_id": dataset_id,
-            "limit": limit,
+            "limit": page_size,
         }
         if start_time is not None or end_time is not None or geometry is not None:
             query["filter"] = {}
@@ -81,43 +220,57 @@ class DCatAPI:
             if geometry is not None:
                 query["filter"]["spatial_coverage__intersects"] = geometry
 
-        resp = requests.post(
-            f"{self.dcat_url}/datasets/dataset_resources",
-            headers=request_headers,
-            json=query,
-        )
-        assert resp.status_code == 200, resp.text
-        return resp.json()["resources"]
+        # the whole listing is cached under one key, as a listing assembled from pages cached at different times could
+        # miss the resources inserted or deleted in between. The pages are only shared by identical queries in progress
+        listing_key = ("datasets/dataset_resources", ujson.dumps(
+            {k: v for k, v in query.items() if k != "limit"}, sort_keys=True))
+        with self.cache_lock:
+            cached = self.cache.get(listing_key)
+        if cached is not None and cached[0] > time.time():
+            listing = copy.deepcopy(cached[1])
+            for i in range(0, len(listing), page_size):
+                yield listing[i:i + page_size]
+            return
+
+        listing = []
+        offset = 0
+        seen_ids = set()
+        while True:
+            query["offset"] = offset
+            resources = self.cached_query("datasets/dataset_resources", query, use_cache=False)["resources"]
+            new_resources = [r for r in resources if r.get("resource_id") not in seen_ids]
+            if len(resources) > 0 and len(new_resources) == 0:
+                # the server ignored the offset, so the remaining resources are fetched in a single query as before
+                self.logger.warning(f"Pagination is not supported when querying resources of dataset {dataset_id}")
+                query.pop("offset")
+                query["limit"] = self.UNPAGINATED_LIMIT
+                resources = self.cached_query("datasets/dataset_resources", query, use_cache=False)["resources"]
+                new_resources = [r for r in resources if r.get("resource_id") not in seen_ids]
+                listing.extend(copy.deepcopy(new_resources))
+                yield new_resources
+                break
+            seen_ids.update(r["resource_id"] for r in new_resources if "resource_id" in r)
+            listing.extend(copy.deepcopy(new_resources))
+            yield new_resources
+            if len(resources) < page_size:
+                break
+            offset += len(resources)
+
+        # only a complete listing is cached, so a listing prefetched by a stream adapter is reused by the reader of the
+        # window
+        with self.cache_lock:
+            self.cache[listing_key] = (time.time() + self.cache_ttl, listing)
 
     def find_dataset_by_id(self, dataset_id):
-        request_headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": self.get_api_key(),
-        }
-        resp = requests.post(
-            f"{self.dcat_url}/datasets/get_dataset_info",
-            headers=request_headers,
-            json={"dataset_id": dataset_id},
-        )
-        assert resp.status_code == 200, resp.text
-        return resp.json()
+        return self.cached_query("datasets/get_dataset_info", {"dataset_id": dataset_id})
 
     def find_standard_variables_by_dataset_id(self, dataset_id):
-        request_headers = {
-            "Content-Type": "application/json",
-            "X-Api-Key": self.get_api_key(),
-        }
-        resp = requests.post(
-            f"{self.dcat_url}/datasets/dataset_standard_variables",
-            headers=request_headers,
-            json={"dataset_id": dataset_id},
-        )
-        assert resp.status_code == 200, resp.text
-        return resp.json()['dataset']['standard_variables']
+        return self.cached_query(
+            "datasets/dataset_standard_variables", {"dataset_id": dataset_id})['dataset']['standard_variables']
 
     def update_dataset_metadata(self, provenance_id, dataset_id, metadata):
         request_headers = {"Content-Type": "application/json", "X-Api-Key": self.get_api_key()}
-        resp = requests.post(
+        resp = self.session.post(
             f"{self.dcat_url}/datasets/update_dataset",
             headers=request_headers,
             json={
@@ -128,6 +281,7 @@ class DCatAPI:
         )
         assert resp.status_code == 200, resp.text
         parsed_response = DCatAPI.handle_api_response(resp)
+        self.invalidate_cache(dataset_id)
         return parsed_response
 
     def register_dataset_with_multiple_resources(
@@ -151,7 +305,7 @@ class DCatAPI:
         }
         if record_id is not None:
             dataset["record_id"] = record_id
-        resp = requests.post(
+        resp = self.session.post(
             f"{self.dcat_url}/datasets/register_datasets",
             headers=request_headers,
             json={"datasets": [dataset]},
@@ -162,7 +316,7 @@ class DCatAPI:
         self.logger.debug("register dataset: %s", dataset)
 
         # TODO: register all variables
-        resp = requests.post(
+        resp = self.session.post(
             f"{self.dcat_url}/datasets/register_variables",
             headers=request_headers,
             json={
@@ -213,7 +367,7 @@ class DCatAPI:
             print(f"register resources index {start_idx} to {last_idx - 1} ")
 
             # ... and register them in bulk
-            resp = requests.post(
+            resp = self.session.post(
                 f"{self.dcat_url}/datasets/register_resources", headers=request_headers, json=resource_defs
             )
 
@@ -256,7 +410,7 @@ class DCatAPI:
         """
         DCatAPI.logger.debug("register variables: %s", variable_forms)
         request_headers = {"Content-Type": "application/json", "X-Api-Key": self.get_api_key()}
-        resp = requests.post(
+        resp = self.session.post(
             f"{self.dcat_url}/knowledge_graph/register_standard_variables",
             headers=request_headers,
             json={"standard_variables": [var.__dict__ for var in variable_forms]},
@@ -275,11 +429,12 @@ class DCatAPI:
         """
         :return:
         """
-        if self.api_key is None or time.time() - self.api_key["time"] > 600:
-            # Obtaining the API Key which allows us to make posts
-            resp = requests.get(f"{self.dcat_url}/get_session_token").json()
-            self.api_key = {"key": resp["X-Api-Key"], "time": time.time()}
-        return self.api_key["key"]
+        with self.api_key_lock:
+            if self.api_key is None or time.time() - self.api_key["time"] > 600:
+                # Obtaining the API Key which allows us to make posts
+                resp = self.session.get(f"{self.dcat_url}/get_session_token", timeout=self.timeout).json()
+                self.api_key = {"key": resp["X-Api-Key"], "time": time.time()}
+            return self.api_key["key"]
 
     @staticmethod
     def handle_api_response(response: requests.Response):
@@ -327,3 +482,85 @@ class DCatAPI:
             """
 
             raise Exception(msg)
+
+
+class AsyncDCatAPI:
+    """
+    Asynchronous client of the data catalog with the same methods as DCatAPI, to be used inside the pipeline's loop.
+    Requests are sent by the synchronous client of the same url in the given executor (the loop's default executor if
+    it is None), so both clients share the connection pool, the cache and the coalescing of identical queries
+    """
+    instances = {}
+
+    def __init__(self, api: DCatAPI, executor: Optional[Executor] = None):
+        self.api = api
+        self.executor = executor
+
+    @staticmethod
+    def get_instance(dcat_url: str = None, executor: Optional[Executor] = None):
+        """
+        :param executor: executor of the requests, usually the thread pool of the pipeline (IFunc.executor)
+        """
+        api = DCatAPI.get_instance(dcat_url)
+        if executor is not None:
+            # the client only binds the shared synchronous client to the executor, so it is cheap to create
+            return AsyncDCatAPI(api, executor)
+        if api.dcat_url not in AsyncDCatAPI.instances:
+            with INSTANCES_LOCK:
+                if api.dcat_url not in AsyncDCatAPI.instances:
+                    AsyncDCatAPI.instances[api.dcat_url] = AsyncDCatAPI(api)
+        return AsyncDCatAPI.instances[api.dcat_url]
+
+    async def run(self, func: Callable, *args, **kwargs):
+        return await get_event_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def find_dataset_by_id(self, dataset_id):
+        return await self.run(self.api.find_dataset_by_id, dataset_id)
+
+    async def find_standard_variables_by_dataset_id(self, dataset_id):
+        return await self.run(self.api.find_standard_variables_by_dataset_id, dataset_id)
+
+    async def find_resources_by_dataset_id(
+            self,
+            dataset_id: str,
+            start_time: datetime = None,
+            end_time: datetime = None,
+            geometry: str = None,
+            limit: int = 100000,
+    ):
+        """start_time and end_time is inclusive"""
+        return await self.run(self.api.find_resources_by_dataset_id, dataset_id, start_time, end_time, geometry, limit)
+
+    async def iter_resources_by_dataset_id(
+            self,
+            dataset_id: str,
+            start_time: datetime = None,
+            end_time: datetime = None,
+            geometry: str = None,
+            page_size: int = None,
+    ) -> AsyncIterator[dict]:
+        """
+        Iterate over the resources of a dataset. The next page is fetched while the resources of the current page are
+        consumed. start_time and end_time is inclusive
+        """
+        loop = get_event_loop()
+        pages = self.api.iter_resource_pages(dataset_id, start_time, end_time, geometry, page_size)
+        next_page = loop.run_in_executor(self.executor, next, pages, None)
+        while True:
+            resources = await next_page
+            if resources is None:
+                return
+            next_page = loop.run_in_executor(self.executor, next, pages, None)
+            for resource in resources:
+                yield resource
+
+    def __getattr__(self, name: str):
+        # the remaining (registration) methods of DCatAPI are exposed as coroutines
+        func = getattr(self.api, name)
+        if not callable(func):
+            return func
+
+        async def wrapper(*args, **kwargs):
+            return await self.run(func, *args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,370 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import requests
+import ujson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# directory of the content-addressed store, it can be on a filesystem shared by several worker nodes. Views are
+# hard-linked from it, so it should be on the same filesystem as the directories the readers download into
+DATA_CATALOG_STORE_DIR = os.path.abspath(
+    os.environ.get("DATA_CATALOG_STORE_DIR") or os.path.join(os.environ["DATA_CATALOG_DOWNLOAD_DIR"], "store"))
+# how files of the store are put into the directories of the readers: hardlink, reflink or copy. When a method is not
+# supported (e.g., the view is on a different filesystem), the next one is used
+DATA_CATALOG_STORE_LINK = os.environ.get("DATA_CATALOG_STORE_LINK", "hardlink")
+# maximum size of the store (e.g., 50GB), files that are not linked by any view are pruned above it. Defaults to the
+# capacity of the readers' cache (DATA_CATALOG_MAX_CAPACITY)
+DATA_CATALOG_STORE_MAX_CAPACITY = os.environ.get("DATA_CATALOG_STORE_MAX_CAPACITY") or \
+    os.environ.get("DATA_CATALOG_MAX_CAPACITY", "200MB")
+CHECK_CERTIFICATE = os.environ.get('NO_CHECK_CERTIFICATE', 'false').lower().strip() != 'true'
+# guards the creation of the store, as two stores in a process would not exclude each other's threads
+INSTANCE_LOCK = threading.Lock()
+
+UNITS_MAPPING = {
+    'PB': 1 << 50,
+    'TB': 1 << 40,
+    'GB': 1 << 30,
+    'MB': 1 << 20,
+    'KB': 1 << 10,
+    'B': 1
+}
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a human readable size such as "200MB" or "1.5 GB" into a number of bytes
+    """
+    size = size.strip().upper()
+    for unit, multiplier in UNITS_MAPPING.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)].strip()) * multiplier)
+    return int(size)
+
+
+class ContentStore:
+    """
+    A store of downloaded files addressed by their content: the key of a file is the hash of its url and of the ETag
+    (or the size when there is no ETag) reported by the server. The same file registered in several datasets or
+    downloaded by several adapters is therefore fetched and stored once, and is linked into the directory of each
+    reader (its view).
+
+    Processes on several nodes can share the store: a file is downloaded by the process holding its POSIX lock
+    (supported by NFS), the other ones wait for the lock and reuse the file. The lock is released automatically when
+    a process dies and its partial download is resumed by the next process.
+
+    Hard-linked views share the content of the store, so readers must not modify them in place.
+    """
+    instance = None
+    logger = logging.getLogger("dcat_store")
+
+    LINK_METHODS = ["hardlink", "reflink", "copy"]
+
+    def __init__(self, store_dir: str, link_method: str = "hardlink", max_capacity: Optional[int] = None):
+        assert link_method in self.LINK_METHODS, \
+            f"Invalid link method {link_method}. Expected one of {self.LINK_METHODS}"
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+        self.locks_dir = os.path.join(store_dir, "locks")
+        # the ETag and size of the last version of each url fetched into the store, so a file found in the store is
+        # reused without querying the server
+        self.urls_dir = os.path.join(store_dir, "urls")
+        self.link_methods = self.LINK_METHODS[self.LINK_METHODS.index(link_method):]
+        self.max_capacity = max_capacity
+        # estimated size of the store, it is computed by the first prune and then updated with the files downloaded by
+        # this process, so the store is only scanned when it may exceed the capacity
+        self.size = None
+        # whether a prune may free space: the store is not scanned again if the last prune freed nothing (all files are
+        # linked by views) and no file has been downloaded since then
+        self.is_prunable = True
+        # a prune removes files until the store is below this fraction of the capacity, so it does not run again for
+        # every new file once the store is full
+        self.low_watermark = 0.8
+        self.size_lock = threading.Lock()
+        self.max_retries = 5
+        self.chunk_size = 1 << 20
+        self.timeout = 60
+        # POSIX locks are held by processes, so the threads of a process are serialized by these locks first
+        self.thread_locks = defaultdict(threading.Lock)
+        self.thread_locks_mutex = threading.Lock()
+        Path(self.objects_dir).mkdir(exist_ok=True, parents=True)
+        Path(self.locks_dir).mkdir(exist_ok=True, parents=True)
+        Path(self.urls_dir).mkdir(exist_ok=True, parents=True)
+
+        self.session = requests.Session()
+        self.session.verify = CHECK_CERTIFICATE
+        # content-length is only reliable for the raw (not encoded) content
+        self.session.headers.update({"Accept-Encoding": "identity"})
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                              max_retries=Retry(total=self.max_retries, backoff_factor=0.5,
+                                                status_forcelist=[500, 502, 503, 504]))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @staticmethod
+    def get_instance():
+        if ContentStore.instance is None:
+            with INSTANCE_LOCK:
+                if ContentStore.instance is None:
+                    ContentStore.instance = ContentStore(
+                        DATA_CATALOG_STORE_DIR, DATA_CATALOG_STORE_LINK, parse_size(DATA_CATALOG_STORE_MAX_CAPACITY))
+        return ContentStore.instance
+
+    def head(self, url: str) -> Tuple[Optional[str], Optional[int]]:
+        """
+        Get the ETag and the size of a remote file, which are None when the server does not report them
+        """
+        try:
+            resp = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            self.logger.warning(f"Cannot query the metadata of {url}: {e}")
+            return None, None
+        size = resp.headers.get("Content-Length")
+        return resp.headers.get("ETag"), int(size) if size is not None and size.isdigit() else None
+
+    def cached_head(self, url: str) -> Optional[Tuple[Optional[str], Optional[int]]]:
+        """
+        Get the ETag and the size of the last version of a remote file fetched into the store, None if the store does
+        not have it anymore
+        """
+        url_path = self.url_path(url)
+        try:
+            with open(url_path, "r") as f:
+                etag, size = ujson.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self.object_path(self.key(url, etag, size))):
+            return None
+        return etag, size
+
+    def url_path(self, url: str) -> str:
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.urls_dir, url_hash[:2], url_hash + ".json")
+
+    @staticmethod
+    def key(url: str, etag: Optional[str], size: Optional[int]) -> str:
+        version = etag if etag is not None else (str(size) if size is not None else "")
+        return hashlib.sha256(f"{url}\n{version}".encode("utf-8")).hexdigest()
+
+    def object_path(self, key: str) -> str:
+        return os.path.join(self.objects_dir, key[:2], key)
+
+    @contextmanager
+    def lock(self, key: str, blocking: bool = True):
+        """
+        Exclusive lock of a file of the store shared by all processes/threads of all nodes. Yields whether the lock
+        is acquired, which is always True when blocking.
+
+        The locks of a pruned file are removed, so a lock acquired after it has been removed is acquired again.
+        """
+        lock_path = os.path.join(self.locks_dir, key + ".lock")
+        while True:
+            with self.thread_locks_mutex:
+                thread_lock = self.thread_locks[key]
+            if not thread_lock.acquire(blocking=blocking):
+                yield False
+                return
+            try:
+                with self.thread_locks_mutex:
+                    is_removed = self.thread_locks.get(key) is not thread_lock
+                if is_removed:
+                    continue
+                with open(lock_path, "a") as f:
+                    try:
+                        fcntl.lockf(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError as e:
+                        if e.errno not in (errno.EACCES, errno.EAGAIN):
+                            raise
+                        yield False
+                        return
+                    try:
+                        try:
+                            is_removed = os.stat(lock_path).st_ino != os.fstat(f.fileno()).st_ino
+                        except FileNotFoundError:
+                            is_removed = True
+                        if is_removed:
+                            continue
+                        yield True
+                        return
+                    finally:
+                        fcntl.lockf(f, fcntl.LOCK_UN)
+            finally:
+                thread_lock.release()
+
+    def fetch(self, url: str, path: Union[Path, str] = None, head: Tuple[Optional[str], Optional[int]] = None) -> int:
+        """
+        Get a remote file through the store: it is downloaded only if the store does not have it yet, then it is
+        linked into path (replacing the existing file) when path is given.
+
+        :param head: ETag and size of the file if they are already known. Otherwise, the last version of the file in
+            the store is used, and the server is only queried when the store does not have it. Pass the result of
+            head to fetch the file again when it has changed on the server
+        :return: size of the file
+        """
+        if head is None:
+            head = self.cached_head(url)
+            if head is None:
+                head = self.head(url)
+        etag, size = head
+        key = self.key(url, etag, size)
+        object_path = self.object_path(key)
+
+        with self.lock(key):
+            if os.path.exists(object_path):
+                self.logger.debug(f"Found {url} in the store")
+                # the modification time tracks the last access of the file across nodes
+                os.utime(object_path)
+            else:
+                Path(object_path).parent.mkdir(exist_ok=True, parents=True)
+                self.logger.debug(f"Downloading {url} into the store")
+                self.download(url, object_path, size)
+                with open(object_path + ".json", "w") as f:
+                    ujson.dump({"url": url, "etag": etag, "size": os.path.getsize(object_path),
+                                "created": time.time()}, f)
+                self.add_size(os.path.getsize(object_path))
+            if path is not None:
+                self.link(object_path, str(path))
+            object_size = os.path.getsize(object_path)
+
+        url_path = self.url_path(url)
+        if self.cached_head(url) != (etag, size):
+            Path(url_path).parent.mkdir(exist_ok=True, parents=True)
+            tmp_path = f"{url_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                ujson.dump([etag, size], f)
+            os.replace(tmp_path, url_path)
+
+        if self.max_capacity is not None and \
+                (self.size is None or (self.size > self.max_capacity and self.is_prunable)):
+            self.prune(int(self.max_capacity * self.low_watermark))
+        return object_size
+
+    def add_size(self, size: int):
+        with self.size_lock:
+            if self.size is not None:
+                self.size += size
+            self.is_prunable = True
+
+    def download(self, url: str, path: str, expected_size: Optional[int] = None):
+        """
+        Download a file into path. The content is first written into a partial file, which is resumed with an http
+        range request if the download is interrupted, and the size of the file is verified against the size reported
+        by the server before the file is moved to path.
+        """
+        part_path = path + ".part"
+        for attempt in range(self.max_retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+                    if resp.status_code == 416:
+                        # the partial file is not valid anymore, so we start over
+                        Path(part_path).unlink()
+                        continue
+                    resp.raise_for_status()
+                    if resp.status_code == 206:
+                        # Content-Range: bytes <start>-<end>/<total or *>
+                        content_range = resp.headers.get("Content-Range", "")
+                        start, total = content_range.split(" ")[-1].split("-")[0], content_range.split("/")[-1]
+                        if not start.isdigit() or int(start) != offset:
+                            Path(part_path).unlink()
+                            continue
+                        expected_size = int(total) if total.isdigit() else expected_size
+                        mode = "ab"
+                    else:
+                        # the server does not support range requests, the whole file is sent
+                        if "Content-Length" in resp.headers:
+                            expected_size = int(resp.headers["Content-Length"])
+                        mode = "wb"
+                    with open(part_path, mode) as f:
+                        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                            f.write(chunk)
+
+                size = os.path.getsize(part_path)
+                if expected_size is not None and size != expected_size:
+                    raise IOError(f"Incomplete download of {url}: expected {expected_size} bytes, got {size} bytes")
+                os.replace(part_path, path)
+                return
+            except (requests.RequestException, IOError) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"Retrying download of {url} ({attempt + 1}/{self.max_retries}) after: {e}")
+        raise IOError(f"Cannot download {url} after {self.max_retries} retries")
+
+    def link(self, object_path: str, path: str):
+        """
+        Put a file of the store into path using the first supported link method. The file is linked to a temporary
+        path first, so readers never see a partial view
+        """
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        for method in self.link_methods:
+            try:
+                if method == "hardlink":
+                    os.link(object_path, tmp_path)
+                elif method == "reflink":
+                    subprocess.check_call(["cp", "--reflink=always", object_path, tmp_path],
+                                          stderr=subprocess.DEVNULL)
+                else:
+                    shutil.copyfile(object_path, tmp_path)
+                break
+            except (OSError, subprocess.CalledProcessError) as e:
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                if method == self.link_methods[-1]:
+                    raise
+                self.logger.debug(f"Cannot {method} {object_path} into {path}: {e}")
+        os.replace(tmp_path, path)
+
+    def prune(self, max_size: int) -> int:
+        """
+        Remove the least recently used files that are not linked by any view until the store is smaller than
+        max_size. Files locked by other processes are skipped. It scans the whole store, so fetch only calls it when
+        the estimated size of the store exceeds the capacity, and prunes the store down to its low watermark.
+
+        :return: the number of bytes freed
+        """
+        objects = []
+        total_size = 0
+        for object_path in Path(self.objects_dir).glob("*/*"):
+            if object_path.suffix in (".json", ".part"):
+                continue
+            stat = object_path.stat()
+            total_size += stat.st_size
+            objects.append((stat.st_mtime, stat.st_nlink, object_path, stat.st_size))
+
+        freed = 0
+        for _, n_links, object_path, size in sorted(objects, key=lambda x: x[0]):
+            if total_size - freed <= max_size:
+                break
+            if n_links > 1:
+                continue
+            with self.lock(object_path.name, blocking=False) as acquired:
+                if not acquired or not object_path.exists() or object_path.stat().st_nlink > 1:
+                    continue
+                self.logger.debug(f"Pruning {object_path} from the store")
+                object_path.unlink()
+                Path(str(object_path) + ".json").unlink(missing_ok=True)
+                # the locks of the file are removed while they are held, lock acquires them again if it was waiting
+                Path(self.locks_dir, object_path.name + ".lock").unlink(missing_ok=True)
+                with self.thread_locks_mutex:
+                    self.thread_locks.pop(object_path.name, None)
+                freed += size
+        with self.size_lock:
+            self.size = total_size - freed
+            self.is_prunable = freed > 0
+        return freed
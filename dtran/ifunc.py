@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import abc
+from concurrent.futures import Executor
 from enum import Enum
 from typing import Dict, Optional, Union, Generator, AsyncGenerator
 
@@ -34,12 +35,23 @@ class IFuncType(Enum):
     INTERMEDIATE = "Other Transformation"
 
 
+class IFuncExecMode(Enum):
+    # run exec directly in the event loop of the pipeline
+    INLINE = "inline"
+    # run exec in a thread pool shared by the pipeline, suitable for I/O or code releasing the GIL (GDAL, numpy)
+    THREAD = "thread"
+
+
 class IFunc(metaclass=IFuncIO):
     id: str = ""
     description = None
     inputs: Dict[str, ArgType] = {}
     outputs: Dict[str, ArgType] = {}
     preferences: Dict[str, str] = {}
+    exec_mode: IFuncExecMode = IFuncExecMode.INLINE
+    # thread pool of the pipeline, which async adapters use to offload their blocking work with
+    # loop.run_in_executor(self.executor, ...). It is None (the loop's default executor) outside of a pipeline
+    executor: Optional[Executor] = None
 
     @abc.abstractmethod
     def validate(self) -> bool:
@@ -88,6 +100,9 @@ class IFunc(metaclass=IFuncIO):
     def get_preference(self, output: str) -> Optional[str]:
         return self.preferences[output]
 
+    def set_executor(self, executor: Optional[Executor]) -> None:
+        self.executor = executor
+
     @abc.abstractmethod
     def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
         pass
@@ -13,8 +13,10 @@ def cli():
     allow_extra_args=True,
 ))
 @click.option("--config", help="full path to config")
+@click.option("--profile_report", help="optional path to save the profiling report of every adapter (.json or .csv)")
+@click.option("--profile_trace", help="optional path to save the timeline of every adapter in Chrome trace format (.json)")
 @click.pass_context
-def exec_pipeline(ctx, config=None):
+def exec_pipeline(ctx, config=None, profile_report=None, profile_trace=None):
     """
     Creates a pipeline and execute it based on given config and input(optional).
     To specify the input to pipeline, use (listed in ascending priority):
@@ -37,7 +39,18 @@ def exec_pipeline(ctx, config=None):
     parsed_pipeline, parsed_inputs = parser.parse(path=config)
 
     # Execute the pipeline
-    parsed_pipeline.exec(parsed_inputs)
+    parsed_pipeline.exec(parsed_inputs, report_file=profile_report, trace_file=profile_trace)
+
+
+@cli.command(name="dcat_cache_stats")
+def dcat_cache_stats():
+    """
+    Print the hit/miss/eviction counters and the usage of the DCAT download cache as JSON
+    """
+    import ujson
+    from funcs.readers.dcat_read_func import ResourceManager
+
+    print(ujson.dumps(ResourceManager.get_instance().get_stats()))
 
 
 if __name__ == "__main__":
@@ -1,25 +1,37 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-from collections import Counter
+import csv
+import sys
+import time
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from functools import partial
 from pathlib import Path
 from typing import *
 
+import ujson
+
 from inspect import isasyncgenfunction, isgeneratorfunction, iscoroutinefunction, signature
-from asyncio import Event, gather, get_event_loop, sleep
+from asyncio import Event, ensure_future, gather, get_event_loop
+from concurrent.futures import Executor, ThreadPoolExecutor
 from marshmallow import Schema, fields, ValidationError
-from networkx import DiGraph, lexicographical_topological_sort, bfs_edges, NetworkXUnfeasible
+from networkx import DiGraph, lexicographical_topological_sort, bfs_edges, find_cycle, NetworkXUnfeasible, NetworkXNoCycle
 
-from dtran.ifunc import IFunc
+from dtran.ifunc import IFunc, IFuncExecMode
 from dtran.metadata import Metadata
 from dtran.wireio import WiredIOArg
 
 
 class Pipeline(object):
-    def __init__(self, func_classes: List[Type[IFunc]], wired: List[any] = None):
+    def __init__(self, func_classes: List[Type[IFunc]], wired: List[any] = None,
+                 buffer_sizes: Dict[Tuple[str, int, str], int] = None, max_workers: int = None):
         """
         :param func_classes:
         :param wired: input, output
+        :param buffer_sizes: maximum number of items buffered for a wired input (id, order, argname), default is 1
+        :param max_workers: maximum number of workers of the thread pool running non-inline adapters
         """
+        self.max_workers = max_workers
         # map from function id to a tuple (idx of function, order of function (start from 1)).
         self.id2order = {}
         # map from idx of function to its order
@@ -92,6 +104,17 @@ class Pipeline(object):
         except NetworkXUnfeasible:
             raise ValidationError("Pipeline is not a DAG")
 
+        # mapping of wired input to the maximum number of items its producer can buffer ahead
+        self.buffer_sizes = {input_gname: 1 for input_gname in self.wired}
+        for input_gname, buffer_size in (buffer_sizes or {}).items():
+            if tuple(input_gname) not in self.wired:
+                raise ValidationError(
+                    f"Cannot set buffer size of {WiredIOArg.get_arg_name(*input_gname)} because it is not wired")
+            if not isinstance(buffer_size, int) or buffer_size < 1:
+                raise ValidationError(
+                    f"Invalid buffer size {buffer_size} of {WiredIOArg.get_arg_name(*input_gname)}. Expected a positive integer")
+            self.buffer_sizes[tuple(input_gname)] = buffer_size
+
         self.schema = {}
         for i, func_cls in enumerate(self.func_classes):
             for argname in func_cls.inputs:
@@ -116,7 +139,15 @@ class Pipeline(object):
                 preference = 'array'
             self.preferences[(root[0], root[1])][root[3]] = preference
 
-    def exec(self, inputs: dict) -> None:
+    def exec(self, inputs: dict, report_file: Union[str, Path] = None, trace_file: Union[str, Path] = None,
+             collect_stats: bool = False) -> None:
+        """
+        :param inputs:
+        :param report_file: optional json/csv file to save the profiling report of every adapter
+        :param trace_file: optional json file to save the timeline of every adapter in Chrome trace event format
+        :param collect_stats: estimate the size in bytes of the buffered items (see get_stats), which is always enabled
+            when a report is saved. Otherwise, only the number of buffered items is tracked
+        """
         inputs_copy = {}
         for arg in inputs:
             if isinstance(arg, WiredIOArg):
@@ -134,13 +165,28 @@ class Pipeline(object):
         self.input_ready_events = {}
         # asyncio events to notify the producer of an output that a particular wired input has been consumed
         self.input_received_events = {}
+        # queue of items (with their estimated size in bytes) produced but not yet consumed for each wired input
+        self.buffers = {}
+        # memory accounting of the buffer of each wired input
+        self.buffer_stats = {}
+        # estimating the size of the items is not free, so it's only done when the stats are needed
+        self.collect_stats = collect_stats or report_file is not None
         # set of inputs whose consumer is waiting for it to be ready
         self.waiting_ready_inputs = set()
         # set of inputs whose producer is waiting for it to be consumed
         self.waiting_received_inputs = set()
         # set of tasks which are finished, so that any of their consumers/producers can stop
         self.finished_tasks = set()
+        # asyncio event to wake up the deadlock detector, set only when the pipeline finishes or deadlocks
+        self.state_changed = Event()
         self.output = {}
+        # async generators of the adapters and of their wired inputs, closed once all tasks are done or cancelled
+        self.streams = []
+        # thread pool shared by all adapters which are not executed inline, and by async adapters
+        self.executors = {}
+        self.profiler = PipelineProfiler([
+            (func_cls.id, self.idx2order[i]) for i, func_cls in enumerate(self.func_classes)
+        ], trace=trace_file is not None)
         # list of async tasks, one for each adapter
         tasks = []
         for i, func_cls in enumerate(self.func_classes):
@@ -151,8 +197,14 @@ class Pipeline(object):
                     # wired has higher priority
                     self.input_ready_events[input_gname] = Event()
                     self.input_received_events[input_gname] = Event()
+                    self.buffers[input_gname] = deque()
+                    self.buffer_stats[input_gname] = {
+                        "buffer_size": self.buffer_sizes[input_gname],
+                        "n_items": 0, "n_bytes": 0, "peak_items": 0, "peak_bytes": 0, "total_items": 0
+                    }
                     # passing an async generator (or stream) for a wired input
                     func_args[argname] = self.wait_for_input(input_gname)
+                    self.streams.append(func_args[argname])
                 else:
                     try:
                         func_args[argname] = inputs[WiredIOArg.get_arg_name(*input_gname)]
@@ -163,7 +215,40 @@ class Pipeline(object):
 
             tasks.append(self.create_task(i, func_args))
         # run all tasks concurrently in asyncio event loop
-        get_event_loop().run_until_complete(gather(*tasks, self.detect_deadlock()))
+        try:
+            get_event_loop().run_until_complete(self.run_tasks(tasks))
+        finally:
+            for executor in self.executors.values():
+                executor.shutdown(wait=True)
+            self.executors = {}
+            if report_file is not None:
+                self.profiler.save_report(report_file, self.get_stats())
+            if trace_file is not None:
+                self.profiler.save_trace(trace_file)
+
+    async def run_tasks(self, tasks: List[Coroutine]):
+        tasks = [ensure_future(task) for task in tasks + [self.detect_deadlock()]]
+        try:
+            await gather(*tasks)
+        finally:
+            # cancelling the tasks left waiting after a deadlock or a failed adapter, then closing their adapters and
+            # input streams, so that none of them is garbage collected later while still suspended
+            for task in tasks:
+                task.cancel()
+            await gather(*tasks, return_exceptions=True)
+            for stream in reversed(self.streams):
+                await stream.aclose()
+            self.streams = []
+
+    def get_executor(self, exec_mode: IFuncExecMode) -> Optional[Executor]:
+        """
+        Get the executor shared by all adapters of the given execution mode, None for inline adapters
+        """
+        if exec_mode == IFuncExecMode.INLINE:
+            return None
+        if exec_mode not in self.executors:
+            self.executors[exec_mode] = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dtran")
+        return self.executors[exec_mode]
 
     async def create_task(self, i: int, func_args: dict):
         func_cls = self.func_classes[i]
@@ -172,13 +257,16 @@ class Pipeline(object):
             func_cls = default_wrapper(func_cls, {
                 argname for argname in func_cls.inputs.keys()
                 if (func_cls.id, self.idx2order[i], argname) in self.wired.keys()
-            })
+            }, self.get_executor(func_cls.exec_mode), partial(self.profiler.measure, (func_cls.id, self.idx2order[i])))
         try:
-            func = func_cls(**func_args)
+            with self.profiler.measure((func_cls.id, self.idx2order[i]), "init"):
+                func = func_cls(**func_args)
         except TypeError:
             print(f"Cannot initialize cls: {func_cls}")
             raise
         func.set_preferences(self.preferences[(func_cls.id, self.idx2order[i])])
+        # async adapters offload their blocking work to the thread pool of the pipeline
+        func.set_executor(self.get_executor(IFuncExecMode.THREAD))
         # list of inputs which have been successfully wired
         wired = []
         # default wired inputs for the case if it never goes inside the async for loop below
@@ -189,7 +277,14 @@ class Pipeline(object):
                     wired.append(input_gname)
 
         # looping Async Generator Adapter
-        async for result in func.exec():
+        results = func.exec()
+        self.streams.append(results)
+        while True:
+            try:
+                with self.profiler.measure((func_cls.id, self.idx2order[i]), "run"):
+                    result = await results.__anext__()
+            except StopAsyncIteration:
+                break
             wired = []
             for argname in func_cls.outputs.keys():
                 output_gname = (func_cls.id, self.idx2order[i], argname)
@@ -201,21 +296,28 @@ class Pipeline(object):
                     )
                     raise
                 if output_gname in self.inv_wired:
+                    self.profiler.count_item((func_cls.id, self.idx2order[i]), argname)
+                    nbytes = estimate_size(self.output[output_gname]) if self.collect_stats else 0
                     for input_gname in self.inv_wired[output_gname]:
                         if input_gname[:2] not in self.finished_tasks:
+                            self.push_input(input_gname, self.output[output_gname], nbytes)
                             # notifying consumer of an input that it is ready
                             self.input_ready_events[input_gname].set()
                             self.waiting_ready_inputs.discard(input_gname)
                             wired.append(input_gname)
 
-            # waiting for all wired inputs to be consumed
+            # waiting for the buffers of all wired inputs to have a free slot
             for input_gname in wired:
-                # adding input to the waiting set only if it's not already consumed
-                if not self.input_received_events[input_gname].is_set():
-                    self.waiting_received_inputs.add(input_gname)
-                # waiting for an input to be consumed
-                await self.input_received_events[input_gname].wait()
-                self.input_received_events[input_gname].clear()
+                while len(self.buffers[input_gname]) >= self.buffer_sizes[input_gname] \
+                        and input_gname[:2] not in self.finished_tasks:
+                    # adding input to the waiting set only if it's not already consumed
+                    if not self.input_received_events[input_gname].is_set():
+                        self.waiting_received_inputs.add(input_gname)
+                        self.notify_state_change()
+                    # waiting for an input to be consumed
+                    with self.profiler.measure((func_cls.id, self.idx2order[i]), "wait_received", input_gname[2]):
+                        await self.input_received_events[input_gname].wait()
+                    self.input_received_events[input_gname].clear()
 
         self.finished_tasks.add((func_cls.id, self.idx2order[i]))
         # notifying all wired inputs that producer has finished
@@ -227,32 +329,105 @@ class Pipeline(object):
         # notifying all producers which are still running that consumer has finished
         for argname in func_cls.inputs.keys():
             input_gname = (func_cls.id, self.idx2order[i], argname)
-            if (input_gname in self.wired) and (self.wired[input_gname][:2] not in self.finished_tasks):
-                self.input_received_events[input_gname].set()
-                self.waiting_received_inputs.discard(input_gname)
+            if input_gname in self.wired:
+                # releasing items which will never be consumed
+                while len(self.buffers[input_gname]) > 0:
+                    self.pop_input(input_gname)
+                if self.wired[input_gname][:2] not in self.finished_tasks:
+                    self.input_received_events[input_gname].set()
+                    self.waiting_received_inputs.discard(input_gname)
+        # checking the deadlock condition only after all consumers/producers of the task have been notified
+        self.notify_state_change()
 
     async def wait_for_input(self, input_gname: Tuple[str, int, str]):
         while True:
-            # adding input to the waiting set only if it's not already ready
-            if not self.input_ready_events[input_gname].is_set():
-                self.waiting_ready_inputs.add(input_gname)
-            # waiting for an input to be ready
-            await self.input_ready_events[input_gname].wait()
-            self.input_ready_events[input_gname].clear()
-            # break out of the loop if producer has finished
-            if self.wired[input_gname][:2] in self.finished_tasks:
-                break
+            if len(self.buffers[input_gname]) == 0:
+                # break out of the loop if producer has finished and every buffered item is consumed
+                if self.wired[input_gname][:2] in self.finished_tasks:
+                    break
+                # adding input to the waiting set only if it's not already ready
+                if not self.input_ready_events[input_gname].is_set():
+                    self.waiting_ready_inputs.add(input_gname)
+                    self.notify_state_change()
+                # waiting for an input to be ready
+                with self.profiler.measure(input_gname[:2], "wait_ready", input_gname[2]):
+                    await self.input_ready_events[input_gname].wait()
+                self.input_ready_events[input_gname].clear()
+                continue
+            item = self.pop_input(input_gname)
             # notifying producer of an input that it has been consumed
             self.input_received_events[input_gname].set()
             self.waiting_received_inputs.discard(input_gname)
-            yield self.output[self.wired[input_gname]]
+            yield item
+
+    def push_input(self, input_gname: Tuple[str, int, str], item: Any, nbytes: int) -> None:
+        self.buffers[input_gname].append((item, nbytes))
+        stats = self.buffer_stats[input_gname]
+        stats['n_items'] += 1
+        stats['n_bytes'] += nbytes
+        stats['total_items'] += 1
+        stats['peak_items'] = max(stats['peak_items'], stats['n_items'])
+        stats['peak_bytes'] = max(stats['peak_bytes'], stats['n_bytes'])
+
+    def pop_input(self, input_gname: Tuple[str, int, str]) -> Any:
+        item, nbytes = self.buffers[input_gname].popleft()
+        stats = self.buffer_stats[input_gname]
+        stats['n_items'] -= 1
+        stats['n_bytes'] -= nbytes
+        return item
+
+    def get_stats(self) -> Dict[str, dict]:
+        """
+        Get the memory accounting of the buffer of every wired input, keyed by its argument name. The sizes in bytes are
+        only estimated if the pipeline is executed with collect_stats or report_file
+        """
+        return {
+            WiredIOArg.get_arg_name(*input_gname): dict(stats)
+            for input_gname, stats in getattr(self, 'buffer_stats', {}).items()
+        }
+
+    def notify_state_change(self) -> None:
+        """
+        Re-evaluate the deadlock condition. It is called whenever a task starts waiting or finishes, since those are
+        the only transitions that can lead to a deadlock or to the end of the pipeline
+        """
+        n_running = len(self.func_classes) - len(self.finished_tasks)
+        # checking if all running tasks are waiting, the deadlock condition
+        if n_running == 0 or n_running == len(self.waiting_ready_inputs) + len(self.waiting_received_inputs):
+            self.state_changed.set()
 
     async def detect_deadlock(self):
-        while len(self.finished_tasks) < len(self.func_classes):
-            # checking if all running tasks are waiting, the deadlock condition
-            if len(self.func_classes) - len(self.finished_tasks) == len(self.waiting_ready_inputs) + len(self.waiting_received_inputs):
-                raise RuntimeError("Pipeline went into a deadlock")
-            await sleep(0)
+        # sleeping until the pipeline either finishes or deadlocks, so no CPU is spent while adapters are running
+        await self.state_changed.wait()
+        if len(self.finished_tasks) < len(self.func_classes):
+            raise RuntimeError(f"Pipeline went into a deadlock: {self.describe_deadlock()}")
+
+    def describe_deadlock(self) -> str:
+        """
+        Build a wait-for graph between the adapters and report the (adapter, input) pairs forming a cycle
+        """
+        graph = DiGraph()
+        for input_gname in self.waiting_ready_inputs:
+            # consumer is waiting for its producer to produce input_gname
+            graph.add_edge(input_gname[:2], self.wired[input_gname][:2], input_gname=input_gname, reason="ready")
+        for input_gname in self.waiting_received_inputs:
+            # producer is waiting for its consumer to receive input_gname
+            graph.add_edge(self.wired[input_gname][:2], input_gname[:2], input_gname=input_gname, reason="received")
+
+        try:
+            edges = find_cycle(graph)
+        except NetworkXNoCycle:
+            edges = list(graph.edges)
+
+        waits = []
+        for source, target in edges:
+            edge = graph[source][target]
+            input_name = WiredIOArg.get_arg_name(*edge['input_gname'])
+            if edge['reason'] == "ready":
+                waits.append(f"{source[0]}__{source[1]} waits for {input_name} to be produced by {target[0]}__{target[1]}")
+            else:
+                waits.append(f"{source[0]}__{source[1]} waits for {input_name} to be received by {target[0]}__{target[1]}")
+        return "; ".join(waits)
 
     def validate(self, inputs: dict) -> None:
         errors = self.schema().validate(inputs)
@@ -278,7 +453,138 @@ class Pipeline(object):
         pass
 
 
-def default_wrapper(cls: Type[IFunc], inputs: Set[str]) -> Type[IFunc]:
+try:
+    import resource
+except ImportError:
+    # resource module is only available on Unix
+    resource = None
+
+
+class PipelineProfiler:
+    """
+    Record where the time goes for each adapter instance of a pipeline run:
+        * init: wall time spent initializing the adapter (including the adapters wrapped by default_wrapper)
+        * exec: wall time spent producing results, excluding init and the time blocked on wired inputs
+        * wait_ready: wall time blocked on input_ready_events, i.e., waiting for producers
+        * wait_received: wall time blocked on input_received_events, i.e., waiting for consumers
+        * n_items: number of items yielded per wired output
+        * peak_rss_delta: increase of the peak resident set size (in bytes) while the adapter was running. As adapters
+          run concurrently, this is an approximation
+    """
+
+    def __init__(self, funcs: List[Tuple[str, int]], trace: bool = False):
+        self.start = time.perf_counter()
+        self.stats = {
+            func: {"init": 0.0, "nested_init": 0.0, "run": 0.0, "wait_ready": 0.0, "wait_received": 0.0,
+                   "n_items": Counter(), "peak_rss_delta": 0}
+            for func in funcs
+        }
+        # nested level of measure for each adapter, so that the peak rss is only tracked at the outermost level
+        self.depth = Counter()
+        # trace events in Chrome trace event format, only recorded if it's enabled to avoid growing memory
+        self.trace = trace
+        self.events = []
+
+    @contextmanager
+    def measure(self, func: Tuple[str, int], category: str, name: str = None):
+        track_rss = resource is not None and self.depth[func] == 0 and category in {"init", "run"}
+        # wrapped adapters are initialized while the wrapper is running
+        is_nested_init = self.depth[func] > 0 and category == "init"
+        if track_rss:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.depth[func] += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.depth[func] -= 1
+            self.stats[func][category] += end - start
+            if is_nested_init:
+                self.stats[func]["nested_init"] += end - start
+            if track_rss:
+                # ru_maxrss is in kilobytes on Linux
+                self.stats[func]["peak_rss_delta"] += (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) * 1024
+            if self.trace:
+                self.events.append({
+                    "name": category if name is None else f"{category}:{name}",
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": 1,
+                    "tid": f"{func[0]}__{func[1]}",
+                })
+
+    def count_item(self, func: Tuple[str, int], output: str):
+        self.stats[func]["n_items"][output] += 1
+
+    def get_report(self) -> List[dict]:
+        report = []
+        for (func_id, func_order), stats in self.stats.items():
+            # waiting for inputs and initializing wrapped adapters happen while the adapter is running
+            exec_time = max(stats["run"] - stats["wait_ready"] - stats["nested_init"], 0.0)
+            report.append({
+                "adapter": f"{func_id}__{func_order}",
+                "init_time": stats["init"],
+                "exec_time": exec_time,
+                "wait_ready_time": stats["wait_ready"],
+                "wait_received_time": stats["wait_received"],
+                "n_items": dict(stats["n_items"]),
+                "peak_rss_delta": stats["peak_rss_delta"],
+            })
+        return report
+
+    def save_report(self, report_file: Union[str, Path], buffer_stats: Dict[str, dict] = None):
+        report = self.get_report()
+        if str(report_file).endswith(".csv"):
+            with open(str(report_file), "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(list(report[0].keys()) if len(report) > 0 else [])
+                for row in report:
+                    writer.writerow([ujson.dumps(v) if isinstance(v, dict) else v for v in row.values()])
+        else:
+            with open(str(report_file), "w") as f:
+                ujson.dump({
+                    "total_time": time.perf_counter() - self.start,
+                    "adapters": report,
+                    "buffers": buffer_stats or {}
+                }, f, indent=2)
+
+    def save_trace(self, trace_file: Union[str, Path]):
+        with open(str(trace_file), "w") as f:
+            ujson.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def estimate_size(obj: Any, max_depth: int = 8) -> int:
+    """
+    Estimate the memory footprint of an item flowing through the pipeline in bytes. Arrays are counted by their
+    buffers, and containers/objects are traversed recursively up to max_depth
+    """
+    seen = set()
+
+    def _estimate(o, depth):
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+        if hasattr(o, 'nbytes') and isinstance(getattr(o, 'nbytes'), int):
+            return o.nbytes
+        size = sys.getsizeof(o)
+        if depth >= max_depth or isinstance(o, (str, bytes, int, float, bool)):
+            return size
+        if isinstance(o, dict):
+            return size + sum(_estimate(k, depth + 1) + _estimate(v, depth + 1) for k, v in o.items())
+        if isinstance(o, (list, tuple, set, frozenset, deque)):
+            return size + sum(_estimate(x, depth + 1) for x in o)
+        if hasattr(o, '__dict__'):
+            return size + _estimate(vars(o), depth + 1)
+        return size
+
+    return _estimate(obj, 0)
+
+
+def default_wrapper(cls: Type[IFunc], inputs: Set[str], executor: Executor = None,
+                    measure: Callable[[str], ContextManager] = None) -> Type[IFunc]:
     class DefaultWrapper(IFunc):
         func_cls = cls
 
@@ -300,17 +606,34 @@ def default_wrapper(cls: Type[IFunc], inputs: Set[str]) -> Type[IFunc]:
                         func_args[argname] = await self.func_args[argname].__anext__()
                 except StopAsyncIteration:
                     break
-                func = self.func_cls(**func_args)
+                with (measure("init") if measure is not None else nullcontext()):
+                    if executor is None:
+                        func = self.func_cls(**func_args)
+                    else:
+                        # adapters such as readers query remote services in their constructor
+                        func = await get_event_loop().run_in_executor(executor, partial(self.func_cls, **func_args))
                 # TODO: correctly handle validate and change_metadata in future
                 # correctly handle get_preference for wrapped adapter's instance
                 func.get_preference = self.get_preference
+                func.set_executor(self.executor)
                 if isgeneratorfunction(func.exec):
-                    for result in func.exec():
-                        yield result
+                    if executor is None:
+                        for result in func.exec():
+                            yield result
+                    else:
+                        # advancing the generator in the executor, so the event loop is free between two results
+                        generator = func.exec()
+                        while True:
+                            result = await get_event_loop().run_in_executor(executor, next, generator, StopIteration)
+                            if result is StopIteration:
+                                break
+                            yield result
                 elif iscoroutinefunction(func.exec):
                     yield await func.exec()
-                else:
+                elif executor is None:
                     yield func.exec()
+                else:
+                    yield await get_event_loop().run_in_executor(executor, func.exec)
                 # if there are no wired inputs, break out to avoid looping infinitely
                 if len(inputs) == 0:
                     break
@@ -324,6 +647,7 @@ def default_wrapper(cls: Type[IFunc], inputs: Set[str]) -> Type[IFunc]:
     # setting static properties of DefaultWrapper to proxy wrapped adapter
     for prop in dir(cls):
         if (not prop.startswith("__")) and \
-                (prop not in {'exec', 'validate', 'change_metadata', 'preferences', 'get_preference', 'set_preferences'}):
+                (prop not in {'exec', 'validate', 'change_metadata', 'preferences', 'get_preference', 'set_preferences',
+                              'executor', 'set_executor'}):
             setattr(DefaultWrapper, prop, getattr(cls, prop))
     return DefaultWrapper
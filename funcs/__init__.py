@@ -3,12 +3,14 @@
 
 from .readers.read_func import ReadFunc
 from .readers.dcat_read_func import DcatReadFunc
+from .readers.dcat_read_stream import DcatReadStream
 from .readers.dcat_range_stream import DcatRangeStream
 from .readers.dcat_variable_stream import DcatVariableStream
 from .readers.dcat_read_no_repr import DcatReadNoReprFunc
 # from .trans_unit_func import UnitTransFunc
 from .writers.write_func import CSVWriteFunc
 from .writers.netcdf_write_func import NetCDFWriteFunc
+from .writers.netcdf_stream_write_func import NetCDFStreamWriteFunc
 from .gdal.trans_cropping_func import CroppingTransFunc
 from .writers.geotiff_write_func import GeoTiffWriteFunc
 from .graph_str2str_func import GraphStr2StrFunc
@@ -16,6 +18,8 @@ from .merge_func import MergeFunc
 from .gdal.trans_cropping_func import CroppingTransFunc
 from .gdal.trans_cropping_wrapper import CroppingTransWrapper
 from .aggregations.variable_aggregation_func import VariableAggregationFunc
+from .aggregations.variable_aggregation_stream import VariableAggregationStream
+from .aggregations.zonal_statistics_func import ZonalStatisticsFunc
 from .dcat_write_func import DcatWriteFunc
 # from .calendar_change_func import CalendarChangeFunc
 from .topoflow.nc2geotiff import NC2GeoTiff
@@ -3,11 +3,12 @@
 
 import enum
 import logging
+import re
 import uuid
+import warnings
 from dataclasses import dataclass
-from datetime import datetime, timezone
 from itertools import chain
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 from drepr import DRepr, outputs
@@ -15,7 +16,7 @@ from drepr.executors.readers.np_dict import NPDictReader
 from drepr.executors.readers.reader_container import ReaderContainer
 
 from dtran.argtype import ArgType
-from dtran.ifunc import IFunc, IFuncType
+from dtran.ifunc import IFunc, IFuncType, IFuncExecMode
 from funcs.readers.dcat_read_func import ShardedBackend
 
 
@@ -24,26 +25,49 @@ class GroupByProp:
     prop: str
     value: str
 
+    # periods of time to group timestamps by: pentads are the 6 periods of 5 days of a month (the last one ends
+    # with the month), dekads the 3 periods of 10 days, and water years start on October 1st
+    TIME_PERIODS = {"exact", "minute", "hour", "day", "week", "pentad", "dekad", "month", "water_year", "year"}
+    # units of numpy.datetime64 of the periods which are truncation of the timestamps
+    DATETIME64_UNITS = {"minute": "m", "hour": "h", "day": "D", "month": "M", "year": "Y"}
+
     def to_key(self, value):
         if self.prop == "mint:timestamp":
-            if self.value == "exact":
-                return int(value * 1000)
-            else:
-                dt = datetime.fromtimestamp(value, tz=timezone.utc)
-                if self.value == "minute":
-                    dt = dt.replace(second=0, microsecond=0)
-                elif self.value == "hour":
-                    dt = dt.replace(minute=0, second=0, microsecond=0)
-                elif self.value == "day":
-                    dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
-                elif self.value == "month":
-                    dt = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                elif self.value == "year":
-                    dt = dt.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-                return int(dt.timestamp() * 1000)
+            return int(self.to_keys(np.asarray([value]))[0])
         else:
             return value
 
+    def to_keys(self, values: np.ndarray) -> np.ndarray:
+        """
+        Get the keys of an array of values. Timestamps (in seconds) are mapped to the start of their period in
+        milliseconds with numpy.datetime64 arithmetic
+        """
+        if self.prop != "mint:timestamp":
+            return values
+        if self.value == "exact":
+            return (values * 1000).astype(np.int64)
+
+        dt = np.floor(values * 1000).astype(np.int64).astype("datetime64[ms]")
+        if self.value in GroupByProp.DATETIME64_UNITS:
+            start = dt.astype(f"datetime64[{GroupByProp.DATETIME64_UNITS[self.value]}]")
+        elif self.value == "week":
+            # weeks start on Monday, and 1970-01-01 is a Thursday
+            days = dt.astype("datetime64[D]")
+            start = days - (days.astype(np.int64) + 3) % 7
+        elif self.value in {"pentad", "dekad"}:
+            days = dt.astype("datetime64[D]")
+            month_start = dt.astype("datetime64[M]").astype("datetime64[D]")
+            length, n_periods = (5, 6) if self.value == "pentad" else (10, 3)
+            day_of_month = (days - month_start).astype(np.int64)
+            start = month_start + np.minimum(day_of_month // length, n_periods - 1) * length
+        elif self.value == "water_year":
+            months = dt.astype("datetime64[M]")
+            # months since October of the same water year
+            start = months - (months.astype(np.int64) - 9) % 12
+        else:
+            raise ValueError(f"Invalid time period: {self.value}")
+        return start.astype("datetime64[ms]").astype(np.int64)
+
     def from_key(self, key):
         if self.prop == "mint:timestamp":
             return float(key / 1000)
@@ -60,6 +84,29 @@ class AggregationFunc(enum.Enum):
     SUM = "sum"
     AVG = "average"
     COUNT = "count"
+    MIN = "min"
+    MAX = "max"
+    STD = "std"
+    VAR = "variance"
+    MEDIAN = "median"
+    PERCENTILE = "percentile"
+
+
+@dataclass(frozen=True)
+class Reduction:
+    # name of the function as given by the user, e.g., average or p90 for the 90th percentile
+    name: str
+    func: AggregationFunc
+    q: float = None
+
+    @staticmethod
+    def parse(name: str) -> 'Reduction':
+        name = name.strip()
+        if re.fullmatch(r"p\d+(\.\d+)?", name):
+            return Reduction(name, AggregationFunc.PERCENTILE, float(name[1:]))
+        if name == AggregationFunc.MEDIAN.value:
+            return Reduction(name, AggregationFunc.MEDIAN, 50.0)
+        return Reduction(name, AggregationFunc(name))
 
 
 class VariableAggregationFunc(IFunc):
@@ -67,6 +114,7 @@ class VariableAggregationFunc(IFunc):
     description = ''''''
     func_type = IFuncType.AGGREGATION_TRANS
     friendly_name: str = "Aggregation Function"
+    exec_mode = IFuncExecMode.THREAD
     inputs = {
         "dataset": ArgType.DataSet(None),
         "group_by": ArgType.VarAggGroupBy,
@@ -75,27 +123,36 @@ class VariableAggregationFunc(IFunc):
     outputs = {"data": ArgType.DataSet(None)}
     example = {
         "group_by": "time, lat, long, place",
-        "function": "count, sum, average"
+        "function": "count, sum, average, min, max, std, variance, median, p90"
     }
     logger = logging.getLogger(__name__)
+    # maximum number of values of a group which are stacked to be folded into its accumulators
+    FOLD_SIZE = 32
 
     def __init__(self, dataset, group_by, function):
+        """
+        :param function: a function, or a list of functions which are computed together and distinguished by the
+            mint:aggregation property of the results
+        """
         self.dataset = dataset
         self.group_by = GroupBy([GroupByProp(**x) for x in group_by])
-        self.function = AggregationFunc(function)
+        self.functions = [Reduction.parse(f) for f in (function if isinstance(function, list) else [function])]
+        self.label_function = isinstance(function, list)
 
     def exec(self) -> dict:
         groups = {}
-
         if isinstance(self.dataset, ShardedBackend):
-            # check if the data is partition
+            # the variables of each partition are grouped at once, and folded before the next partition
             for dataset in reversed(self.dataset.datasets):
-                VariableAggregationFunc._group_by(dataset, self.group_by, groups)
+                VariableAggregationFunc._group_by(dataset, self.group_by, groups, self.functions)
         else:
-            VariableAggregationFunc._group_by(self.dataset, self.group_by, groups)
+            VariableAggregationFunc._group_by(self.dataset, self.group_by, groups, self.functions)
 
-        values = VariableAggregationFunc._aggregate(groups, self.function)
+        values = VariableAggregationFunc._aggregate(groups, self.functions, self.label_function)
+        return {"data": VariableAggregationFunc._to_dataset(values)}
 
+    @staticmethod
+    def _to_dataset(values: list):
         if len(values) > 1:
             ds = ShardedBackend(len(values))
             for v in values:
@@ -129,192 +186,357 @@ class VariableAggregationFunc(IFunc):
                 dsmodel = DRepr.parse(dsmodel)
                 ds = outputs.ArrayBackend.from_drepr(dsmodel, resource_id)
                 ReaderContainer.get_instance().delete(resource_id)
-        return {"data": ds}
+        return ds
 
     def validate(self) -> bool:
         return True
 
     @staticmethod
-    def _group_by(sm, group_by: GroupBy, groups: dict):
+    def _group_by(sm, group_by: GroupBy, groups: dict, funcs: List[Reduction] = None, by_variable: bool = False) -> set:
+        """
+        Group the variables of a dataset. The values of a group are kept until they are aggregated, or folded into
+        running accumulators of the group if funcs is given (so only the accumulators are kept in memory, except
+        for the median and percentiles which need every value)
+
+        :param by_variable: the variables are also grouped by their mint:standardName, so the groups of different
+            variables accumulated across datasets are not mixed. The keys of the groups are (name, key)
+        :return: keys of the groups which have been updated
+        """
         rdf = sm.ns(outputs.Namespace.RDF)
         mint_geo = sm.ns("https://mint.isi.edu/geo")
         mint = sm.ns("https://mint.isi.edu/")
+        # the variables are partitioned by the props which are part of their keys (i.e., which have a single value)
+        partitions = {}
         for c in sm.c(mint.Variable):
-            index_keys = [p.prop for p in group_by.group_props if c.p(p.prop).ndarray_size() != 1]
-            first_record = next(c.iter_records())
             key_props = [p for p in group_by.group_props if c.p(p.prop).ndarray_size() == 1]
-            sub_key = tuple([
-                p.to_key(first_record.s(p.prop)) for p in key_props
-            ])
-            assert 'mint:timestamp' not in index_keys
-            if sub_key not in groups:
-                groups[sub_key] = {
-                    "key": sub_key,
-                    "dataset": sm,
-                    "record": first_record,
-                    "key_props": key_props,
-                    "carried_props": [
-                        p for p, po in c.predicates.items() if po.ndarray_size() == 1
-                    ],
-                    "index_props": index_keys,
-                    "data": [c.p(rdf.value).as_ndarray([c.p(x) for x in index_keys])]
-                }
+            partitions.setdefault(tuple(p.prop for p in key_props), (key_props, []))[1].append(
+                (c, next(c.iter_records())))
+
+        keys = set()
+        for key_props, members in partitions.values():
+            # keys of each prop for all variables at once, encoded as integer codes to find the groups with np.unique
+            prop_keys = []
+            codes = np.zeros((len(members), len(key_props) + int(by_variable)), dtype=np.int64)
+            for i, p in enumerate(key_props):
+                values = [record.s(p.prop) for _, record in members]
+                if p.prop == "mint:timestamp":
+                    prop_keys.append(p.to_keys(np.asarray(values, dtype=np.float64)))
+                    codes[:, i] = np.unique(prop_keys[-1], return_inverse=True)[1]
+                else:
+                    prop_keys.append([p.to_key(v) for v in values])
+                    index = {}
+                    codes[:, i] = [index.setdefault(k, len(index)) for k in prop_keys[-1]]
+            if by_variable:
+                names = [VariableAggregationFunc._get_variable_name(c, record) for c, record in members]
+                index = {}
+                codes[:, -1] = [index.setdefault(name, len(index)) for name in names]
+            n_groups, group_ids = 1, np.zeros(len(members), dtype=np.int64)
+            if codes.shape[1] > 0:
+                group_ids = np.unique(codes, axis=0, return_inverse=True)[1].reshape(-1)
+                n_groups = int(group_ids.max()) + 1
+            # the variables sorted by group, and the boundaries of each group
+            order = np.argsort(group_ids, kind="stable")
+            bounds = np.searchsorted(group_ids[order], np.arange(n_groups + 1))
+
+            for group_id in range(n_groups):
+                member_ids = order[bounds[group_id]:bounds[group_id + 1]]
+                sub_key = tuple(
+                    int(k[member_ids[0]]) if p.prop == "mint:timestamp" else k[member_ids[0]]
+                    for p, k in zip(key_props, prop_keys)
+                )
+                group_key = (names[member_ids[0]], sub_key) if by_variable else sub_key
+                values = []
+                for j, member_id in enumerate(member_ids):
+                    c, record = members[member_id]
+                    index_keys = [p.prop for p in group_by.group_props if c.p(p.prop).ndarray_size() != 1]
+                    assert 'mint:timestamp' not in index_keys
+                    if group_key not in groups:
+                        groups[group_key] = {
+                            "key": sub_key,
+                            "key_props": key_props,
+                            # the carried props are copied, so the group does not hold the dataset
+                            "carried_props": VariableAggregationFunc._get_carried_props(sm, c, record),
+                            "index_props": index_keys,
+                            "data": []
+                        }
+                    values.append(c.p(rdf.value).as_ndarray([c.p(x) for x in index_keys]))
+                    if funcs is None:
+                        groups[group_key]['data'].extend(values)
+                        values = []
+                    elif len(values) == VariableAggregationFunc.FOLD_SIZE or j == len(member_ids) - 1:
+                        # the values of the group are folded together by chunks, so only FOLD_SIZE values are
+                        # stacked at once
+                        VariableAggregationFunc._fold(groups[group_key], values, funcs)
+                        values = []
+                keys.add(group_key)
+        return keys
+
+    @staticmethod
+    def _get_variable_name(c, record) -> Optional[str]:
+        po = c.p("mint:standardName")
+        if po is None or po.ndarray_size() != 1:
+            return None
+        return record.s("mint:standardName")
+
+    @staticmethod
+    def _get_carried_props(sm, c, record) -> list:
+        carried_props = []
+        for p, po in c.predicates.items():
+            if po.ndarray_size() != 1:
+                continue
+            if p in {"mint:place", "mint-geo:raster"}:
+                carried_props.append((p, sm.get_record_by_id(record.s(p)).to_dict()))
             else:
-                groups[sub_key]['data'].append(
-                    c.p(rdf.value).as_ndarray([c.p(x) for x in index_keys]))
+                carried_props.append((p, record.s(p)))
+        return carried_props
+
+    @staticmethod
+    def _fold(group: dict, values: list, funcs: List[Reduction]):
+        """
+        Fold values of a group into its running accumulators. The values are stacked into one array, so every
+        accumulator is updated by a single masked numpy operation
+        """
+        data = np.stack([v.data for v in values]) if len(values) > 1 else values[0].data[None]
+        nodata = values[0].nodata.value
+        mask = data != nodata
+        kinds = {f.func for f in funcs}
+        if 'count' not in group:
+            group['count'] = np.zeros(data.shape[1:], dtype=np.int64)
+            group['total'] = np.zeros(data.shape[1:], dtype=data.dtype)
+            if AggregationFunc.MIN in kinds:
+                group['min'] = np.full(data.shape[1:], np.inf)
+            if AggregationFunc.MAX in kinds:
+                group['max'] = np.full(data.shape[1:], -np.inf)
+            if kinds & {AggregationFunc.STD, AggregationFunc.VAR}:
+                group['mean'] = np.zeros(data.shape[1:], dtype=np.float64)
+                group['m2'] = np.zeros(data.shape[1:], dtype=np.float64)
+            if kinds & {AggregationFunc.MEDIAN, AggregationFunc.PERCENTILE}:
+                group['values'] = []
+            group['ndim'] = data.ndim - 1
+            group['dtype'] = data.dtype
+            group['nodata'] = nodata
+            group['index_values'] = values[0].index_props
+
+        n = mask.sum(axis=0)
+        total = np.where(mask, data, 0).sum(axis=0, dtype=group['total'].dtype)
+        group['total'] += total
+        if 'min' in group:
+            group['min'] = np.minimum(group['min'], np.where(mask, data, np.inf).min(axis=0))
+        if 'max' in group:
+            group['max'] = np.maximum(group['max'], np.where(mask, data, -np.inf).max(axis=0))
+        if 'mean' in group:
+            # Welford's algorithm, merging the mean and the sum of squared deviations of the stacked values into the
+            # ones of the group (Chan et al.), which is stable even when the values are large compared to their spread
+            mean = np.divide(total, n, out=np.zeros(n.shape), where=n > 0)
+            m2 = np.where(mask, (data - mean) ** 2, 0).sum(axis=0)
+            n_total = group['count'] + n
+            delta = mean - group['mean']
+            ratio = np.divide(n, n_total, out=np.zeros(n.shape), where=n_total > 0)
+            group['m2'] += m2 + delta ** 2 * group['count'] * ratio
+            group['mean'] += delta * ratio
+        if 'values' in group:
+            group['values'].append(np.where(mask, data, np.nan).astype(np.float64))
+        group['count'] += n
 
     @staticmethod
-    def _aggregate(groups: dict, func: AggregationFunc):
+    def _finalize(group: dict, funcs: List[Reduction]) -> list:
+        """Compute the results of a group from its accumulators, in the same order as funcs"""
+        # one extra dimension at the end, which we need to reduce
+        has_extra_dim = len(group['index_props']) < group['ndim']
+        count = group['count'].sum(axis=-1) if has_extra_dim else group['count']
+        nodata = group['nodata']
+
+        percentiles = {}
+        qs = sorted({f.q for f in funcs if f.q is not None})
+        if len(qs) > 0:
+            # all percentiles are computed by a single partition of the values
+            values = np.moveaxis(np.concatenate(group['values'], axis=0), 0, -1)
+            if has_extra_dim:
+                values = values.reshape(values.shape[:-2] + (-1,))
+            with warnings.catch_warnings():
+                # groups without any observation
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                results = np.nanpercentile(values, qs, axis=-1)
+            for q, result in zip(qs, results):
+                percentiles[q] = np.where(count > 0, result, nodata)
+
+        results = []
+        for f in funcs:
+            if f.func == AggregationFunc.SUM:
+                total = group['total']
+                results.append(total.sum(axis=-1) if has_extra_dim else total)
+            elif f.func == AggregationFunc.COUNT:
+                results.append(count.astype(group['dtype']))
+            elif f.func == AggregationFunc.AVG:
+                results.append(VariableAggregationFunc._finalize_average(group, has_extra_dim))
+            elif f.func in {AggregationFunc.MIN, AggregationFunc.MAX}:
+                if f.func == AggregationFunc.MIN:
+                    result = group['min'].min(axis=-1) if has_extra_dim else group['min']
+                else:
+                    result = group['max'].max(axis=-1) if has_extra_dim else group['max']
+                results.append(np.where(count > 0, result, nodata).astype(group['dtype']))
+            elif f.func in {AggregationFunc.STD, AggregationFunc.VAR}:
+                n, mean, m2 = group['count'], group['mean'], group['m2']
+                if has_extra_dim:
+                    # merging the sums of squared deviations of the last dimension
+                    mean_total = np.divide((n * mean).sum(axis=-1), count, out=np.zeros(count.shape), where=count > 0)
+                    m2 = (m2 + n * (mean - mean_total[..., None]) ** 2).sum(axis=-1)
+                result = np.divide(m2, count, out=np.zeros(count.shape), where=count > 0)
+                if f.func == AggregationFunc.STD:
+                    result = np.sqrt(result)
+                results.append(np.where(count > 0, result, nodata))
+            else:
+                results.append(percentiles[f.q])
+        return results
+
+    @staticmethod
+    def _finalize_average(group: dict, has_extra_dim: bool) -> np.ndarray:
+        total = group['total']
+        n_obs = group['count'].astype(group['dtype'])
+        nodata = group['nodata']
+        if has_extra_dim:
+            # calculate the total
+            total = total.sum(axis=-1)
+            # calculate the n_obs
+            n_obs = n_obs.sum(axis=-1)
+
+            if group['ndim'] == 1:
+                if n_obs == 0:
+                    result = [nodata]
+                else:
+                    result = [total / n_obs]
+                result = np.asarray(result)
+            else:
+                result = total / n_obs
+                result[n_obs == 0] = nodata
+        else:
+            obs_mask = n_obs != 0
+            result = np.zeros(total.shape, dtype=np.float32 if total.dtype == np.float32 else np.float64)
+            result[obs_mask] = total[obs_mask] / n_obs[obs_mask]
+        return result
+
+    @staticmethod
+    def _aggregate(groups: dict, funcs: List[Reduction], label_function: bool = False):
         """Aggregate the data"""
         # TODO: fix me, this is currently implement a corner case
         raw_ds = []
         for key, group in groups.items():
             # because the rest is group by exact value, we don't need to do anything
-            values = group['data']
-            if func == AggregationFunc.SUM:
-                total = np.zeros_like(values[0].data)
-                for v in values:
-                    total += v.data * (v.data != v.nodata.value)
-                if len(group['index_props']) < len(values[0].data.shape):
-                    # one extra dimension at the end, which we need to sum
-                    total = total.sum(axis=-1)
-                result = total
-            elif func == AggregationFunc.COUNT:
-                total = np.zeros_like(values[0].data)
-                for v in values:
-                    total += (v.data != v.nodata.value).astype(np.int64)
-
-                if len(group['index_props']) < len(values[0].data.shape):
-                    # one extra dimension at the end, which we need to sum
-                    total = total.sum(axis=-1)
-                result = total
-            elif func == AggregationFunc.AVG:
-                total = np.zeros_like(values[0].data)
-                n_obs = np.zeros_like(values[0].data)
-                for v in values:
-                    mask = (v.data != v.nodata.value).astype(np.float32)
-                    n_obs += mask
-                    total += v.data * mask
-
-                if len(group['index_props']) < len(values[0].data.shape):
-                    # one extra dimension at the end
-                    # calculate the total
-                    total = total.sum(axis=-1)
-                    # calculate the n_obs
-                    n_obs = n_obs.sum(axis=-1)
-
-                    if len(values[0].data.shape) == 1:
-                        if n_obs == 0:
-                            result = [values[0].nodata.value]
-                        else:
-                            result = [total / n_obs]
-                        result = np.asarray(result)
-                    else:
-                        result = np.zeros(values[0].data.shape[:-1], dtype=np.float32 if values[0].data.dtype == np.float32 else np.float64)
-                        result = total / n_obs
-                        result[n_obs == 0] = values[0].nodata.value
-                else:
-                    obs_mask = n_obs != 0
-                    result = np.zeros(values[0].data.shape, dtype=np.float32 if values[0].data.dtype == np.float32 else np.float64)
-                    result[obs_mask] = total[obs_mask] / n_obs[obs_mask]
-
-            attrs = {'rdf_value': "$.rdf_value" + ("[:]" * len(result.shape))}
-            aligns = []
-            tbl = {}
-            raw_sm = {
-                "mint:Variable:1": {
-                    "properties": [
-                        ("rdf:value", "rdf_value"),
-                    ],
-                    'links': []
-                },
-                "prefixes": {
-                    "mint": "https://mint.isi.edu/",
-                    "mint-geo": "https://mint.isi.edu/geo"
-                }
+            if len(group['data']) > 0:
+                VariableAggregationFunc._fold(group, group['data'], funcs)
+                group['data'] = []
+            for f, result in zip(funcs, VariableAggregationFunc._finalize(group, funcs)):
+                raw_ds.append(VariableAggregationFunc._build(group, result, f.name if label_function else None))
+        return raw_ds
+
+    @staticmethod
+    def _build(group: dict, result: np.ndarray, function: str = None) -> dict:
+        """Build the dataset of the result of a group"""
+        attrs = {'rdf_value': "$.rdf_value" + ("[:]" * len(result.shape))}
+        aligns = []
+        tbl = {}
+        raw_sm = {
+            "mint:Variable:1": {
+                "properties": [
+                    ("rdf:value", "rdf_value"),
+                ],
+                'links': []
+            },
+            "prefixes": {
+                "mint": "https://mint.isi.edu/",
+                "mint-geo": "https://mint.isi.edu/geo"
             }
-            tbl['rdf_value'] = result
-            key_props = {p.prop: i for i, p in enumerate(group['key_props'])}
-            for p in group['carried_props']:
-                if p in {"mint:place", "mint-geo:raster"}:
-                    o = group['dataset'].get_record_by_id(group['record'].s(p))
-                    if p == "mint-geo:raster":
-                        raw_sm['mint-geo:Raster:1'] = {"properties": []}
-                        raw_sm['mint:Variable:1']['links'].append(
-                            ('mint-geo:raster', 'mint-geo:Raster:1'))
-                        for k, v in o.to_dict().items():
-                            if k == '@id':
-                                continue
+        }
+        tbl['rdf_value'] = result
+        if function is not None:
+            tbl['aggregation'] = function
+            attrs['aggregation'] = "$.aggregation"
+            raw_sm['mint:Variable:1']['properties'].append(("mint:aggregation", "aggregation"))
+            aligns.append({
+                "type": "dimension",
+                "source": 'rdf_value',
+                "target": 'aggregation',
+                "aligned_dims": []
+            })
+        key_props = {p.prop: i for i, p in enumerate(group['key_props'])}
+        for p, o in group['carried_props']:
+            if p in {"mint:place", "mint-geo:raster"}:
+                if p == "mint-geo:raster":
+                    raw_sm['mint-geo:Raster:1'] = {"properties": []}
+                    raw_sm['mint:Variable:1']['links'].append(
+                        ('mint-geo:raster', 'mint-geo:Raster:1'))
+                    for k, v in o.items():
+                        if k == '@id':
+                            continue
 
+                        aid = f"{p}_{k}".replace(":", "_")
+                        raw_sm['mint-geo:Raster:1']['properties'].append((k, aid))
+                        tbl[aid] = v[0]
+                        attrs[aid] = f"$.{aid}"
+                        aligns.append({
+                            "type": "dimension",
+                            "source": "rdf_value",
+                            "target": aid,
+                            "aligned_dims": []
+                        })
+                elif p == 'mint:place':
+                    raw_sm['mint:Place:1'] = {"properties": []}
+                    raw_sm['mint:Variable:1']['links'].append(('mint:place', 'mint:Place:1'))
+                    for k, v in o.items():
+                        if k == '@id':
+                            continue
+
+                        if k.startswith("mint:"):
                             aid = f"{p}_{k}".replace(":", "_")
-                            raw_sm['mint-geo:Raster:1']['properties'].append((k, aid))
                             tbl[aid] = v[0]
                             attrs[aid] = f"$.{aid}"
+                            raw_sm['mint:Place:1']['properties'].append((k, aid))
                             aligns.append({
                                 "type": "dimension",
                                 "source": "rdf_value",
                                 "target": aid,
                                 "aligned_dims": []
                             })
-                    elif p == 'mint:place':
-                        raw_sm['mint:Place:1'] = {"properties": []}
-                        raw_sm['mint:Variable:1']['links'].append(('mint:place', 'mint:Place:1'))
-                        for k, v in o.to_dict().items():
-                            if k == '@id':
-                                continue
-
-                            if k.startswith("mint:"):
-                                aid = f"{p}_{k}".replace(":", "_")
-                                tbl[aid] = v[0]
-                                attrs[aid] = f"$.{aid}"
-                                raw_sm['mint:Place:1']['properties'].append((k, aid))
-                                aligns.append({
-                                    "type": "dimension",
-                                    "source": "rdf_value",
-                                    "target": aid,
-                                    "aligned_dims": []
-                                })
-                else:
-                    aid = p.replace(":", "_")
-                    if p in key_props:
-                        tbl[aid] = group['key_props'][key_props[p]].from_key(group['key'][key_props[p]])
-                    else:
-                        tbl[aid] = group['record'].s(p)
-                    attrs[aid] = f"$.{aid}"
-                    raw_sm['mint:Variable:1']['properties'].append((p, aid))
-                    aligns.append({
-                        "type": "dimension",
-                        "source": 'rdf_value',
-                        "target": aid,
-                        "aligned_dims": []
-                    })
-            for i, p in enumerate(group['index_props']):
+            else:
                 aid = p.replace(":", "_")
-                tbl[aid] = values[0].index_props[i]
-                attrs[aid] = f"$.{aid}[:]"
+                if p in key_props:
+                    tbl[aid] = group['key_props'][key_props[p]].from_key(group['key'][key_props[p]])
+                else:
+                    tbl[aid] = o
+                attrs[aid] = f"$.{aid}"
                 raw_sm['mint:Variable:1']['properties'].append((p, aid))
                 aligns.append({
                     "type": "dimension",
-                    "source": "rdf_value",
+                    "source": 'rdf_value',
                     "target": aid,
-                    "aligned_dims": [{
-                        "source": i + 1,
-                        "target": 1
-                    }]
+                    "aligned_dims": []
                 })
+        for i, p in enumerate(group['index_props']):
+            aid = p.replace(":", "_")
+            tbl[aid] = group['index_values'][i]
+            attrs[aid] = f"$.{aid}[:]"
+            raw_sm['mint:Variable:1']['properties'].append((p, aid))
+            aligns.append({
+                "type": "dimension",
+                "source": "rdf_value",
+                "target": aid,
+                "aligned_dims": [{
+                    "source": i + 1,
+                    "target": 1
+                }]
+            })
 
-            # remove raster if we don't have it any more
-            has_mintgeo_coor = False
-            for prop in chain(raw_sm['mint:Variable:1']['properties'], raw_sm['mint:Variable:1'].get('static_properties', [])):
-                if prop[0] == 'mint-geo:lat':
-                    has_mintgeo_coor = True
-            if not has_mintgeo_coor:
-                delete_link = []
-                for i, link in enumerate(raw_sm['mint:Variable:1']['links']):
-                    if link[0] == 'mint-geo:raster':
-                        raw_sm.pop(link[1])
-                        delete_link.append(i)
-                for i in reversed(delete_link):
-                    raw_sm['mint:Variable:1']['links'].pop(i)
-            raw_ds.append({"data": tbl, "attrs": attrs, "aligns": aligns, "sm": raw_sm})
-        return raw_ds
+        # remove raster if we don't have it any more
+        has_mintgeo_coor = False
+        for prop in chain(raw_sm['mint:Variable:1']['properties'], raw_sm['mint:Variable:1'].get('static_properties', [])):
+            if prop[0] == 'mint-geo:lat':
+                has_mintgeo_coor = True
+        if not has_mintgeo_coor:
+            delete_link = []
+            for i, link in enumerate(raw_sm['mint:Variable:1']['links']):
+                if link[0] == 'mint-geo:raster':
+                    raw_sm.pop(link[1])
+                    delete_link.append(i)
+            for i in reversed(delete_link):
+                raw_sm['mint:Variable:1']['links'].pop(i)
+        return {"data": tbl, "attrs": attrs, "aligns": aligns, "sm": raw_sm}
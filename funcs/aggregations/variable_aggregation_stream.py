@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from asyncio import get_event_loop
+from typing import Union, Generator, AsyncGenerator, Optional, Dict, List
+
+from dtran.argtype import ArgType
+from dtran.backend import ShardedBackend
+from dtran.ifunc import IFunc, IFuncType
+from dtran.metadata import Metadata
+from funcs.aggregations.variable_aggregation_func import VariableAggregationFunc, Reduction, GroupBy, GroupByProp
+
+
+class VariableAggregationStream(IFunc):
+    id = "aggregation_stream"
+    description = """ Aggregates a stream of datasets (e.g., the output of the cropping wrapper) with running
+    accumulators, and returns the aggregated groups as soon as their time period is over.
+    """
+    func_type = IFuncType.AGGREGATION_TRANS
+    friendly_name: str = "Aggregation Stream"
+    inputs = VariableAggregationFunc.inputs
+    outputs = VariableAggregationFunc.outputs
+    example = VariableAggregationFunc.example
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, dataset, group_by, function):
+        """
+        :param dataset: stream of datasets, ordered by time: a time period is over when a dataset starting after
+            it is received
+        """
+        self.dataset = dataset
+        self.group_by = GroupBy([GroupByProp(**x) for x in group_by])
+        self.functions = [Reduction.parse(f) for f in (function if isinstance(function, list) else [function])]
+        self.label_function = isinstance(function, list)
+
+    async def exec(self) -> Union[dict, Generator[dict, None, None], AsyncGenerator[dict, None]]:
+        # only the accumulators of the groups whose time period is not over are kept. The groups are keyed by the
+        # variable too, as the datasets of different variables (e.g., of the cropping wrapper) are accumulated together
+        groups = {}
+        # the latest time key of the groups which have been returned
+        closed_time = None
+        async for dataset in self.iter_datasets():
+            if isinstance(dataset, ShardedBackend):
+                # the shards are only read, as the same dataset may be wired to other adapters
+                shards = list(reversed(dataset.datasets))
+            else:
+                shards = [dataset]
+            # dropping our references, so each shard is released as soon as it is folded if no one else holds it
+            dataset = None
+            while len(shards) > 0:
+                shard = shards.pop(0)
+                keys = await get_event_loop().run_in_executor(
+                    self.executor, VariableAggregationFunc._group_by, shard, self.group_by, groups, self.functions,
+                    True)
+                shard = None
+                times = [t for t in (self.get_time(groups[key]) for key in keys) if t is not None]
+                if len(times) == 0:
+                    continue
+                if closed_time is not None and min(times) <= closed_time:
+                    self.logger.warning("Received data of a time period which has been returned, the stream of "
+                                        "datasets should be ordered by time")
+                closed_keys = [key for key, group in groups.items()
+                               if self.get_time(group) is not None and self.get_time(group) < min(times)]
+                if len(closed_keys) > 0:
+                    closed_time = max(self.get_time(groups[key]) for key in closed_keys)
+                    yield {"data": await get_event_loop().run_in_executor(
+                        self.executor, self.aggregate, [groups.pop(key) for key in closed_keys])}
+
+        if len(groups) > 0:
+            yield {"data": await get_event_loop().run_in_executor(
+                self.executor, self.aggregate, list(groups.values()))}
+
+    async def iter_datasets(self):
+        if hasattr(self.dataset, '__anext__'):
+            while True:
+                try:
+                    yield await self.dataset.__anext__()
+                except StopAsyncIteration:
+                    break
+        else:
+            yield self.dataset
+
+    @staticmethod
+    def get_time(group: dict) -> Optional[int]:
+        for i, p in enumerate(group['key_props']):
+            if p.prop == "mint:timestamp":
+                return group['key'][i]
+        return None
+
+    def aggregate(self, groups: List[dict]):
+        # the keys of the groups are not unique across variables
+        values = VariableAggregationFunc._aggregate(dict(enumerate(groups)), self.functions, self.label_function)
+        return VariableAggregationFunc._to_dataset(values)
+
+    def validate(self) -> bool:
+        return True
+
+    def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
+        return metadata
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Dict
+from urllib.parse import urlencode
+
+import numpy as np
+from drepr import DRepr, outputs
+from drepr.executors.readers.np_dict import NPDictReader
+from drepr.executors.readers.reader_container import ReaderContainer
+
+from dtran.argtype import ArgType
+from dtran.backend import ShardedBackend
+from dtran.ifunc import IFunc, IFuncType, IFuncExecMode
+from dtran.metadata import Metadata
+from funcs.aggregations.variable_aggregation_func import GroupByProp
+from funcs.gdal.cutline_mask import CutlineMaskCache
+from funcs.gdal.raster import Raster
+from funcs.gdal.trans_cropping_func import CroppingTransFunc
+
+zonal_model = {
+    "version": "2",
+    "resources": "container",
+    "attributes": {
+        "variable_name": "$.variable_name",
+        "variable": "$.variable[:]",
+        "timestamp": "$.timestamp[:]",
+        "place_uri": "$.place_uri",
+    },
+    "alignments": [
+        {"type": "dimension", "value": "variable:1 <-> timestamp:1"},
+        {"type": "dimension", "source": "variable", "target": "variable_name", "aligned_dims": []},
+        {"type": "dimension", "source": "variable", "target": "place_uri", "aligned_dims": []},
+    ],
+    "semantic_model": {
+        "mint:Variable:1": {
+            "properties": [
+                ("rdf:value", "variable"),
+                ("mint:timestamp", "timestamp"),
+                ("mint:standardName", "variable_name")
+            ],
+            "links": [
+                ("mint:place", "mint:Place:1")
+            ]
+        },
+        "mint:Place:1": {
+            "properties": [
+                ("drepr:uri", "place_uri")
+            ]
+        },
+        "prefixes": {
+            "mint": "https://mint.isi.edu/",
+            "mint-geo": "https://mint.isi.edu/geo"
+        }
+    }
+}
+
+
+@dataclass
+class ZonalLabels:
+    """
+    Pixels of a grid in each region: the rows and columns of the pixels sorted by region, and the start of each region
+    in them. A pixel on the boundary of two regions is in both, as when the regions are cropped one by one
+    """
+    rows: np.ndarray
+    cols: np.ndarray
+    starts: np.ndarray
+    # indices of the regions having at least one pixel in the grid, in the same order as starts
+    regions: np.ndarray
+
+
+class ZonalStatisticsFunc(IFunc):
+    id = "zonal_statistics_func"
+    description = """ Aggregates the variables of a raster dataset over every region of a shape dataset.
+    All regions are aggregated together instead of cropping the dataset region by region.
+    """
+    func_type = IFuncType.AGGREGATION_TRANS
+    friendly_name: str = "Zonal Statistics Function"
+    # the reductions are numpy operations which release the GIL
+    exec_mode = IFuncExecMode.THREAD
+    inputs = {
+        "dataset": ArgType.DataSet(None),
+        "shape": ArgType.DataSet(None),
+        "variable_name": ArgType.String(optional=True),
+        "function": ArgType.String(optional=True),
+        "time_period": ArgType.String(optional=True),
+    }
+    outputs = {"data": ArgType.DataSet(None)}
+    example = {
+        "variable_name": "",
+        "function": "sum, average, count, min, max",
+        "time_period": "exact, minute, hour, day, week, pentad, dekad, month, water_year, year"
+    }
+    logger = logging.getLogger(__name__)
+
+    FUNCTIONS = {"sum", "average", "count", "min", "max"}
+    # maximum number of bytes of the pixels of the regions gathered at once (the number of rasters reduced together)
+    MAX_BATCH_SIZE = 1 << 28
+
+    def __init__(self, dataset, shape, variable_name: str = "", function: str = "average", time_period: str = "exact"):
+        self.dataset = dataset
+        self.shape_sm = shape
+        self.variable_name = variable_name
+        self.function = function
+        self.time_period = GroupByProp("mint:timestamp", time_period)
+
+    def validate(self) -> bool:
+        return self.function in ZonalStatisticsFunc.FUNCTIONS and \
+               self.time_period.value in GroupByProp.TIME_PERIODS
+
+    def exec(self) -> dict:
+        rasters = CroppingTransFunc.extract_raster(self.dataset, self.variable_name)
+        shapes = CroppingTransFunc.extract_shape(self.shape_sm)
+        wkts = [CroppingTransFunc.shape_array_to_wkt(shape) for shape in shapes]
+
+        # labels of the regions are built once per grid and shared by all rasters on that grid
+        labels = {}
+        variables = OrderedDict()
+        for r in rasters:
+            raster = r["raster"]
+            grid = (raster.geotransform.to_gdal(), raster.data.shape[-2:], raster.epsg)
+            if grid not in labels:
+                labels[grid] = ZonalStatisticsFunc.get_labels(raster, shapes, wkts)
+            variables.setdefault(r["variable_name"], []).append((grid, r))
+
+        results = []
+        for variable_name, members in variables.items():
+            has_timestamp = members[0][1]["timestamp"] is not None
+            assert all((r["timestamp"] is not None) == has_timestamp for _, r in members), \
+                f"Some rasters of {variable_name} do not have timestamp"
+            keys = np.asarray([self.time_period.to_key(r["timestamp"]) if has_timestamp else 0 for _, r in members],
+                              dtype=np.int64)
+            bucket_keys, buckets = np.unique(keys, return_inverse=True)
+            stats = ZonalStatisticsFunc.reduce(members, buckets, len(bucket_keys), len(shapes), labels)
+            values = ZonalStatisticsFunc.finalize(stats, self.function, members[0][1]["raster"].nodata)
+            timestamps = [self.time_period.from_key(key) for key in bucket_keys] if has_timestamp else None
+            for i, shape in enumerate(shapes):
+                results.append(ZonalStatisticsFunc.to_dataset(variable_name, values[:, i], timestamps, shape["place"]))
+
+        assert len(results) > 0, "No data for the given regions"
+        ds = ShardedBackend(len(results))
+        for dsmodel, data in results:
+            resource_id = "resource-" + str(uuid.uuid4())
+            ReaderContainer.get_instance().set(resource_id, NPDictReader(data))
+            ds.add(outputs.ArrayBackend.from_drepr(dsmodel, resource_id, ds.inject_class_id))
+            ReaderContainer.get_instance().delete(resource_id)
+        return {"data": ds}
+
+    @staticmethod
+    def get_labels(raster: Raster, shapes: List[dict], wkts: List[str]) -> ZonalLabels:
+        """
+        Rasterize the regions on the grid of the raster, reusing the masks cached by the cropping function
+        """
+        mask_cache = CutlineMaskCache.get_instance()
+        height, width = raster.data.shape[-2:]
+        pixels_rows, pixels_cols, regions = [], [], []
+        for i, (shape, wkt) in enumerate(zip(shapes, wkts)):
+            mask = mask_cache.get(wkt, shape["epsg"], raster, same_as_warp=False)
+            assert mask is not None, \
+                f"The grid of the raster (epsg {raster.epsg}) needs to be reprojected to the regions (epsg {shape['epsg']})"
+            rows, cols = np.nonzero(mask.mask)
+            rows += mask.row_offset
+            cols += mask.col_offset
+            # the window of the region may go past the grid
+            inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+            pixels_rows.append(rows[inside])
+            pixels_cols.append(cols[inside])
+            regions.append(np.full(int(inside.sum()), i, dtype=np.int64))
+
+        if len(regions) == 0:
+            pixels_rows, pixels_cols, regions = [[np.zeros(0, dtype=np.int64)]] * 3
+        # the regions are already sorted, but the starts of the empty regions must be dropped for np.ufunc.reduceat
+        region_ids, starts = np.unique(np.concatenate(regions), return_index=True)
+        return ZonalLabels(np.concatenate(pixels_rows), np.concatenate(pixels_cols), starts, region_ids)
+
+    @staticmethod
+    def reduce(members: list, buckets: np.ndarray, n_buckets: int, n_regions: int, labels: Dict[tuple, ZonalLabels]):
+        """
+        Compute the count, sum, min and max of every region in every bucket of time. The pixels of the regions in a
+        batch of rasters are gathered into a (rasters x pixels) array, which is reduced per region with np.ufunc.reduceat
+        """
+        count = np.zeros((n_buckets, n_regions), dtype=np.int64)
+        total = np.zeros((n_buckets, n_regions), dtype=np.float64)
+        minimum = np.full((n_buckets, n_regions), np.inf)
+        maximum = np.full((n_buckets, n_regions), -np.inf)
+
+        grids = OrderedDict()
+        for (grid, r), bucket in zip(members, buckets):
+            grids.setdefault(grid, []).append((r["raster"], bucket))
+
+        for grid, grid_members in grids.items():
+            label = labels[grid]
+            if len(label.rows) == 0:
+                continue
+            batch_size = max(ZonalStatisticsFunc.MAX_BATCH_SIZE // (label.rows.size * 8), 1)
+            for i in range(0, len(grid_members), batch_size):
+                batch = grid_members[i:i + batch_size]
+                values = np.stack([raster.data[label.rows, label.cols] for raster, _ in batch]).astype(np.float64)
+                valid = ~np.isnan(values)
+                nodata = [raster.nodata for raster, _ in batch]
+                if any(x is not None for x in nodata):
+                    nodata = np.asarray([np.nan if x is None else x for x in nodata], dtype=np.float64)
+                    valid &= values != nodata[:, None]
+                batch_buckets = np.asarray([bucket for _, bucket in batch])
+
+                # reductions of the batch: (rasters x regions having pixels)
+                b_count = np.add.reduceat(valid, label.starts, axis=1, dtype=np.int64)
+                b_total = np.add.reduceat(np.where(valid, values, 0), label.starts, axis=1)
+                b_min = np.minimum.reduceat(np.where(valid, values, np.inf), label.starts, axis=1)
+                b_max = np.maximum.reduceat(np.where(valid, values, -np.inf), label.starts, axis=1)
+
+                # fold the rasters of the batch into their buckets
+                idx = (batch_buckets[:, None], label.regions[None, :])
+                np.add.at(count, idx, b_count)
+                np.add.at(total, idx, b_total)
+                np.minimum.at(minimum, idx, b_min)
+                np.maximum.at(maximum, idx, b_max)
+
+        return {"count": count, "sum": total, "min": minimum, "max": maximum}
+
+    @staticmethod
+    def finalize(stats: dict, function: str, nodata) -> np.ndarray:
+        count = stats["count"]
+        if function == "count":
+            return count
+        if function == "sum":
+            return stats["sum"]
+
+        nodata = np.nan if nodata is None else nodata
+        if function == "average":
+            values = np.full(count.shape, nodata, dtype=np.float64)
+            np.divide(stats["sum"], count, out=values, where=count > 0)
+        else:
+            values = stats[function].copy()
+            values[count == 0] = nodata
+        return values
+
+    @staticmethod
+    def to_dataset(variable_name: str, values: np.ndarray, timestamps: Optional[list], place):
+        place_dict = place.to_dict()
+        model = copy.deepcopy(zonal_model)
+        data = {
+            "variable_name": variable_name,
+            "variable": values,
+            "timestamp": np.asarray(timestamps, dtype=np.float64) if timestamps is not None else None,
+            "place_uri": f"https://mint.isi.edu/place_uri?{urlencode(sorted(place_dict.items()))}",
+        }
+        if timestamps is None:
+            model["attributes"].pop("timestamp")
+            model["alignments"].pop(0)
+            model["semantic_model"]["mint:Variable:1"]["properties"].remove(("mint:timestamp", "timestamp"))
+            data.pop("timestamp")
+
+        for pp in ['region', 'zone', 'district']:
+            if f"mint:{pp}" in place_dict:
+                model["attributes"][f"place_{pp}"] = f"$.place_{pp}"
+                model["alignments"].append(
+                    {"type": "dimension", "source": "variable", "target": f"place_{pp}", "aligned_dims": []})
+                model["semantic_model"]["mint:Place:1"]["properties"].insert(-1, (f"mint:{pp}", f"place_{pp}"))
+                data[f"place_{pp}"] = place.s(f"mint:{pp}")
+
+        return DRepr.parse(model), data
+
+    def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
+        return metadata
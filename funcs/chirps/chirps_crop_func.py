@@ -2,11 +2,11 @@
 This script downloads CHIRPS global daily dataset and register with dcat
 """
 import os
-import urllib
 import datetime
 import xarray
 
 from dtran.argtype import ArgType
+from dtran.dcat.store import ContentStore
 from dtran.ifunc import IFunc, IFuncType
 
 
@@ -62,7 +62,7 @@ class CHIRPSCropFunc(IFunc):
             chirps_fn = os.path.join(CHIRPS_DOWNLOAD_DIR, url.split("/")[-1])
             if not os.path.exists(chirps_fn):
                 print(f"Downloading {url} to {chirps_fn}...")
-                urllib.request.urlretrieve(url, chirps_fn)
+                ContentStore.get_instance().fetch(url, chirps_fn)
             else:
                 print(f"{chirps_fn} is already downloaded...")
             fns.append(chirps_fn)
@@ -1,6 +1,7 @@
 import argparse
 import subprocess
 from dtran.dcat.api import DCatAPI
+from dtran.dcat.store import ContentStore
 from funcs.readers.dcat_read_func import DATA_CATALOG_DOWNLOAD_DIR
 import os
 import shutil
@@ -346,7 +347,7 @@ def gldas2cycles(
                 Path(nc_path).mkdir(parents=True, exist_ok=True)
             if not os.path.exists(ofile):
                 logging.debug(ofile)
-                subprocess.check_call(f"wget -q \"{resource['resource_data_url']}\" -O {ofile}", shell=True, close_fds=False)
+                ContentStore.get_instance().fetch(resource['resource_data_url'], ofile)
             if os.path.exists(ofile):
                 gldas_files.append(ofile)
 
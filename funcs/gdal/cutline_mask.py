@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from funcs.gdal.raster import Raster, GeoTransform
+
+# directory to persist the rasterized masks across runs (disabled if empty), and number of masks kept in memory
+CROPPING_MASK_CACHE_DIR = os.environ.get("CROPPING_MASK_CACHE_DIR", "")
+CROPPING_MASK_CACHE_SIZE = int(os.environ.get("CROPPING_MASK_CACHE_SIZE", "1024"))
+# guards the creation of the cache, as the cropping adapters run concurrently in the threads of the pipeline
+INSTANCE_LOCK = threading.Lock()
+
+
+@dataclass
+class CutlineMask:
+    """
+    Pixels of a grid covered by a polygon: the window of the polygon in the grid (which may go past the grid) and
+    the mask of the pixels of the window touching the polygon
+    """
+    row_offset: int
+    col_offset: int
+    mask: np.ndarray
+    geotransform: GeoTransform
+
+    def apply(self, raster: Raster) -> Raster:
+        """
+        Crop a raster of the grid to the polygon, which gives the same result as gdal.Warp with the polygon as cutline
+        """
+        fill = raster.nodata if raster.nodata is not None else 0
+        n_rows, n_cols = self.mask.shape
+        height, width = raster.data.shape[-2:]
+        data = np.full(raster.data.shape[:-2] + (n_rows, n_cols), fill, dtype=raster.data.dtype)
+        r0, r1 = max(self.row_offset, 0), min(self.row_offset + n_rows, height)
+        c0, c1 = max(self.col_offset, 0), min(self.col_offset + n_cols, width)
+        if r0 < r1 and c0 < c1:
+            data[..., r0 - self.row_offset:r1 - self.row_offset, c0 - self.col_offset:c1 - self.col_offset] = \
+                raster.data[..., r0:r1, c0:c1]
+        data[..., ~self.mask] = fill
+        return Raster(data, self.geotransform, raster.epsg, raster.nodata)
+
+
+class CutlineMaskCache:
+    """
+    Cache of the masks of polygons rasterized on the grids of the cropped rasters, keyed by (polygon, grid). The masks
+    are kept in memory with a LRU bound and optionally saved as .npy files in CROPPING_MASK_CACHE_DIR, so cropping
+    the same regions again is a slice and a mask of the arrays without any rasterization.
+    """
+    instance = None
+
+    def __init__(self, cache_dir: str = None, max_size: int = 1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.masks = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir:
+            Path(cache_dir).mkdir(exist_ok=True, parents=True)
+
+    @staticmethod
+    def get_instance():
+        if CutlineMaskCache.instance is None:
+            with INSTANCE_LOCK:
+                if CutlineMaskCache.instance is None:
+                    CutlineMaskCache.instance = CutlineMaskCache(CROPPING_MASK_CACHE_DIR or None,
+                                                                 CROPPING_MASK_CACHE_SIZE)
+        return CutlineMaskCache.instance
+
+    @staticmethod
+    def digest(wkt: str) -> str:
+        return hashlib.sha1(wkt.encode("utf-8")).hexdigest()
+
+    def get(self, wkt: str, epsg: int, raster: Raster, all_touched: bool = True,
+            wkt_digest: str = None, same_as_warp: bool = True) -> Optional[CutlineMask]:
+        """
+        Get the mask of a polygon on the grid of a raster. None is returned when cropping the raster with the mask
+        would not give the same result as gdal.Warp (i.e., when reprojection or resampling is needed)
+
+        :param wkt_digest: digest of wkt, to avoid hashing the polygon for every raster of the same grid
+        :param same_as_warp: if False, the mask is also returned when gdal.Warp would realign the pixels of the raster,
+            which is enough to select the pixels of the raster in the polygon (e.g., for zonal statistics)
+        """
+        gt = raster.geotransform
+        if int(epsg) != int(raster.epsg) or gt.x_slope != 0 or gt.y_slope != 0 or gt.dx <= 0 or gt.dy >= 0:
+            return None
+        # the pixels of the cropped raster are aligned to multiples of the resolution (targetAlignedPixels), they are
+        # the pixels of the source raster only if its origin is aligned too
+        if same_as_warp and not (CutlineMaskCache.is_aligned(gt.x_0 / gt.dx)
+                                 and CutlineMaskCache.is_aligned(gt.y_0 / gt.dy)):
+            return None
+
+        wkt_digest = wkt_digest or CutlineMaskCache.digest(wkt)
+        key = hashlib.sha1(repr((wkt_digest, gt.to_gdal(), raster.data.shape[-2:], all_touched)).encode("utf-8")) \
+            .hexdigest()
+        with self.lock:
+            if key in self.masks:
+                self.masks.move_to_end(key)
+                return self.masks[key]
+
+        window = CutlineMaskCache.get_window(wkt, gt)
+        mask = None
+        cache_file = os.path.join(self.cache_dir, key + ".npy") if self.cache_dir else None
+        if cache_file is not None and os.path.exists(cache_file):
+            mask = np.load(cache_file)
+        if mask is None or mask.shape != window[2:]:
+            mask = CutlineMaskCache.rasterize(wkt, epsg, window, gt, all_touched)
+            if cache_file is not None:
+                tmp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.npy"
+                np.save(tmp_file, mask)
+                os.replace(tmp_file, cache_file)
+
+        row_offset, col_offset, n_rows, n_cols = window
+        cutline_mask = CutlineMask(row_offset, col_offset, mask, GeoTransform(
+            x_0=gt.x_0 + col_offset * gt.dx, y_0=gt.y_0 + row_offset * gt.dy, dx=gt.dx, dy=gt.dy))
+        with self.lock:
+            self.masks[key] = cutline_mask
+            while len(self.masks) > self.max_size:
+                self.masks.popitem(last=False)
+        return cutline_mask
+
+    @staticmethod
+    def is_aligned(x: float, tolerance: float = 1e-6) -> bool:
+        return abs(x - round(x)) <= tolerance
+
+    @staticmethod
+    def get_window(wkt: str, gt: GeoTransform):
+        """
+        Get the window (row offset, column offset, number of rows, number of columns) of the polygon's envelope
+        expanded to the pixels of the grid. When the origin of the grid is aligned to the resolution, these are the
+        pixels gdal.Warp uses with cropToCutline and targetAlignedPixels
+        """
+        min_x, max_x, min_y, max_y = ogr.CreateGeometryFromWkt(wkt).GetEnvelope()
+        dx, dy = gt.dx, abs(gt.dy)
+        col_min, col_max = math.floor((min_x - gt.x_0) / dx), math.ceil((max_x - gt.x_0) / dx)
+        row_min, row_max = math.floor((gt.y_0 - max_y) / dy), math.ceil((gt.y_0 - min_y) / dy)
+        return row_min, col_min, max(row_max - row_min, 1), max(col_max - col_min, 1)
+
+    @staticmethod
+    def rasterize(wkt: str, epsg: int, window, gt: GeoTransform, all_touched: bool) -> np.ndarray:
+        row_offset, col_offset, n_rows, n_cols = window
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(int(epsg))
+
+        ds = gdal.GetDriverByName("MEM").Create("", n_cols, n_rows, 1, gdal.GDT_Byte)
+        ds.SetGeoTransform((gt.x_0 + col_offset * gt.dx, gt.dx, 0, gt.y_0 + row_offset * gt.dy, 0, gt.dy))
+        ds.SetSpatialRef(srs)
+        vector_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = vector_ds.CreateLayer("cutline", srs)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+        gdal.RasterizeLayer(ds, [1], layer, burn_values=[1], options=["ALL_TOUCHED=TRUE"] if all_touched else [])
+        return ds.ReadAsArray().astype(bool)
@@ -2,12 +2,13 @@
 # -*- coding: utf-8 -*-
 import datetime
 import os
+from collections import OrderedDict
 from uuid import uuid4
 
 import numpy as np
 from pathlib import Path
 from osgeo import gdal, osr, gdal_array
-from typing import Tuple, Union
+from typing import Tuple, Union, List, Optional
 from enum import Enum, IntEnum
 from dataclasses import dataclass, astuple
 from netCDF4 import Dataset
@@ -58,6 +59,9 @@ class ReSample(Enum):
 
 
 class Raster:
+    # maximum number of bytes of the rasters stacked into a single dataset by crop_many
+    MAX_BATCH_SIZE = 1 << 28
+
     def __init__(self,
                  array: np.ndarray,
                  geotransform: GeoTransform,
@@ -118,6 +122,13 @@ class Raster:
         """
         @param x_res, y_res None will use original resolution
         """
+        if vector_file is None and bounds is not None:
+            window = self.get_pixel_window(bounds, x_res, y_res)
+            if window is not None:
+                # the bounds are aligned with the grid, so the cropped raster is a view of the array without warping
+                rows, cols, geotransform = window
+                return Raster(self.data[..., rows, cols], geotransform, self.epsg, self.nodata)
+
         tmp_file = f"/vsimem/{str(uuid4())}.tif"
         warp_options = {'format': 'GTiff'}
         if vector_file is not None:
@@ -147,8 +158,126 @@ class Raster:
 
         return Raster(cropped_array, cropped_geotransform, self.epsg, self.nodata)
 
-    def to_geotiff(self, outfile: str):
-        driver = gdal.GetDriverByName("GTiff")
+    def get_pixel_window(self,
+                         bounds: BoundingBox,
+                         x_res: float = None,
+                         y_res: float = None,
+                         tolerance: float = 1e-6) -> Optional[Tuple[slice, slice, GeoTransform]]:
+        """
+        Get the rows, columns and geotransform of the pixels inside the bounds if cropping to the bounds is a pure
+        slice of the array: the resolution is unchanged, the raster is not rotated, and the bounds are aligned with the
+        pixels (up to tolerance pixel) and inside the raster. Otherwise, None is returned as warping is needed.
+        """
+        gt = self.geotransform
+        if gt.x_slope != 0 or gt.y_slope != 0 or gt.dx <= 0 or gt.dy >= 0:
+            return None
+        if (x_res is not None and abs(abs(x_res) - gt.dx) > tolerance * gt.dx) or \
+                (y_res is not None and abs(abs(y_res) - abs(gt.dy)) > tolerance * abs(gt.dy)):
+            return None
+
+        col_offset = (bounds.x_min - gt.x_0) / gt.dx
+        row_offset = (bounds.y_max - gt.y_0) / gt.dy
+        if abs(col_offset - round(col_offset)) > tolerance or abs(row_offset - round(row_offset)) > tolerance:
+            return None
+        # same rounding of the output size as gdal.Warp
+        n_cols = int((bounds.x_max - bounds.x_min) / gt.dx + 0.5)
+        n_rows = int((bounds.y_max - bounds.y_min) / abs(gt.dy) + 0.5)
+        col_offset, row_offset = int(round(col_offset)), int(round(row_offset))
+        height, width = self.data.shape[-2:]
+        if n_cols <= 0 or n_rows <= 0 or col_offset < 0 or row_offset < 0 or \
+                col_offset + n_cols > width or row_offset + n_rows > height:
+            return None
+
+        geotransform = GeoTransform(x_0=bounds.x_min, y_0=bounds.y_max, dx=gt.dx, dy=gt.dy)
+        return slice(row_offset, row_offset + n_rows), slice(col_offset, col_offset + n_cols), geotransform
+
+    @staticmethod
+    def crop_many(rasters: List['Raster'],
+                  bounds: BoundingBox = None,
+                  vector_file: Union[Path, str] = None,
+                  use_vector_bounds: bool = True,
+                  x_res: float = None,
+                  y_res: float = None,
+                  resampling_algo: ReSample = None,
+                  touch_cutline: bool = False,
+                  max_batch_size: int = None) -> List[Optional['Raster']]:
+        """
+        Crop many rasters (e.g., the timesteps of a variable) to the same region. Rasters on the same grid (geotransform,
+        epsg, no data, shape and type) are stacked as the bands of one in-memory dataset and warped together, so the
+        pixel window and the cutline mask are computed once for the whole stack instead of once per raster.
+
+        @param max_batch_size maximum number of bytes stacked into a single dataset (default to MAX_BATCH_SIZE)
+        @return the cropped rasters in the same order, None for the rasters which do not overlap the region
+        """
+        crop_args = dict(bounds=bounds, vector_file=vector_file, use_vector_bounds=use_vector_bounds, x_res=x_res,
+                         y_res=y_res, resampling_algo=resampling_algo, touch_cutline=touch_cutline)
+        max_batch_size = max_batch_size or Raster.MAX_BATCH_SIZE
+        results = [None] * len(rasters)
+        grids = OrderedDict()
+        for i, raster in enumerate(rasters):
+            if len(raster.data.shape) != 2:
+                results[i] = raster.crop(**crop_args)
+                continue
+            grid = (raster.geotransform.to_gdal(), int(raster.epsg), str(raster.nodata), raster.data.shape,
+                    raster.data.dtype.str)
+            grids.setdefault(grid, []).append(i)
+
+        for indices in grids.values():
+            first = rasters[indices[0]]
+            if vector_file is None and bounds is not None and first.get_pixel_window(bounds, x_res, y_res) is not None:
+                # slicing each raster is cheaper than stacking them
+                for i in indices:
+                    results[i] = rasters[i].crop(**crop_args)
+                continue
+            n_bands = max(1, max_batch_size // max(first.data.nbytes, 1))
+            for start in range(0, len(indices), n_bands):
+                batch = indices[start:start + n_bands]
+                if len(batch) == 1:
+                    results[batch[0]] = rasters[batch[0]].crop(**crop_args)
+                    continue
+                stack = Raster(np.stack([rasters[i].data for i in batch]), first.geotransform, first.epsg,
+                               first.nodata)
+                cropped = stack.crop(**crop_args)
+                if cropped is None:
+                    continue
+                for band, i in enumerate(batch):
+                    results[i] = Raster(cropped.data[band], cropped.geotransform, first.epsg, first.nodata)
+        return results
+
+    def to_geotiff(self, outfile: str, compress: str = None, cog: bool = False, band_names: List[str] = None):
+        """
+        @param compress compression of the file (e.g., DEFLATE, ZSTD, LZW), the file is tiled and uses a predictor
+            when it is compressed. None writes an uncompressed striped file
+        @param cog write a cloud optimized geotiff (tiled, compressed with DEFLATE by default, and with overviews)
+        @param band_names descriptions of the bands (e.g., the timestamps of the bands of a stack)
+        """
+        if not cog:
+            options = []
+            if compress is not None:
+                options = ["TILED=YES", f"COMPRESS={compress.upper()}", f"PREDICTOR={self.get_predictor()}"]
+            outdata = self.to_gdal_dataset(gdal.GetDriverByName("GTiff"), outfile, options, band_names)
+            outdata.FlushCache()
+            return
+
+        # cloud optimized geotiffs are copied from a dataset in memory, as their overviews come before the data
+        outdata = self.to_gdal_dataset(gdal.GetDriverByName("MEM"), "", [], band_names)
+        compress = (compress or "DEFLATE").upper()
+        driver = gdal.GetDriverByName("COG")
+        if driver is not None:
+            options = ["BLOCKSIZE=256", f"COMPRESS={compress}", "PREDICTOR=YES", "OVERVIEWS=AUTO"]
+        else:
+            # gdal < 3.1 does not have the COG driver, the overviews are built in memory and copied to the file
+            driver = gdal.GetDriverByName("GTiff")
+            overview_levels = []
+            while max(outdata.RasterXSize, outdata.RasterYSize) // (2 ** (len(overview_levels) + 1)) >= 256:
+                overview_levels.append(2 ** (len(overview_levels) + 1))
+            if len(overview_levels) > 0:
+                outdata.BuildOverviews("AVERAGE", overview_levels)
+            options = ["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256", "COPY_SRC_OVERVIEWS=YES",
+                       f"COMPRESS={compress}", f"PREDICTOR={self.get_predictor()}"]
+        driver.CreateCopy(outfile, outdata, options=options).FlushCache()
+
+    def to_gdal_dataset(self, driver, outfile: str, options: List[str], band_names: List[str] = None):
         if len(self.data.shape) == 2:
             data = self.data.reshape((1, *self.data.shape))
         elif len(self.data.shape) == 3:
@@ -157,14 +286,20 @@ class Raster:
             raise Exception("Does not support writing non 2 or 3 dims array to geotiff file")
 
         bands, rows, cols = data.shape
-        outdata = driver.Create(outfile, cols, rows, bands, self.dtype_np2gdal(data.dtype))
+        outdata = driver.Create(outfile, cols, rows, bands, self.dtype_np2gdal(data.dtype), options=options)
         outdata.SetGeoTransform(self.raster.GetGeoTransform())
         outdata.SetProjection(self.raster.GetProjection())
         for band in range(bands):
             outdata.GetRasterBand(band + 1).WriteArray(data[band])
             if self.nodata is not None:
                 outdata.GetRasterBand(band + 1).SetNoDataValue(float(self.nodata))
-        outdata.FlushCache()
+            if band_names is not None:
+                outdata.GetRasterBand(band + 1).SetDescription(band_names[band])
+        return outdata
+
+    def get_predictor(self) -> int:
+        # floating point predictor for float rasters, horizontal differencing for integer rasters
+        return 3 if np.issubdtype(self.data.dtype, np.floating) else 2
 
     def serialize(self, outfile: str):
         np.savez_compressed(outfile,
@@ -10,11 +10,12 @@ from typing import Optional, Dict
 
 from dtran.argtype import ArgType
 from dtran.backend import ShardedBackend
-from dtran.ifunc import IFunc, IFuncType
+from dtran.ifunc import IFunc, IFuncType, IFuncExecMode
 from dtran.metadata import Metadata
 from drepr import outputs
 from drepr.executors.readers.reader_container import ReaderContainer
 from funcs.gdal.raster import Raster, GeoTransform, BoundingBox, ReSample
+from funcs.gdal.cutline_mask import CutlineMaskCache
 from funcs.gdal.raster_to_dataset import raster_to_dataset
 
 
@@ -38,6 +39,8 @@ class CroppingTransFunc(IFunc):
 
     func_type = IFuncType.CROPPING_TRANS
     friendly_name: str = "Cropping function"
+    # gdal.Warp releases the GIL, so cropping runs in the thread pool of the pipeline
+    exec_mode = IFuncExecMode.THREAD
     example = {
         "variable_name": "",
         "xmin": "",
@@ -65,6 +68,14 @@ class CroppingTransFunc(IFunc):
             if isinstance(self.shape_sm, str):
                 self.use_temp = False
 
+    @staticmethod
+    def shape_array_to_wkt(data) -> str:
+        if isinstance(data['polygon'][0][0][0], (int, float)):
+            shape_type = "Polygon"
+        else:
+            shape_type = "MultiPolygon"
+        return shape({"type": shape_type, "coordinates": data['polygon']}).wkt
+
     @staticmethod
     def shape_array_to_shapefile(data, fname):
         driver = ogr.GetDriverByName("ESRI Shapefile")
@@ -72,15 +83,13 @@ class CroppingTransFunc(IFunc):
         srs = osr.SpatialReference()
         srs.ImportFromEPSG(data['epsg'])
         if isinstance(data['polygon'][0][0][0], (int, float)):
-            shape_type = "Polygon"
             layer = ds.CreateLayer("TempCroppingPolygon", srs, ogr.wkbPolygon)
         else:
-            shape_type = "MultiPolygon"
             layer = ds.CreateLayer("TempCroppingPolygon", srs, ogr.wkbMultiPolygon)
         field = ogr.FieldDefn("name", ogr.OFTString)
         layer.CreateField(field)
         feature = ogr.Feature(layer.GetLayerDefn())
-        feature.SetGeometry(ogr.CreateGeometryFromWkt(shape({"type": shape_type, "coordinates": data['polygon']}).wkt))
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(CroppingTransFunc.shape_array_to_wkt(data)))
         feature.SetField("name", "TempCroppingPolygon")
         layer.CreateFeature(feature)
         ds = None
@@ -155,8 +164,9 @@ class CroppingTransFunc(IFunc):
         bb = BoundingBox(x_min=self.xmin, y_min=self.ymin, x_max=self.xmax, y_max=self.ymax)
 
         results = []
-        for r in self.rasters:
-            cropped_raster = r["raster"].crop(bounds=bb, resampling_algo=ReSample.BILINEAR)
+        cropped_rasters = Raster.crop_many([r["raster"] for r in self.rasters], bounds=bb,
+                                           resampling_algo=ReSample.BILINEAR)
+        for r, cropped_raster in zip(self.rasters, cropped_rasters):
             if cropped_raster is None:
                 continue
             results.append(raster_to_dataset(cropped_raster, r["variable_name"], timestamp=r["timestamp"], region_label=self.region_label))
@@ -170,20 +180,40 @@ class CroppingTransFunc(IFunc):
         self.rasters = CroppingTransFunc.extract_raster(self.dataset, self.variable_name)
         self.shapes = CroppingTransFunc.extract_shape(self.shape_sm)
 
+        mask_cache = CutlineMaskCache.get_instance()
         results = []
         for shape in self.shapes:
-            tempfile_name = f"/tmp/{uuid.uuid4()}.shp"
-            CroppingTransFunc.shape_array_to_shapefile(shape, tempfile_name)
-            for r in self.rasters:
-                cropped_raster = r["raster"].crop(
-                    vector_file=tempfile_name, resampling_algo=ReSample.BILINEAR, touch_cutline=True
+            wkt = CroppingTransFunc.shape_array_to_wkt(shape)
+            wkt_digest = CutlineMaskCache.digest(wkt)
+            # cropping with the cached mask of the shape on the grid of each raster, or warping when it's not possible
+            cropped_rasters = []
+            warped_indices = []
+            for i, r in enumerate(self.rasters):
+                mask = mask_cache.get(wkt, shape['epsg'], r["raster"], all_touched=True, wkt_digest=wkt_digest)
+                if mask is None:
+                    warped_indices.append(i)
+                    cropped_rasters.append(None)
+                else:
+                    cropped_rasters.append(mask.apply(r["raster"]))
+
+            if len(warped_indices) > 0:
+                tempfile_name = f"/tmp/{uuid.uuid4()}.shp"
+                CroppingTransFunc.shape_array_to_shapefile(shape, tempfile_name)
+                # a single warp per shape for all rasters on the same grid
+                warped_rasters = Raster.crop_many(
+                    [self.rasters[i]["raster"] for i in warped_indices], vector_file=tempfile_name,
+                    resampling_algo=ReSample.BILINEAR, touch_cutline=True
                 )
+                for i, cropped_raster in zip(warped_indices, warped_rasters):
+                    cropped_rasters[i] = cropped_raster
+                for f in glob.glob(f"{tempfile_name[:-4]}*"):
+                    os.remove(f)
+
+            for r, cropped_raster in zip(self.rasters, cropped_rasters):
                 if cropped_raster is None:
                     continue
                 place = shape['place']
                 results.append(raster_to_dataset(cropped_raster, r["variable_name"], place=place, timestamp=r["timestamp"]))
-            for f in glob.glob(f"{tempfile_name[:-4]}*"):
-                os.remove(f)
         assert len(results) > 0, "No overlapping data for the given region"
         self.results = ShardedBackend(len(results))
         for result, temp_file in results:
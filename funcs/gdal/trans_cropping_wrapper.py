@@ -1,7 +1,8 @@
 from typing import *
+from asyncio import get_event_loop
 from inspect import signature
 
-from dtran.ifunc import IFunc
+from dtran.ifunc import IFunc, IFuncExecMode
 from dtran.metadata import Metadata
 from funcs import CroppingTransFunc
 
@@ -44,7 +45,11 @@ class CroppingTransWrapper(IFunc):
                     func = self.func_cls(**{**func_args, 'shape': shape, 'variable_name': variable, 'dataset': dataset})
                     func.get_preference = self.get_preference
                     try:
-                        yield func.exec()
+                        if self.func_cls.exec_mode == IFuncExecMode.THREAD:
+                            # running in the thread pool shared by the pipeline
+                            yield await get_event_loop().run_in_executor(self.executor, func.exec)
+                        else:
+                            yield func.exec()
                     except AssertionError as e:
                         print(e)
 
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import asyncio
 from datetime import datetime
 from typing import Union, Generator, AsyncGenerator, Optional, Dict
 from isodate import parse_duration
@@ -8,7 +9,7 @@ from dateutil import parser
 
 from dtran.argtype import ArgType
 from dtran.ifunc import IFunc, IFuncType
-from dtran.dcat.api import DCatAPI
+from dtran.dcat.api import AsyncDCatAPI
 from dtran.metadata import Metadata
 
 
@@ -36,27 +37,51 @@ class DcatRangeStream(IFunc):
     }
 
     def __init__(self, dataset_id: str, start_time: datetime = None, end_time: datetime = None, step_time: str = None):
-        if (start_time is None) or (end_time is None):
-            dataset = DCatAPI.get_instance().find_dataset_by_id(dataset_id)
-            self.start_time = start_time or parser.parse(dataset['metadata']['temporal_coverage']['start_time'])
-            self.end_time = end_time or parser.parse(dataset['metadata']['temporal_coverage']['end_time'])
-        else:
-            self.start_time = start_time
-            self.end_time = end_time
+        self.dataset_id = dataset_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.step_time = None if step_time is None else parse_duration(step_time)
+
+    async def exec(self) -> Union[dict, Generator[dict, None, None], AsyncGenerator[dict, None]]:
+        dcat = AsyncDCatAPI.get_instance(executor=self.executor)
+        if (self.start_time is None) or (self.end_time is None):
+            dataset = await dcat.find_dataset_by_id(self.dataset_id)
+            self.start_time = self.start_time or parser.parse(dataset['metadata']['temporal_coverage']['start_time'])
+            self.end_time = self.end_time or parser.parse(dataset['metadata']['temporal_coverage']['end_time'])
 
         self.start_time = self.start_time.replace(microsecond=0)
         self.end_time = self.end_time.replace(microsecond=0)
-        if step_time is None:
+        if self.step_time is None:
             self.step_time = self.end_time - self.start_time
-        else:
-            self.step_time = parse_duration(step_time)
 
-    async def exec(self) -> Union[dict, Generator[dict, None, None], AsyncGenerator[dict, None]]:
-        start_time = self.start_time
-        while start_time < self.end_time:
-            end_time = min(start_time + self.step_time, self.end_time)
-            yield {"start_time": start_time, "end_time": end_time}
-            start_time = end_time
+        # prefetches which are not finished yet, they are cancelled if the stream is closed before they finish
+        prefetches = set()
+        try:
+            start_time = self.start_time
+            while start_time < self.end_time:
+                end_time = min(start_time + self.step_time, self.end_time)
+                if end_time < self.end_time:
+                    # listing the resources of the next window in the background while the current one is processed,
+                    # the reader of the next window gets them from the catalog client's cache (or waits for this query)
+                    prefetch = asyncio.ensure_future(dcat.find_resources_by_dataset_id(
+                        self.dataset_id, end_time, min(end_time + self.step_time, self.end_time)))
+                    prefetch.add_done_callback(self.check_prefetch)
+                    prefetch.add_done_callback(prefetches.discard)
+                    prefetches.add(prefetch)
+                yield {"start_time": start_time, "end_time": end_time}
+                start_time = end_time
+            # the listing of the last window may still be used by its reader
+            await asyncio.gather(*prefetches, return_exceptions=True)
+        finally:
+            for prefetch in list(prefetches):
+                prefetch.cancel()
+            await asyncio.gather(*prefetches, return_exceptions=True)
+
+    def check_prefetch(self, future: asyncio.Future):
+        # a failed prefetch is not fatal as the reader of the window sends the query again
+        if not future.cancelled() and future.exception() is not None:
+            AsyncDCatAPI.get_instance().api.logger.warning(
+                f"Cannot prefetch resources of dataset {self.dataset_id}: {future.exception()}")
 
     def validate(self) -> bool:
         return True
@@ -1,50 +1,54 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import fcntl
 import logging
 import os
 import shutil
 import subprocess
-import time
-import requests
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Union, Dict
+from typing import Union, Dict, Tuple
 from functools import partial
 from playhouse.kv import KeyValue
-from peewee import SqliteDatabase, Model, UUIDField, IntegerField, BooleanField, BigIntegerField, DoesNotExist
+from playhouse.migrate import SqliteMigrator, migrate
+from peewee import SqliteDatabase, Model, UUIDField, IntegerField, BooleanField, BigIntegerField, DateTimeField, \
+    DoesNotExist, fn
 
 from drepr import DRepr
 from drepr.outputs import ArrayBackend, GraphBackend
 from dtran.argtype import ArgType
 from dtran.backend import ShardedBackend, ShardedClassID, LazyLoadBackend
 from dtran.dcat.api import DCatAPI
-from dtran.ifunc import IFunc, IFuncType
+from dtran.dcat.store import ContentStore, parse_size
+from dtran.ifunc import IFunc, IFuncType, IFuncExecMode
 
 DATA_CATALOG_DOWNLOAD_DIR = os.path.abspath(os.environ["DATA_CATALOG_DOWNLOAD_DIR"])
-if os.environ['NO_CHECK_CERTIFICATE'].lower().strip() == 'true':
-    DOWNLOAD_CMD = "wget --no-check-certificate"
-else:
-    DOWNLOAD_CMD = "wget"
+# number of resources downloaded concurrently by a process
+DATA_CATALOG_DOWNLOAD_WORKERS = int(os.environ.get("DATA_CATALOG_DOWNLOAD_WORKERS", "8"))
+# maximum size of DATA_CATALOG_DOWNLOAD_DIR, and minimum size to free when it is full (e.g., 200MB, 1.5GB)
+DATA_CATALOG_MAX_CAPACITY = os.environ.get("DATA_CATALOG_MAX_CAPACITY", "200MB")
+DATA_CATALOG_MAX_CLEAR_SIZE = os.environ.get("DATA_CATALOG_MAX_CLEAR_SIZE", "100MB")
+# order in which unreferenced resources are evicted: fifo, lru, lfu or size
+DATA_CATALOG_EVICTION_POLICY = os.environ.get("DATA_CATALOG_EVICTION_POLICY", "lru")
 
 Path(DATA_CATALOG_DOWNLOAD_DIR).mkdir(exist_ok=True, parents=True)
-
-UNITS_MAPPING = {
-    'PB': 1 << 50,
-    'TB': 1 << 40,
-    'GB': 1 << 30,
-    'MB': 1 << 20,
-    'KB': 1 << 10,
-    'B': 1
-}
-
+# lock files used to notify processes/threads waiting for a resource instead of polling the database
+Path(os.path.join(DATA_CATALOG_DOWNLOAD_DIR, '.locks')).mkdir(exist_ok=True, parents=True)
+# guards the creation of the resource manager, as readers may be constructed concurrently in the threads of the pipeline
+INSTANCE_LOCK = threading.Lock()
 
 class Resource(Model):
     resource_id = UUIDField(unique=True)
     ref_count = IntegerField(default=0, index=True)
     is_downloading = BooleanField(default=False)
     size = BigIntegerField(default=0)
+    last_access = DateTimeField(default=datetime.now, index=True)
+    hit_count = IntegerField(default=0)
 
     class Meta:
         database = SqliteDatabase(os.path.join(DATA_CATALOG_DOWNLOAD_DIR, 'dcat_read_func.db'), timeout=10)
@@ -53,14 +57,52 @@ class Resource(Model):
 class ResourceManager:
     instance = None
 
+    # order of evicting unreferenced resources for each eviction policy
+    EVICTION_ORDERS = {
+        # first downloaded, first evicted
+        "fifo": (Resource.id,),
+        # least recently used first
+        "lru": (Resource.last_access, Resource.id),
+        # least frequently used first
+        "lfu": (Resource.hit_count, Resource.last_access, Resource.id),
+        # large and rarely used resources first
+        "size": ((Resource.hit_count + 1) * 1.0 / fn.MAX(Resource.size, 1), Resource.last_access, Resource.id),
+    }
+
     def __init__(self):
-        self.max_capacity = 200 * UNITS_MAPPING['MB']
-        self.max_clear_size = 100 * UNITS_MAPPING['MB']
+        self.max_capacity = parse_size(DATA_CATALOG_MAX_CAPACITY)
+        self.max_clear_size = parse_size(DATA_CATALOG_MAX_CLEAR_SIZE)
         assert self.max_capacity >= self.max_clear_size, "max_capacity cannot be less than max_clear_size"
+        assert DATA_CATALOG_EVICTION_POLICY in self.EVICTION_ORDERS, \
+            f"Invalid eviction policy {DATA_CATALOG_EVICTION_POLICY}. Expected one of {list(self.EVICTION_ORDERS)}"
+        self.eviction_policy = DATA_CATALOG_EVICTION_POLICY
+        # only used as a fallback when waiting for resources referenced by other processes
         self.poll_interval = 10
         self.compressed_resource_types = {".zip", ".tar.gz", ".tar"}
+        self.max_workers = DATA_CATALOG_DOWNLOAD_WORKERS
+        # pool of download workers
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dcat_download")
+        # resources are fetched through the content-addressed store (possibly shared with other nodes) and hard-linked
+        # into DATA_CATALOG_DOWNLOAD_DIR, which only holds the views of this host
+        self.store = ContentStore.get_instance()
+        # notified whenever a resource is unlinked by this process
+        self.unlinked = threading.Condition()
         self.db = Resource._meta.database
         self.db.connect()
+        if self.db.table_exists(Resource._meta.table_name):
+            # adding the access tracking columns to databases created by previous versions, before their indices
+            # are created. The new columns are nullable as sqlite cannot add a not null column to an existing table
+            columns = {column.name for column in self.db.get_columns(Resource._meta.table_name)}
+            migrator = SqliteMigrator(self.db)
+            operations = [
+                migrator.add_column(Resource._meta.table_name, name, field)
+                for name, field in [('last_access', DateTimeField(null=True, default=datetime.now)),
+                                    ('hit_count', IntegerField(null=True, default=0))]
+                if name not in columns
+            ]
+            if len(operations) > 0:
+                migrate(*operations)
+                Resource.update(last_access=datetime.now(), hit_count=0).execute()
         self.db.create_tables([Resource], safe=True)
         self.db.close()
         self.kv = KeyValue(database=self.db, value_field=BigIntegerField())
@@ -82,9 +124,36 @@ class ResourceManager:
     @staticmethod
     def get_instance():
         if ResourceManager.instance is None:
-            ResourceManager.instance = ResourceManager()
+            with INSTANCE_LOCK:
+                if ResourceManager.instance is None:
+                    ResourceManager.instance = ResourceManager()
         return ResourceManager.instance
 
+    @contextmanager
+    def lock(self, resource_id: str):
+        """
+        Exclusive lock of a resource shared by all processes/threads. It is held while deciding whether to download a
+        resource and during its download, so waiters are woken up by the kernel once the resource is ready. The lock is
+        released automatically if the process holding it dies
+        """
+        with open(os.path.join(DATA_CATALOG_DOWNLOAD_DIR, '.locks', resource_id + '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def download_all(self, resources: Dict[str, Dict[str, str]], should_redownload: bool) -> Dict[str, str]:
+        """
+        Download resources concurrently using the pool of download workers. Returns the path of each resource in the
+        same order as the given resources
+        """
+        futures = OrderedDict(
+            (resource_id, self.executor.submit(self.download, resource_id, resource_metadata, should_redownload))
+            for resource_id, resource_metadata in resources.items()
+        )
+        return OrderedDict((resource_id, future.result()) for resource_id, future in futures.items())
+
     def download(self, resource_id: str, resource_metadata: Dict[str, str], should_redownload: bool) -> str:
         is_compressed = resource_metadata['resource_type'] in self.compressed_resource_types
         if is_compressed:
@@ -94,64 +163,82 @@ class ResourceManager:
         else:
             path = os.path.join(DATA_CATALOG_DOWNLOAD_DIR, resource_id + '.dat')
 
-        download = True
-        with self.db.atomic('EXCLUSIVE'):
-            try:
-                # if resource already exists
-                resource = Resource.select().where(Resource.resource_id == resource_id).get()
-                resource.ref_count += 1
-                if not should_redownload:
-                    # TODO: comparing timestamp before skipping download
-                    download = False
-            except DoesNotExist:
-                resource = Resource.create(resource_id=resource_id, ref_count=1, is_downloading=True, size=0)
-
-            if download:
-                required_size = 0
-                if resource.ref_count > 1:
-                    # adjust required_size when the resource is to be redownloaded
-                    required_size -= resource.size
+        with self.lock(resource_id):
+            download = True
+            is_redownload = False
+            with self.db.atomic('EXCLUSIVE'):
                 try:
-                    resource.size = int(requests.head(resource_metadata['resource_data_url']).headers['Content-Length'])
-                    required_size += resource.size
-                except KeyError:
-                    pass
-                if self.max_capacity - self.kv['current_size'] < required_size:
-                    # clear files to make space
-                    self.kv['current_size'] -= self.clear()
-                    assert self.max_capacity - self.kv['current_size'] >= required_size, "Not enough disk space"
-                self.kv['current_size'] += required_size
-            resource.save()
-
-        if download:
-            if resource.ref_count > 1:
-                # block until all other processes accessing the resource are finished
+                    # if resource already exists
+                    resource = Resource.select().where(Resource.resource_id == resource_id).get()
+                    resource.ref_count += 1
+                    resource.last_access = datetime.now()
+                    # a resource which is still marked as downloading while we hold its lock has been left behind by
+                    # a process that died, so its download is resumed
+                    if not resource.is_downloading:
+                        if should_redownload:
+                            is_redownload = True
+                        else:
+                            # TODO: comparing timestamp before skipping download
+                            download = False
+                            resource.hit_count += 1
+                except DoesNotExist:
+                    resource = Resource.create(resource_id=resource_id, ref_count=1, is_downloading=True, size=0)
+                resource.save()
+                self.increment_counter('cache_hits' if not download else 'cache_misses')
+
+            if not download:
+                DcatReadFunc.logger.debug(f"Skipping resource {resource_id}, found in cache")
+                return self.path(resource_id, path, is_compressed)
+
+            # querying the version and size of the resource outside of the transaction, so other processes are not
+            # blocked. The server is only queried if the store does not have the resource or for a redownload, which
+            # only fetches the resource again if it has changed on the server
+            head = None if is_redownload else self.store.cached_head(resource_metadata['resource_data_url'])
+            if head is None:
+                head = self.store.head(resource_metadata['resource_data_url'])
+            new_size = head[1]
+
+            if is_redownload and resource.ref_count > 1:
+                # block until all other processes/threads accessing the resource are finished
                 DcatReadFunc.logger.debug(f"Waiting for some other process/thread to free resource {resource_id} ...")
-                while resource.ref_count > 1:
-                    time.sleep(self.poll_interval)
+                while True:
                     with self.db.atomic('EXCLUSIVE'):
                         resource = Resource.select().where(Resource.resource_id == resource_id).get()
                         if resource.ref_count == 1:
                             # setting is_downloading before redownload
                             resource.is_downloading = True
                             resource.save()
-                # clear old resource before redownload
-                if is_compressed:
-                    shutil.rmtree(str(path))
-                else:
-                    Path(path).unlink()
+                            break
+                    with self.unlinked:
+                        # other processes do not notify us, so we still need to check again after a while
+                        self.unlinked.wait(timeout=self.poll_interval)
+
+            with self.db.atomic('EXCLUSIVE'):
+                resource = Resource.select().where(Resource.resource_id == resource_id).get()
+                required_size = 0 if new_size is None else new_size - resource.size
+                if self.max_capacity - self.kv['current_size'] < required_size:
+                    # clear files to make space
+                    self.kv['current_size'] -= self.clear()
+                    assert self.max_capacity - self.kv['current_size'] >= required_size, "Not enough disk space"
+                self.kv['current_size'] += required_size
+                resource.size += required_size
+                resource.is_downloading = True
+                resource.save()
+
+            # clear old resource before redownload
+            if is_compressed and Path(path).exists():
+                shutil.rmtree(str(path))
             DcatReadFunc.logger.debug(f"Downloading resource {resource_id} ...")
             if is_compressed:
                 temp_path = path + resource_metadata['resource_type']
-                subprocess.check_call(f"wget -q \"{resource_metadata['resource_data_url']}\" -O {temp_path}", shell=True, close_fds=False)
+                self.store.fetch(resource_metadata['resource_data_url'], temp_path, head)
                 self.uncompress(resource_metadata['resource_type'], path)
                 # adjust required_size when the resource is compressed
                 required_size = -resource.size
                 required_size += sum(f.stat().st_size for f in Path(path).rglob('*')) + Path(path).stat().st_size
                 Path(temp_path).unlink()
             else:
-                subprocess.check_call(f"wget -q \"{resource_metadata['resource_data_url']}\" -O {path}", shell=True, close_fds=False)
-                required_size = 0
+                required_size = self.store.fetch(resource_metadata['resource_data_url'], path, head) - resource.size
 
             with self.db.atomic('EXCLUSIVE'):
                 self.kv['current_size'] += required_size
@@ -159,15 +246,6 @@ class ResourceManager:
                 resource.size += required_size
                 resource.is_downloading = False
                 resource.save()
-        else:
-            DcatReadFunc.logger.debug(f"Skipping resource {resource_id}, found in cache")
-            if resource.is_downloading:
-                # block until some other process is done downloading the resource
-                DcatReadFunc.logger.debug(f"Waiting for other process/thread to finish downloading resource {resource_id} ...")
-                while resource.is_downloading:
-                    time.sleep(self.poll_interval)
-                    with self.db.atomic('EXCLUSIVE'):
-                        resource = Resource.select().where(Resource.resource_id == resource_id).get()
 
         return self.path(resource_id, path, is_compressed)
 
@@ -176,10 +254,31 @@ class ResourceManager:
             resource = Resource.select().where(Resource.resource_id == resource_id).get()
             resource.ref_count -= 1
             resource.save()
+        with self.unlinked:
+            self.unlinked.notify_all()
+
+    def increment_counter(self, name: str, value: int = 1):
+        """
+        Increment a cache counter, the caller must be inside a transaction
+        """
+        self.kv[name] = self.kv[name] + value if name in self.kv else value
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        Get the cache counters (shared by all processes using DATA_CATALOG_DOWNLOAD_DIR) and the current usage
+        """
+        with self.db.atomic():
+            stats = {name: self.kv[name] if name in self.kv else 0
+                     for name in ['cache_hits', 'cache_misses', 'cache_evictions', 'cache_evicted_size', 'current_size']}
+            stats['n_resources'] = Resource.select().count()
+            stats['n_referenced_resources'] = Resource.select().where(Resource.ref_count > 0).count()
+        stats['max_capacity'] = self.max_capacity
+        return stats
 
     def clear(self) -> int:
         size = 0
-        for resource in Resource.select().where(Resource.ref_count == 0).order_by(Resource.id):
+        eviction_order = self.EVICTION_ORDERS[self.eviction_policy]
+        for resource in Resource.select().where(Resource.ref_count == 0).order_by(*eviction_order):
             DcatReadFunc.logger.debug(f"Clearing resource {resource.resource_id}")
             path = Path(os.path.join(DATA_CATALOG_DOWNLOAD_DIR, str(resource.resource_id) + '.dat'))
             if path.exists():
@@ -190,8 +289,10 @@ class ResourceManager:
                 size += sum(f.stat().st_size for f in path.rglob('*')) + path.stat().st_size
                 shutil.rmtree(str(path))
             resource.delete_instance()
+            self.increment_counter('cache_evictions')
             if size >= self.max_clear_size:
-                return size
+                break
+        self.increment_counter('cache_evicted_size', size)
         return size
 
     def uncompress(self, resource_type: str, path: Union[Path, str]):
@@ -233,6 +334,8 @@ class DcatReadFunc(IFunc):
     """
     func_type = IFuncType.READER
     friendly_name: str = "Data Catalog Reader"
+    # downloading and parsing resources is mostly I/O, so it runs off the event loop
+    exec_mode = IFuncExecMode.THREAD
     inputs = {
         "dataset_id": ArgType.String,
         "start_time": ArgType.DateTime(optional=True),
@@ -266,35 +369,36 @@ class DcatReadFunc(IFunc):
         self.resource_manager = ResourceManager.get_instance()
         dataset = DCatAPI.get_instance().find_dataset_by_id(dataset_id)
 
-        assert ('resource_repr' in dataset['metadata']) or ('dataset_repr' in dataset['metadata']), \
-            "Dataset is missing both 'resource_repr' and 'dataset_repr'"
-        assert not (('resource_repr' in dataset['metadata']) and ('dataset_repr' in dataset['metadata'])), \
-            "Dataset has both 'resource_repr' and 'dataset_repr'"
+        self.drepr, self.repr_type = DcatReadFunc.parse_drepr(dataset, override_drepr)
+        self.logger.debug(f"Found key '{self.repr_type}'")
 
         resources = DCatAPI.get_instance().find_resources_by_dataset_id(dataset_id, start_time, end_time)
 
         self.resources = OrderedDict()
-        if 'resource_repr' in dataset['metadata']:
-            if override_drepr is not None:
-                self.drepr = DRepr.parse_from_file(override_drepr)
-            else:
-                self.drepr = DRepr.parse(dataset['metadata']['resource_repr'])
+        if self.repr_type == 'resource_repr':
             for resource in resources:
                 self.resources[resource['resource_id']] = {key: resource[key] for key in
                                                            {'resource_data_url', 'resource_type'}}
-            self.repr_type = 'resource_repr'
         else:
             # TODO: fix me!!
             assert len(resources) == 1
             self.resources[resources[0]['resource_id']] = {key: resources[0][key] for key in
                                                            {'resource_data_url', 'resource_type'}}
-            if override_drepr is not None:
-                self.drepr = DRepr.parse_from_file(override_drepr)
-            else:
-                self.drepr = DRepr.parse(dataset['metadata']['dataset_repr'])
-            self.repr_type = 'dataset_repr'
 
-        self.logger.debug(f"Found key '{self.repr_type}'")
+    @staticmethod
+    def parse_drepr(dataset: dict, override_drepr: str = None) -> Tuple[DRepr, str]:
+        """
+        Get the D-REPR model of a dataset and whether it describes every resource ('resource_repr') or the whole
+        dataset ('dataset_repr')
+        """
+        assert ('resource_repr' in dataset['metadata']) or ('dataset_repr' in dataset['metadata']), \
+            "Dataset is missing both 'resource_repr' and 'dataset_repr'"
+        assert not (('resource_repr' in dataset['metadata']) and ('dataset_repr' in dataset['metadata'])), \
+            "Dataset has both 'resource_repr' and 'dataset_repr'"
+        repr_type = 'resource_repr' if 'resource_repr' in dataset['metadata'] else 'dataset_repr'
+        if override_drepr is not None:
+            return DRepr.parse_from_file(override_drepr), repr_type
+        return DRepr.parse(dataset['metadata'][repr_type]), repr_type
 
     def exec(self) -> dict:
         # TODO: fix me! incorrect way to choose backend
@@ -327,10 +431,10 @@ class DcatReadFunc(IFunc):
             else:
                 dataset = ShardedBackend(len(self.resources))
                 data_path = []
-                for resource_id, resource_metadata in self.resources.items():
-                    resource_file = self.resource_manager.download(resource_id, resource_metadata, self.should_redownload)
+                # fetching all resources concurrently before parsing them in order
+                for resource_file in self.resource_manager.download_all(self.resources, self.should_redownload).values():
                     dataset.add(backend.from_drepr(self.drepr, resource_file, dataset.inject_class_id))
-                    data_path.append(data_path)
+                    data_path.append(resource_file)
                 return {"data": dataset, "data_path": data_path}
 
     def __del__(self):
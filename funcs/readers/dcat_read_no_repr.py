@@ -5,6 +5,7 @@ import subprocess
 from pathlib import Path
 
 from dtran.argtype import ArgType
+from dtran.dcat.store import ContentStore
 from dtran.ifunc import IFunc, IFuncType
 from funcs.readers.dcat_read_func import DCatAPI
 
@@ -39,9 +40,7 @@ class DcatReadNoReprFunc(IFunc):
         self.resources = {}
         for resource_id, resource_url in resource_ids.items():
             file_full_path = f"/tmp/dcat_read_func/{resource_id}.dat"
-            subprocess.check_call(
-                f"wget {resource_url} -O {file_full_path}", shell=True
-            )
+            ContentStore.get_instance().fetch(resource_url, file_full_path)
             self.resources[resource_id] = file_full_path
 
     def exec(self) -> dict:
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from asyncio import get_event_loop, wrap_future
+from collections import deque
+from datetime import datetime
+from typing import Union, Generator, AsyncGenerator, Optional, Dict, List, Tuple
+
+from drepr.outputs import ArrayBackend, GraphBackend
+from dtran.argtype import ArgType
+from dtran.backend import ShardedBackend
+from dtran.dcat.api import AsyncDCatAPI
+from dtran.ifunc import IFunc, IFuncType
+from dtran.metadata import Metadata
+from funcs.readers.dcat_read_func import DcatReadFunc, ResourceManager
+
+
+class DcatReadStream(IFunc):
+    id = "dcat_read_stream"
+    description = """ An entry point in the pipeline.
+    Fetches a dataset from the MINT Data-Catalog and returns a stream of its resources as soon as they are downloaded.
+    """
+    func_type = IFuncType.READER
+    friendly_name: str = "Data Catalog Stream Reader"
+    inputs = {
+        "dataset_id": ArgType.String,
+        "start_time": ArgType.DateTime(optional=True),
+        "end_time": ArgType.DateTime(optional=True),
+        "batch_size": ArgType.Number(optional=True),
+        "n_prefetch": ArgType.Number(optional=True),
+        "should_redownload": ArgType.Boolean(optional=True),
+        "override_drepr": ArgType.String(optional=True),
+    }
+    outputs = {"data": ArgType.DataSet(None), "data_path": ArgType.ListString(optional=True)}
+    example = {
+        "dataset_id": "ea0e86f3-9470-4e7e-a581-df85b4a7075d",
+        "start_time": "2020-03-02T12:30:55",
+        "end_time": "2020-03-02T12:30:55",
+        "batch_size": "1",
+        "n_prefetch": "4",
+        "should_redownload": "False",
+        "override_drepr": "/tmp/model.yml"
+    }
+    logger = logging.getLogger(__name__)
+
+    def __init__(self,
+                 dataset_id: str,
+                 start_time: Union[datetime, AsyncGenerator[datetime, None]] = None,
+                 end_time: Union[datetime, AsyncGenerator[datetime, None]] = None,
+                 batch_size: int = 1,
+                 n_prefetch: int = 4,
+                 should_redownload: bool = False,
+                 override_drepr: str = None
+                 ):
+        """
+        :param start_time: start time of the window, or a stream of windows when wired with end_time to a range stream
+        :param batch_size: number of resources in each dataset of the stream
+        :param n_prefetch: number of resources downloaded ahead of the resource being parsed
+        """
+        assert batch_size >= 1 and n_prefetch >= 1, "batch_size and n_prefetch must be positive"
+        self.dataset_id = dataset_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.batch_size = int(batch_size)
+        self.n_prefetch = int(n_prefetch)
+        self.should_redownload = should_redownload
+        self.override_drepr = override_drepr
+        self.resource_manager = ResourceManager.get_instance()
+
+    async def exec(self) -> Union[dict, Generator[dict, None, None], AsyncGenerator[dict, None]]:
+        # TODO: fix me! incorrect way to choose backend
+        if self.get_preference("data") is None or self.get_preference("data") == 'array':
+            backend = ArrayBackend
+        else:
+            backend = GraphBackend
+
+        dcat = AsyncDCatAPI.get_instance(executor=self.executor)
+        drepr, repr_type = DcatReadFunc.parse_drepr(await dcat.find_dataset_by_id(self.dataset_id),
+                                                    self.override_drepr)
+        self.logger.debug(f"Found key '{repr_type}'")
+        # resources of the last yielded dataset, they are referenced until the consumer has received the next dataset
+        # so they are not evicted while the dataset is used
+        yielded = []
+        # resources of the batch being collected
+        batch_ids = []
+        # resources which are being downloaded, in the order of the stream
+        downloading = deque()
+        try:
+            async for start_time, end_time in self.iter_windows():
+                resources = dcat.iter_resources_by_dataset_id(self.dataset_id, start_time, end_time)
+                is_exhausted = False
+                batch = []
+                while True:
+                    # keeping n_prefetch downloads in progress, so resource k + 1 is downloaded while resource k is
+                    # parsed and processed by the next adapters
+                    while not is_exhausted and len(downloading) < self.n_prefetch:
+                        try:
+                            resource = await resources.__anext__()
+                        except StopAsyncIteration:
+                            is_exhausted = True
+                            break
+                        metadata = {key: resource[key] for key in {'resource_data_url', 'resource_type'}}
+                        downloading.append((resource['resource_id'], wrap_future(self.resource_manager.executor.submit(
+                            self.resource_manager.download, resource['resource_id'], metadata,
+                            self.should_redownload))))
+                    if len(downloading) == 0:
+                        break
+
+                    resource_id, future = downloading.popleft()
+                    resource_file = await future
+                    batch_ids.append(resource_id)
+                    batch.append(resource_file)
+                    if repr_type == 'dataset_repr':
+                        if not is_exhausted and len(downloading) == 0:
+                            # with n_prefetch = 1, the listing is not consumed yet when its only resource is downloaded
+                            try:
+                                await resources.__anext__()
+                            except StopAsyncIteration:
+                                is_exhausted = True
+                        # TODO: fix me!!
+                        assert len(downloading) == 0 and is_exhausted, "Dataset has more than one resource"
+                        dataset = await get_event_loop().run_in_executor(
+                            self.executor, backend.from_drepr, drepr, resource_file)
+                        yield {"data": dataset, "data_path": batch}
+                        yielded, batch_ids = self.release(yielded, batch_ids)
+                        batch = []
+                    elif len(batch) == self.batch_size:
+                        yield {"data": await get_event_loop().run_in_executor(
+                            self.executor, self.parse_batch, backend, drepr, batch), "data_path": batch}
+                        yielded, batch_ids = self.release(yielded, batch_ids)
+                        batch = []
+                if len(batch) > 0:
+                    yield {"data": await get_event_loop().run_in_executor(
+                        self.executor, self.parse_batch, backend, drepr, batch), "data_path": batch}
+                    yielded, batch_ids = self.release(yielded, batch_ids)
+        finally:
+            # waiting for the downloads in progress if the stream is closed early, so they can be released
+            for resource_id, future in downloading:
+                try:
+                    await future
+                    batch_ids.append(resource_id)
+                except Exception:
+                    pass
+            self.release(yielded + batch_ids, [])
+
+    def release(self, resource_ids: List[str], batch_ids: List[str]) -> Tuple[List[str], List[str]]:
+        """
+        Release the resources of the previous dataset once the next one (batch_ids) has been handed to the consumer,
+        i.e., when the stream is resumed after yielding it
+
+        :return: the resources of the last yielded dataset and of a new batch
+        """
+        for resource_id in resource_ids:
+            self.resource_manager.unlink(resource_id)
+        return batch_ids, []
+
+    async def iter_windows(self):
+        """
+        Iterate over the time windows to read, which are either given or streamed by a wired adapter
+        """
+        if hasattr(self.start_time, '__anext__') or hasattr(self.end_time, '__anext__'):
+            assert hasattr(self.start_time, '__anext__') and hasattr(self.end_time, '__anext__'), \
+                "start_time and end_time must be both wired or both given"
+            while True:
+                try:
+                    yield await self.start_time.__anext__(), await self.end_time.__anext__()
+                except StopAsyncIteration:
+                    break
+        else:
+            yield self.start_time, self.end_time
+
+    @staticmethod
+    def parse_batch(backend, drepr, resource_files):
+        dataset = ShardedBackend(len(resource_files))
+        for resource_file in resource_files:
+            dataset.add(backend.from_drepr(drepr, resource_file, dataset.inject_class_id))
+        return dataset
+
+    def validate(self) -> bool:
+        return True
+
+    def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
+        return metadata
@@ -6,7 +6,7 @@ from typing import Union, Generator, AsyncGenerator, Optional, Dict
 
 from dtran.argtype import ArgType
 from dtran.ifunc import IFunc, IFuncType
-from dtran.dcat.api import DCatAPI
+from dtran.dcat.api import AsyncDCatAPI
 from dtran.metadata import Metadata
 
 
@@ -27,10 +27,12 @@ class DcatVariableStream(IFunc):
     }
 
     def __init__(self, dataset_id: str):
-        self.variables = DCatAPI.get_instance().find_standard_variables_by_dataset_id(dataset_id)
+        self.dataset_id = dataset_id
 
     async def exec(self) -> Union[dict, Generator[dict, None, None], AsyncGenerator[dict, None]]:
-        for variable in self.variables:
+        dcat = AsyncDCatAPI.get_instance(executor=self.executor)
+        variables = await dcat.find_standard_variables_by_dataset_id(self.dataset_id)
+        for variable in variables:
             yield {"variable_name": variable["standard_variable_name"]}
 
     def validate(self) -> bool:
@@ -61,7 +61,11 @@ def wrap_nc2geotiff(args):
     return None
 
 
-def nc2geotiff(nc_file: str, var_name: str, out_file, no_data=0.0, verbose=False):
+def nc2geotiff(nc_file: str, var_name: str, out_file, no_data=0.0, verbose=False, out_format='GTiff'):
+    """
+    Convert a variable of a netcdf file to a geotiff file. With out_format='MEM', the variable is converted to
+    a gdal dataset in memory, which is returned instead of being written to out_file
+    """
     logs = ["convert gpm file to geotiff: %s at %s" % (Path(nc_file).stem, datetime.now().strftime("%H:%M:%S"))]
     ### raster = gdal.Open("NETCDF:{0}:{1}".format(nc_file, var_name), gdal.GA_ReadOnly )
     raster = gdal.Open("NETCDF:{0}:{1}".format(nc_file, var_name))
@@ -149,7 +153,7 @@ def nc2geotiff(nc_file: str, var_name: str, out_file, no_data=0.0, verbose=False
     # ------------------------------------
     # Write new array to a GeoTIFF file
     # ------------------------------------
-    driver = gdal.GetDriverByName('GTiff')
+    driver = gdal.GetDriverByName(out_format)
     outRaster = driver.Create(out_file, ncols2, nrows2, 1, gdal.GDT_Float32)
     outRaster.SetGeoTransform(geotransform2)
     outband = outRaster.GetRasterBand(1)
@@ -158,6 +162,8 @@ def nc2geotiff(nc_file: str, var_name: str, out_file, no_data=0.0, verbose=False
     outRasterSRS.ImportFromWkt(proj2)
     outRaster.SetProjection(outRasterSRS.ExportToWkt())
     outband.FlushCache()
+    if out_format == 'MEM':
+        return outRaster
 
     # ---------------------
     # Close the out_file
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import zlib
+from dataclasses import dataclass, asdict, field
+from typing import List, Optional
+
+import numpy as np
+
+
+@dataclass
+class GridRecord:
+    """
+    A grid of the RTS file: the NetCDF file it is regridded from (to detect changed inputs) and the checksum of the
+    grid in the RTS file (to detect grids which are not or partially written)
+    """
+    file: str
+    size: int
+    mtime_ns: int
+    sha1: str
+    checksum: int
+    gmax: float
+    bad_file: bool
+
+    @staticmethod
+    def create(nc_file: str, grid: np.ndarray, gmax: float, bad_file: bool) -> 'GridRecord':
+        stat = os.stat(nc_file)
+        return GridRecord(os.path.basename(nc_file), stat.st_size, stat.st_mtime_ns, file_digest(nc_file),
+                          grid_checksum(grid), float(gmax), bool(bad_file))
+
+
+@dataclass
+class RTSManifest:
+    """
+    Manifest of an RTS file generated from NetCDF files, so that running the transformation again (e.g., for an
+    extended date range) only regrids the new or changed files. The grids are valid only if they are generated with
+    the same parameters (variable, DEM bounds and resolution, nodata)
+    """
+    params: dict
+    shape: List[int]
+    grids: List[GridRecord] = field(default_factory=list)
+
+    @staticmethod
+    def load(manifest_file: str, params: dict) -> Optional['RTSManifest']:
+        if not os.path.exists(manifest_file):
+            return None
+        try:
+            with open(manifest_file, "r") as f:
+                obj = json.load(f)
+            manifest = RTSManifest(obj['params'], obj['shape'], [GridRecord(**r) for r in obj['grids']])
+        except (ValueError, KeyError, TypeError):
+            print(f"Ignore the invalid manifest {manifest_file}")
+            return None
+        if manifest.params != params:
+            print(f"The parameters of the manifest {manifest_file} changed, all files will be regridded")
+            return None
+        return manifest
+
+    def save(self, manifest_file: str):
+        tmp_file = f"{manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(asdict(self), f, indent=2)
+        os.replace(tmp_file, manifest_file)
+
+    def n_valid_grids(self, nc_files: List[str], rts) -> int:
+        """
+        Get the number of grids at the beginning of the RTS file (a memory-mapped RTS) which are generated from the
+        first NetCDF files (sorted by time) as they are now. A file whose mtime changed is valid if its content is
+        the same
+        """
+        n_grids = min(len(self.grids), len(nc_files), rts.number_of_grids())
+        for i in range(n_grids):
+            record, nc_file = self.grids[i], nc_files[i]
+            stat = os.stat(nc_file)
+            if os.path.basename(nc_file) != record.file or stat.st_size != record.size:
+                return i
+            if stat.st_mtime_ns != record.mtime_ns:
+                if file_digest(nc_file) != record.sha1:
+                    return i
+                record.mtime_ns = stat.st_mtime_ns
+            if grid_checksum(rts.get_grid(i)) != record.checksum:
+                return i
+        return n_grids
+
+
+def file_digest(file: str) -> str:
+    digest = hashlib.sha1()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def grid_checksum(grid: np.ndarray) -> int:
+    return zlib.crc32(np.ascontiguousarray(grid, dtype=np.float32).tobytes())
@@ -30,6 +30,17 @@ from . import rti_files
 #       byte_swap_needed()
 #       number_of_grids()
 #
+#   class rts_memmap():    # (memory-mapped, random access)
+#
+#       open_file()
+#       open_new_file()
+#       get_grid()
+#       get_grids()
+#       add_grid()
+#       number_of_grids()
+#       flush()
+#       close()
+#
 #-------------------------------------------------------------------
 def unit_test(nx=4, ny=5, n_grids=6, VERBOSE=False,
               file_name="TEST_FILE.rts"):
@@ -491,3 +502,142 @@ class rts_file():
     #-------------------------------------------------------------------
 
     
+
+#-------------------------------------------------------------------
+class rts_memmap():
+
+    #----------------------------------------------------------
+    # Notes: The RTS file is mapped in memory as a read-only
+    #        or writable (time, ny, nx) array (self.grids),
+    #        so a grid or a range of grids is a view of the
+    #        file without any copy or read of the other grids.
+    #
+    #        The byte order of the RTI file is part of the
+    #        dtype of the array, so values are converted
+    #        when they are used and no byte swap is needed.
+    #
+    #        Several processes can open the same file with
+    #        UPDATE=True and write disjoint time indices, as
+    #        the file is allocated by open_new_file().
+    #----------------------------------------------------------
+    def open_file(self, file_name, UPDATE=False, info=None,
+                  n_grids=None):
+
+        #-----------------------------------------------------
+        # Note: With UPDATE, the file can be truncated or
+        #       extended (with zeros) to n_grids grids, e.g.
+        #       to append new grids in place.
+        #-----------------------------------------------------
+        if (info is None):
+            info = rti_files.read_info( file_name )
+        if (info is None) or (info == -1):
+            return False
+
+        self.store_info( file_name, info )
+        if (n_grids is not None) and (UPDATE):
+            with open( file_name, 'rb+' ) as f:
+                f.truncate( n_grids * self.grid_size )
+        n_grids = os.path.getsize( file_name ) // self.grid_size
+        self.grids = np.memmap( file_name, dtype=self.dtype,
+                                mode=('r+' if UPDATE else 'r'),
+                                shape=(n_grids, self.ny, self.nx) )
+        return True
+
+    #   open_file()
+    #----------------------------------------------------------
+    def open_new_file(self, file_name, n_grids, info=None,
+                      dtype='float32', MAKE_RTI=True):
+
+        #-----------------------------------------------------
+        # Note: The file is allocated for n_grids grids, and
+        #       filled with zeros.  If "info" is not given,
+        #       it is read from an existing RTI file.
+        #-----------------------------------------------------
+        if (info is None):
+            info = rti_files.read_info( file_name )
+            if (info is None) or (info == -1):
+                print('ERROR during open_new_file():')
+                print('   Could not find RTI file and "info"')
+                print('   argument was not provided.')
+                print(' ')
+                return False
+        else:
+            info.grid_file  = file_name
+            info.data_type  = rti_files.get_rti_data_type( dtype )
+            info.byte_order = rti_files.get_rti_byte_order()
+
+        if (MAKE_RTI):
+            prefix   = rti_files.get_file_prefix( file_name )
+            rti_files.write_info( prefix + '.rti', info )
+
+        self.store_info( file_name, info )
+        self.grids = np.memmap( file_name, dtype=self.dtype, mode='w+',
+                                shape=(n_grids, self.ny, self.nx) )
+        return True
+
+    #   open_new_file()
+    #----------------------------------------------------------
+    def store_info(self, file_name, info):
+
+        self.info      = info
+        self.file_name = file_name
+        self.nx        = info.ncols
+        self.ny        = info.nrows
+        self.dx        = info.xres
+        self.dy        = info.yres
+
+        byte_order = ('>' if (info.byte_order.upper() == 'MSB') else '<')
+        dtype = rti_files.get_numpy_data_type( info.data_type )
+        self.dtype     = np.dtype( dtype ).newbyteorder( byte_order )
+        self.grid_size = (self.nx * self.ny * self.dtype.itemsize)
+
+    #   store_info()
+    #----------------------------------------------------------
+    def get_grid(self, time_index):
+
+        return self.grids[ time_index ]
+
+    #   get_grid()
+    #----------------------------------------------------------
+    def get_grids(self, start=None, stop=None, step=None):
+
+        # Note:  A (time, ny, nx) view of the grids.
+        return self.grids[ start:stop:step ]
+
+    #   get_grids()
+    #----------------------------------------------------------
+    def add_grid(self, grid, time_index):
+
+        #------------------------------------------------
+        # Note: A scalar "grid" is written to all cells.
+        #       The values are converted to the dtype and
+        #       byte order of the file by the assignment.
+        #------------------------------------------------
+        self.grids[ time_index ] = grid
+
+    #   add_grid()
+    #----------------------------------------------------------
+    def number_of_grids(self):
+
+        return self.grids.shape[0]
+
+    #   number_of_grids()
+    #----------------------------------------------------------
+    def flush(self):
+
+        if (self.grids.mode != 'r'):
+            self.grids.flush()
+
+    #   flush()
+    #----------------------------------------------------------
+    def close(self):
+
+        self.flush()
+        #-----------------------------------------------
+        # Note: The file is unmapped when there are no
+        #       more references to the array or views.
+        #-----------------------------------------------
+        del self.grids
+
+    #   close()
+    #-------------------------------------------------------------------
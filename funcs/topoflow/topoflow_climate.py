@@ -30,7 +30,8 @@ class Topoflow4ClimateWriteFunc(IFunc):
         "bounds": ArgType.String,
         "xres_arcsecs": ArgType.Number,
         "yres_arcsecs": ArgType.Number,
-        "unit_multiplier": ArgType.Number(optional=True)
+        "unit_multiplier": ArgType.Number(optional=True),
+        "max_workers": ArgType.Number(optional=True),
     }
     outputs = {"output_file": ArgType.String}
     friendly_name: str = "Topoflow Climate"
@@ -42,10 +43,11 @@ class Topoflow4ClimateWriteFunc(IFunc):
         "bounds": "34.221249999999, 7.362083333332, 36.446249999999, 9.503749999999",
         "xres_arcsecs": "30",
         "yres_arcsecs": "30",
-        "unit_multiplier": 1
+        "unit_multiplier": 1,
+        "max_workers": "4",
     }
 
-    def __init__(self, geotiff_files: List[str], cropped_geotiff_dir: str, output_file: str, bounds: str, xres_arcsecs: int, yres_arcsecs: int, unit_multiplier: float=1):
+    def __init__(self, geotiff_files: List[str], cropped_geotiff_dir: str, output_file: str, bounds: str, xres_arcsecs: int, yres_arcsecs: int, unit_multiplier: float=1, max_workers: int=None):
         x_min, y_min, x_max, y_max = [float(x.strip()) for x in bounds.split(",")]
         assert x_max > x_min and y_min < y_max
         self.bounding_box = BoundingBox(x_min, y_min, x_max, y_max)
@@ -62,6 +64,8 @@ class Topoflow4ClimateWriteFunc(IFunc):
             Path(self.cropped_geotiff_dir).mkdir(exist_ok=True, parents=True)
 
         self.unit_multiplier = unit_multiplier
+        # number of processes cropping the geotiff files
+        self.max_workers = int(max_workers) if max_workers is not None else None
         Path(self.cropped_geotiff_dir).mkdir(exist_ok=True, parents=True)
         Path(output_file).parent.mkdir(exist_ok=True, parents=True)
 
@@ -74,7 +78,8 @@ class Topoflow4ClimateWriteFunc(IFunc):
         else:
             rts_file = self.output_file
 
-        create_rts_rti(self.geotiff_files, rts_file, self.cropped_geotiff_dir, self.bounding_box, self.xres_arcsecs, self.yres_arcsecs, self.unit_multiplier)
+        create_rts_rti(self.geotiff_files, rts_file, self.cropped_geotiff_dir, self.bounding_box, self.xres_arcsecs, self.yres_arcsecs, self.unit_multiplier,
+                       max_workers=self.max_workers)
 
         if self.output_file.endswith(".zip"):
             # compress the outfile
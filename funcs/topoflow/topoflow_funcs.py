@@ -1,5 +1,6 @@
 import glob
 import os
+import traceback
 
 from funcs.gdal.raster import Raster, BoundingBox
 
@@ -23,25 +24,51 @@ def crop_geotiff(args):
     return True
 
 
-def create_rts_rti(tif_files, out_file, crop_dir: str, out_bounds: BoundingBox, out_xres_sec: int, out_yres_sec: int, unit_multiplier: float):
-    """Create RTS file from TIF files. Names of TIF files must be sorted by time"""
+def safe_crop_geotiff(args):
+    """Crop a geotiff in a worker, returning the error instead of raising it so the other files are still cropped"""
+    try:
+        return crop_geotiff(args), None
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def create_rts_rti(tif_files, out_file, crop_dir: str, out_bounds: BoundingBox, out_xres_sec: int, out_yres_sec: int,
+                   unit_multiplier: float, max_workers: int = None):
+    """Create RTS file from TIF files. Names of TIF files must be sorted by time
+
+    @param max_workers number of processes cropping the files (default is the number of processors, 1 crops the
+        files in the current process)
+    """
     assert out_file.endswith(".rts") and len(out_file.split(".rts")) == 2
     assert len(tif_files) > 0
 
-    pool = Pool()
     # crop the data first
     tif_files = sorted(tif_files)
     out_bounds = [out_bounds.x_min, out_bounds.y_min, out_bounds.x_max, out_bounds.y_max]
     out_crop_files = [os.path.join(crop_dir, os.path.basename(tif_file)) for tif_file in tif_files]
-
-    # res = list(pool.imap_unordered(crop_geotiff, [
-    #     (tif_file, out_crop_file, out_bounds, out_xres_sec, out_yres_sec)
-    #     for tif_file, out_crop_file in zip(tif_files, out_crop_files)
-    # ]))
-    # print(res)
-    for tif_file, out_crop_file in tqdm(zip(tif_files, out_crop_files)):
-        args = (tif_file, out_crop_file, out_bounds, out_xres_sec, out_yres_sec)
-        assert crop_geotiff(args)
+    crop_args = [
+        (tif_file, out_crop_file, out_bounds, out_xres_sec, out_yres_sec)
+        for tif_file, out_crop_file in zip(tif_files, out_crop_files)
+    ]
+
+    if max_workers == 1 or len(crop_args) == 1:
+        results = [safe_crop_geotiff(args) for args in tqdm(crop_args)]
+    else:
+        pool = Pool(max_workers)
+        try:
+            # the results are in the same order as the files, but the files are cropped in any order
+            results = list(tqdm(pool.imap(safe_crop_geotiff, crop_args), total=len(crop_args)))
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    errors = [(tif_file, error) for tif_file, (success, error) in zip(tif_files, results) if not success]
+    # the RTS file cannot have missing time steps, so it is not written if any file fails
+    assert len(errors) == 0, f"Cannot crop {len(errors)} files:\n" + "\n".join(
+        f"{tif_file}: {error or 'failed'}" for tif_file, error in errors)
 
     # load the crop file and write rts and rti
     with open(out_file, "wb") as f:
@@ -2,9 +2,13 @@
 # -*- coding: utf-8 -*-
 import glob
 import re
+from asyncio import get_event_loop, as_completed, ensure_future
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 from os.path import join
 from pathlib import Path
-from typing import Union, List, Optional, Dict
+from multiprocessing import Pool
+from typing import Union, List, Optional, Dict, AsyncGenerator
 
 import gdal  # # ogr
 import numpy as np
@@ -19,6 +23,8 @@ from zipfile import ZipFile
 from dtran.argtype import ArgType
 from dtran.ifunc import IFunc, IFuncType
 from funcs.topoflow.rti_files import generate_rti_file
+from funcs.topoflow.rts_manifest import RTSManifest, GridRecord
+from funcs.topoflow.topoflow.utils import rts_files
 
 
 class Topoflow4ClimateWriteFunc(IFunc):
@@ -34,6 +40,8 @@ class Topoflow4ClimateWriteFunc(IFunc):
         "DEM_bounds": ArgType.String,
         "DEM_xres_arcsecs": ArgType.String,
         "DEM_yres_arcsecs": ArgType.String,
+        "direct": ArgType.Boolean(optional=True),
+        "max_workers": ArgType.Number(optional=True),
     }
     outputs = {"output_file": ArgType.String}
     friendly_name: str = "Topoflow Climate"
@@ -45,10 +53,19 @@ class Topoflow4ClimateWriteFunc(IFunc):
         "var_name": "HQprecipitation",
         "DEM_bounds": "34.221249999999, 7.362083333332, 36.446249999999, 9.503749999999",
         "DEM_xres_arcsecs": "30",
-        "DEM_yres_arcsecs": "30"
+        "DEM_yres_arcsecs": "30",
+        "direct": "False",
+        "max_workers": "4",
     }
 
-    def __init__(self, input_dir: str, temp_dir: str, output_file: Union[str, Path], var_name: str, DEM_bounds: str, DEM_xres_arcsecs: str, DEM_yres_arcsecs: str):
+    def __init__(self, input_dir: str, temp_dir: str, output_file: Union[str, Path], var_name: str, DEM_bounds: str, DEM_xres_arcsecs: str, DEM_yres_arcsecs: str,
+                 direct: bool = False, max_workers: int = None):
+        """
+        :param direct: regrid the NetCDF files in memory and write the grids directly to the RTS file, without the
+            intermediate GeoTIFF and npz files in temp_dir. The RTS file is resumable: running again for an
+            extended date range only regrids the new files and appends them to the RTS file in temp_dir
+        :param max_workers: number of processes regridding the files in direct mode
+        """
         self.DEM = {
             "bounds": [float(x.strip()) for x in DEM_bounds.split(",")],
             "xres": float(DEM_xres_arcsecs) / 3600.0,
@@ -58,6 +75,8 @@ class Topoflow4ClimateWriteFunc(IFunc):
         self.input_dir = str(input_dir)
         self.temp_dir = str(temp_dir)
         self.output_file = str(output_file)
+        self.direct = direct
+        self.max_workers = int(max_workers) if max_workers is not None else None
 
     def exec(self) -> dict:
         for path in [self.input_dir, self.temp_dir]:
@@ -65,7 +84,8 @@ class Topoflow4ClimateWriteFunc(IFunc):
 
         Path(self.output_file).parent.mkdir(exist_ok=True, parents=True)
 
-        create_rts_from_nc_files(self.input_dir, self.temp_dir, self.output_file, self.DEM, self.var_name, IN_MEMORY=True)
+        create_rts_from_nc_files(self.input_dir, self.temp_dir, self.output_file, self.DEM, self.var_name, IN_MEMORY=True,
+                                 DIRECT=self.direct, max_workers=self.max_workers)
         return {"output_file": self.output_file}
 
     def validate(self) -> bool:
@@ -75,44 +95,92 @@ class Topoflow4ClimateWriteFunc(IFunc):
 class Topoflow4ClimateWritePerMonthFunc(IFunc):
     id = "topoflow4_climate_write_per_month_func"
     description = ''' A reader-transformation-writer multi-adapter.
-    Creates RTS (and RTI) files per month from NetCDF (climate) files.
+    Creates RTS (and RTI) files per month (or per week, season, year) from NetCDF (climate) files.
+    The RTS files of the periods are written in parallel, and returned as soon as they are written.
     '''
     inputs = {
         "grid_dir": ArgType.String,
         "date_regex": ArgType.String,
         "output_file": ArgType.FilePath,
+        "period": ArgType.String(optional=True),
+        "max_workers": ArgType.Number(optional=True),
     }
-    outputs = {}
+    outputs = {"output_file": ArgType.String, "period": ArgType.String}
     friendly_name: str = "Topoflow Climate Per Month"
     func_type = IFuncType.MODEL_TRANS
     example = {
         "grid_dir": f"/data/mint/gpm_grid_baro",
         "date_regex": '3B-HHR-E.MS.MRG.3IMERG.(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})',
         "output_file": f"/data/mint/baro/climate.rts",
+        "period": "month, week, season, year",
+        "max_workers": "4",
     }
 
-    def __init__(self, grid_dir: str, date_regex: str, output_file: Union[str, Path]):
+    PERIODS = {"month", "week", "season", "year"}
+
+    def __init__(self, grid_dir: str, date_regex: str, output_file: Union[str, Path], period: str = "month",
+                 max_workers: int = None):
+        """
+        :param date_regex: regex of the names of the grid files, with the groups year, month (except for year
+            periods) and day (for week periods)
+        :param period: the files are grouped by month (the month number, as files of different years are grouped
+            together), ISO week, meteorological season (december is in the winter of the next year) or year
+        :param max_workers: number of periods written at the same time (default is the number of processors)
+        """
         self.grid_dir = str(grid_dir)
         self.date_regex = re.compile(str(date_regex))
         self.output_file = str(output_file)
+        self.period = period
+        self.max_workers = int(max_workers) if max_workers is not None else None
 
-    def exec(self) -> dict:
-        grid_files_per_month = {}
+    async def exec(self) -> AsyncGenerator[dict, None]:
+        grid_files_per_period = {}
         for grid_file in glob.glob(join(self.grid_dir, '*.npz')):
-            month = self.date_regex.match(Path(grid_file).name).group('month')
-            if month not in grid_files_per_month:
-                grid_files_per_month[month] = []
-            grid_files_per_month[month].append(grid_file)
-
-        for month in sorted(grid_files_per_month.keys()):
-            grid_files = grid_files_per_month[month]
-            print(">>> Process month", month, "#files=", len(grid_files))
-            output_file = Path(self.output_file).parent / f"{Path(self.output_file).stem}.{month}.rts"
-            write_grid_files_to_rts(grid_files, output_file)
-        return {}
+            period = self.get_period(self.date_regex.match(Path(grid_file).name))
+            if period not in grid_files_per_period:
+                grid_files_per_period[period] = []
+            grid_files_per_period[period].append(grid_file)
+
+        loop = get_event_loop()
+        executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        async def write_period(period: str):
+            grid_files = grid_files_per_period[period]
+            print(">>> Process", self.period, period, "#files=", len(grid_files))
+            output_file = Path(self.output_file).parent / f"{Path(self.output_file).stem}.{period}.rts"
+            await loop.run_in_executor(executor, write_grid_files_to_rts, grid_files, output_file)
+            return {"output_file": str(output_file), "period": period}
+
+        tasks = [ensure_future(write_period(period)) for period in sorted(grid_files_per_period.keys())]
+        try:
+            # the periods are returned in the order they are written
+            for result in as_completed(tasks):
+                yield await result
+        except BaseException:
+            # on failure (or if the stream is closed early), the periods which are not written yet are cancelled and
+            # the pool is shut down without blocking the event loop until the running ones finish
+            for task in tasks:
+                task.cancel()
+            executor.shutdown(wait=False)
+            raise
+        # every period is written, so the shutdown is quick but it still joins the worker processes
+        await loop.run_in_executor(self.executor, executor.shutdown)
+
+    def get_period(self, match) -> str:
+        if self.period == "month":
+            return match.group('month')
+        year = int(match.group('year'))
+        if self.period == "year":
+            return f"{year:04d}"
+        month = int(match.group('month'))
+        if self.period == "season":
+            season = ["DJF", "MAM", "JJA", "SON"][(month % 12) // 3]
+            return f"{year + (month == 12):04d}{season}"
+        iso_year, iso_week, _ = date(year, month, int(match.group('day'))).isocalendar()
+        return f"{iso_year:04d}W{iso_week:02d}"
 
     def validate(self) -> bool:
-        return True
+        return self.period in Topoflow4ClimateWritePerMonthFunc.PERIODS
 
     def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
         return metadata
@@ -242,7 +310,7 @@ def bounds_disjoint(bounds1, bounds2, VERBOSE=False):
 # -------------------------------------------------------------------
 def gdal_regrid_to_dem_grid(ds_in, tmp_file,
                             nodata, DEM_bounds, DEM_xres, DEM_yres,
-                            RESAMPLE_ALGO='bilinear'):
+                            RESAMPLE_ALGO='bilinear', OUT_FORMAT='GTiff'):
     # -----------------------------------
     # Specify the resampling algorithm
     # -----------------------------------
@@ -266,7 +334,7 @@ def gdal_regrid_to_dem_grid(ds_in, tmp_file,
     # --------------------------------------------------
     # gdal_bbox = [DEM_bounds[0], DEM_bounds[2], DEM_bounds[1], DEM_bounds[3]]
     ds_tmp = gdal.Warp(tmp_file, ds_in,
-                       format='GTiff',  # (output format string)
+                       format=OUT_FORMAT,  # (output format string, MEM to keep the result in memory)
                        outputBounds=DEM_bounds, xRes=DEM_xres, yRes=DEM_yres,
                        srcNodata=nodata,  ########
                        ### dstNodata=nodata,  ########
@@ -411,6 +479,117 @@ def extract_grid_data(args):
     return gmax, BAD_FILE, grid2.shape
 
 
+def regrid_nc_file(nc_file, var_name, rts_nodata, DEM_bounds, DEM_xres, DEM_yres, DEM_shape=None):
+    """
+    Regrid the variable of a NetCDF file to the DEM grid without any temporary file: the variable is read with
+    netCDF4 to a gdal dataset in memory, which is warped to another dataset in memory
+    """
+    ds_in = nc2geotiff(nc_file, var_name, '', no_data=rts_nodata, out_format='MEM')
+    gmax = ds_in.ReadAsArray().max()
+
+    BAD_FILE = bounds_disjoint(get_raster_bounds(ds_in, VERBOSE=False), DEM_bounds)
+    if BAD_FILE:
+        print('###############################################')
+        print('WARNING: Bounding boxes do not overlap.')
+        print('         New grid will contain only nodata.')
+        print('###############################################')
+        print('file  =', nc_file)
+        print(' ')
+        assert DEM_shape is not None, f"The first file {nc_file} does not overlap with the DEM"
+        grid = np.full(DEM_shape, rts_nodata, dtype=np.float32)
+    else:
+        grid = gdal_regrid_to_dem_grid(ds_in, '', rts_nodata, DEM_bounds, DEM_xres, DEM_yres,
+                                       RESAMPLE_ALGO='bilinear', OUT_FORMAT='MEM')
+    ds_in = None
+    return np.float32(grid), gmax, BAD_FILE
+
+
+def extract_grid_to_rts(args):
+    """
+    Regrid a NetCDF file and write the grid at its time index in the RTS file, which is already allocated so that
+    the files can be written in any order
+    """
+    rts_file, time_index, nc_file, var_name, rts_nodata, DEM_bounds, DEM_nrows, DEM_ncols, DEM_xres, DEM_yres = args
+    grid, gmax, BAD_FILE = regrid_nc_file(nc_file, var_name, rts_nodata, DEM_bounds, DEM_xres, DEM_yres,
+                                          (DEM_nrows, DEM_ncols))
+    assert grid.shape == (DEM_nrows, DEM_ncols), f"The grid of {nc_file} does not have the shape of the DEM"
+    rts = rts_files.rts_memmap()
+    assert rts.open_file(rts_file, UPDATE=True)
+    rts.add_grid(grid, time_index)
+    rts.close()
+    return time_index, GridRecord.create(nc_file, grid, gmax, BAD_FILE)
+
+
+def write_nc_files_to_rts(nc_files: List[str], rts_file: str, var_name, rts_nodata, DEM_bounds, DEM_xres, DEM_yres,
+                          max_workers: int = None, manifest_file: str = None):
+    """
+    Regrid the NetCDF files (sorted in time-order) and write them directly to the RTS file, without the intermediate
+    GeoTIFF and npz files. The RTS file is allocated (with its RTI file) once the shape of the grids is known from the
+    first file, then the other files are written by a pool of workers at their time index.
+
+    With a manifest file, the grids of the RTS file generated by a previous run from the same files and parameters
+    are kept: only the following files are regridded, and appended to the RTS file in place.
+
+    @return DEM_nrows, DEM_ncols, Pmax, bad_count, and whether the RTS file is changed
+    """
+    params = {"var_name": var_name, "rts_nodata": float(rts_nodata), "DEM_bounds": [float(x) for x in DEM_bounds],
+              "DEM_xres": float(DEM_xres), "DEM_yres": float(DEM_yres)}
+    manifest = RTSManifest.load(manifest_file, params) if manifest_file is not None else None
+    n_valid, n_rts_grids = 0, 0
+    if manifest is not None and os.path.exists(rts_file):
+        rts = rts_files.rts_memmap()
+        if rts.open_file(rts_file):
+            n_valid = manifest.n_valid_grids(nc_files, rts)
+            n_rts_grids = rts.number_of_grids()
+            rts.close()
+
+    if n_valid == 0:
+        grid, gmax, BAD_FILE = regrid_nc_file(nc_files[0], var_name, rts_nodata, DEM_bounds, DEM_xres, DEM_yres)
+        DEM_nrows, DEM_ncols = grid.shape
+        manifest = RTSManifest(params, [DEM_nrows, DEM_ncols], [GridRecord.create(nc_files[0], grid, gmax, BAD_FILE)])
+        generate_rti_file(rts_file, rts_file.replace('.rts', '.rti'), DEM_ncols, DEM_nrows, DEM_xres, DEM_yres,
+                          pixel_geom=0, silent=True)
+        rts = rts_files.rts_memmap()
+        assert rts.open_new_file(rts_file, len(nc_files), MAKE_RTI=False)
+        rts.add_grid(grid, 0)
+        rts.close()
+        start = 1
+    else:
+        DEM_nrows, DEM_ncols = manifest.shape
+        manifest.grids = manifest.grids[:n_valid]
+        if n_valid == len(nc_files) == n_rts_grids:
+            print(f'{rts_file} is up to date with {n_valid} grids')
+            # the mtimes of the files whose content is unchanged are updated
+            manifest.save(manifest_file)
+            return DEM_nrows, DEM_ncols, max(r.gmax for r in manifest.grids), \
+                sum(r.bad_file for r in manifest.grids), False
+        print(f'Keep {n_valid} grids of {rts_file}, regrid {len(nc_files) - n_valid} files')
+        # the invalid grids are overwritten, and the new grids are appended in place
+        rts = rts_files.rts_memmap()
+        assert rts.open_file(rts_file, UPDATE=True, n_grids=len(nc_files))
+        rts.close()
+        start = n_valid
+
+    args = [
+        (rts_file, time_index, nc_file, var_name, rts_nodata, DEM_bounds, DEM_nrows, DEM_ncols, DEM_xres, DEM_yres)
+        for time_index, nc_file in enumerate(nc_files)
+        if time_index >= start
+    ]
+    records = {}
+    if len(args) > 0:
+        with Pool(max_workers) as pool:
+            for time_index, record in tqdm(pool.imap_unordered(extract_grid_to_rts, args), total=len(args)):
+                records[time_index] = record
+    manifest.grids.extend(records[time_index] for time_index in sorted(records.keys()))
+    if manifest_file is not None:
+        # the manifest is saved once all grids are written, so an interrupted run is resumed from the last manifest
+        manifest.save(manifest_file)
+
+    Pmax = max(r.gmax for r in manifest.grids)
+    bad_count = sum(r.bad_file for r in manifest.grids)
+    return DEM_nrows, DEM_ncols, Pmax, bad_count, True
+
+
 def write_grid_files_to_rts(grid_files: List[str], rts_output_file: str):
     """
     grid_files need to be sorted in time-order
@@ -427,7 +606,13 @@ def write_grid_files_to_rts(grid_files: List[str], rts_output_file: str):
 # -------------------------------------------------------------------
 def create_rts_from_nc_files(nc_dir_path, temp_bin_dir, zip_file, DEM_info: dict,
                              var_name,
-                             IN_MEMORY=False, VERBOSE=False):
+                             IN_MEMORY=False, VERBOSE=False, DIRECT=False, max_workers=None):
+    """
+    @param DIRECT regrid the files in memory and write them directly to the RTS file, instead of going through
+        GeoTIFF and npz files in temp_bin_dir. A manifest of the grids is kept next to the RTS file, so running
+        again (e.g., for an extended date range) only regrids the new or changed files
+    @param max_workers number of processes regridding the files in DIRECT mode
+    """
     # ------------------------------------------------------
     # For info on GDAL constants, see:
     # https://gdal.org/python/osgeo.gdalconst-module.html
@@ -456,6 +641,21 @@ def create_rts_from_nc_files(nc_dir_path, temp_bin_dir, zip_file, DEM_info: dict
     rts_nodata = 0.0  # (good for rainfall rates; not general)
     Pmax = -1
 
+    if DIRECT:
+        file_name = os.path.basename(zip_file)
+        rts_file = f"{temp_bin_dir}/{file_name.replace('.zip', '.rts')}"
+        manifest_file = rts_file.replace('.rts', '.manifest.json')
+        DEM_nrows, DEM_ncols, Pmax, bad_count, changed = write_nc_files_to_rts(
+            nc_file_list, rts_file, var_name, rts_nodata, DEM_bounds, DEM_xres, DEM_yres, max_workers, manifest_file)
+        count = len(nc_file_list)
+        # the RTI and zip files are only regenerated when the RTS file changed or when they are missing
+        rti_file = rts_file.replace('.rts', '.rti')
+        if changed or not os.path.exists(rti_file) or not os.path.exists(zip_file) \
+                or os.path.getmtime(zip_file) < os.path.getmtime(rts_file):
+            write_rti_and_zip(rts_file, zip_file, temp_bin_dir, DEM_nrows, DEM_ncols, DEM_xres, DEM_yres,
+                              Pmax, bad_count, count)
+        return
+
     # ------------------------
     # BINH: run multiprocessing
     from multiprocessing import Pool
@@ -504,7 +704,13 @@ def create_rts_from_nc_files(nc_dir_path, temp_bin_dir, zip_file, DEM_info: dict
     rts_file = f"{temp_bin_dir}/{file_name.replace('.zip', '.rts')}"
     grid_files = sorted(glob.glob(join(temp_bin_dir, '*.npz')))
     write_grid_files_to_rts(grid_files, rts_file)
+    write_rti_and_zip(rts_file, zip_file, temp_bin_dir, DEM_nrows, DEM_ncols, DEM_xres, DEM_yres,
+                      Pmax, bad_count, count)
 
+
+def write_rti_and_zip(rts_file, zip_file, temp_bin_dir, DEM_nrows, DEM_ncols, DEM_xres, DEM_yres,
+                      Pmax, bad_count, count):
+    file_name = os.path.basename(zip_file)
     # Generate RTI file
     rti_fname = f"{temp_bin_dir}/{file_name.replace('.zip', '.rti')}"
     generate_rti_file(rts_file, rti_fname, DEM_ncols, DEM_nrows, DEM_xres, DEM_yres, pixel_geom=0)
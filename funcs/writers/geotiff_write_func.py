@@ -1,31 +1,66 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Optional, Union
 
+import numpy as np
 from drepr.outputs.base_output_sm import BaseOutputSM
 from datetime import datetime, timezone
+from osgeo import gdal
+
 from dtran import ArgType
-from dtran.ifunc import IFunc
+from dtran.ifunc import IFunc, IFuncExecMode
 from dtran.metadata import Metadata
+from funcs.gdal.raster import Raster
 from funcs.gdal.trans_cropping_func import CroppingTransFunc
 
 
 class GeoTiffWriteFunc(IFunc):
     id = "geotiff_write_func"
     description = """Write dataset to GeoTiff format."""
+    # gdal releases the GIL while encoding the files
+    exec_mode = IFuncExecMode.THREAD
     inputs = {
         "dataset": ArgType.DataSet(None),
         "variable_name": ArgType.String,
         "output_dir": ArgType.String,
+        "layout": ArgType.String(optional=True),
+        "compress": ArgType.String(optional=True),
+        "cog": ArgType.Boolean(optional=True),
+        "max_workers": ArgType.Number(optional=True),
     }
     outputs = {
         "output_files": ArgType.ListString
     }
+    example = {
+        "variable_name": "atmosphere_water__rainfall_mass_flux",
+        "output_dir": "/tmp/geotiff",
+        "layout": "files, stack, vrt",
+        "compress": "none, deflate, zstd, lzw",
+        "cog": "False",
+        "max_workers": "4",
+    }
+
+    LAYOUTS = {"files", "stack", "vrt"}
+    COMPRESSIONS = {"none", "deflate", "zstd", "lzw"}
 
-    def __init__(self, dataset: BaseOutputSM, variable_name: str, output_dir: Union[str, Path]):
+    def __init__(self, dataset: BaseOutputSM, variable_name: str, output_dir: Union[str, Path], layout: str = "files",
+                 compress: str = "none", cog: bool = False, max_workers: int = None):
+        """
+        :param layout: files writes one file per timestamp, stack writes one multi-band file (a band per timestamp)
+            per grid, and vrt writes one file per timestamp and a multi-band VRT per grid referencing them
+        :param compress: compression of the files, which are also tiled if they are compressed
+        :param cog: write cloud optimized geotiffs (tiled, compressed with deflate by default, and with overviews)
+        :param max_workers: number of files written in parallel (default is the number of processors)
+        """
         self.dataset = dataset
         self.variable_name = variable_name
         self.output_dir = os.path.abspath(str(output_dir))
+        self.layout = layout
+        self.compress = None if compress is None or compress.lower() == "none" else compress
+        self.cog = cog
+        # the pool is nested in the thread of the pipeline running the adapter, so its size is bounded explicitly
+        self.max_workers = int(max_workers) if max_workers is not None else (os.cpu_count() or 1)
 
         if not os.path.exists(self.output_dir):
             Path(self.output_dir).mkdir(exist_ok=True, parents=True)
@@ -33,18 +68,77 @@ class GeoTiffWriteFunc(IFunc):
     def exec(self):
         rasters = CroppingTransFunc.extract_raster(self.dataset, self.variable_name)
         rasters = sorted(rasters, key=lambda x: x['timestamp'])
+        if self.layout == "stack":
+            jobs = [(os.path.join(self.output_dir, self.get_stack_name(members, i, "tif")), members)
+                    for i, members in enumerate(self.group_by_grid(rasters))]
+            self.write_all(jobs, self.write_stack)
+            return {"output_files": [outfile for outfile, _ in jobs]}
+
         outfiles = [
             os.path.join(self.output_dir,
                          datetime.fromtimestamp(raster['timestamp'], tz=timezone.utc).strftime(f"%Y%m%d%H%M%S.{i}.tif"))
             for i, raster in enumerate(rasters)
         ]
-        for outfile, raster in zip(outfiles, rasters):
-            raster['raster'].to_geotiff(outfile)
+        self.write_all(list(zip(outfiles, rasters)), self.write_raster)
+
+        if self.layout == "vrt":
+            raster2outfile = {id(r): outfile for outfile, r in zip(outfiles, rasters)}
+            vrt_files = []
+            for i, members in enumerate(self.group_by_grid(rasters)):
+                vrt_file = os.path.join(self.output_dir, self.get_stack_name(members, i, "vrt"))
+                vrt = gdal.BuildVRT(vrt_file, [raster2outfile[id(r)] for r in members], separate=True)
+                for band, r in enumerate(members):
+                    vrt.GetRasterBand(band + 1).SetDescription(self.get_band_name(r))
+                vrt.FlushCache()
+                vrt_files.append(vrt_file)
+            return {"output_files": vrt_files}
 
         return {"output_files": outfiles}
 
+    def write_all(self, jobs: list, write_func):
+        if self.max_workers == 1 or len(jobs) <= 1:
+            for job in jobs:
+                write_func(*job)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # consume the results so the errors of the writes are raised
+            list(executor.map(lambda job: write_func(*job), jobs))
+
+    def write_raster(self, outfile: str, raster: dict):
+        raster['raster'].to_geotiff(outfile, compress=self.compress, cog=self.cog)
+
+    def write_stack(self, outfile: str, members: list):
+        first = members[0]['raster']
+        stack = Raster(np.stack([r['raster'].data for r in members]), first.geotransform, first.epsg, first.nodata)
+        stack.to_geotiff(outfile, compress=self.compress, cog=self.cog,
+                         band_names=[self.get_band_name(r) for r in members])
+
+    @staticmethod
+    def group_by_grid(rasters: list) -> list:
+        """
+        Group the rasters (sorted by time) by their grid, as only rasters of the same grid can be bands of a file
+        """
+        grids = {}
+        for r in rasters:
+            raster = r['raster']
+            grid = (raster.geotransform.to_gdal(), raster.data.shape, raster.data.dtype.str, int(raster.epsg),
+                    raster.nodata)
+            grids.setdefault(grid, []).append(r)
+        return list(grids.values())
+
+    @staticmethod
+    def get_band_name(raster: dict) -> str:
+        return datetime.fromtimestamp(raster['timestamp'], tz=timezone.utc).isoformat()
+
+    @staticmethod
+    def get_stack_name(members: list, i: int, ext: str) -> str:
+        start, end = (datetime.fromtimestamp(r['timestamp'], tz=timezone.utc).strftime("%Y%m%d%H%M%S")
+                      for r in (members[0], members[-1]))
+        return f"{start}_{end}.{i}.{ext}"
+
     def validate(self) -> bool:
-        return True
+        return self.layout in GeoTiffWriteFunc.LAYOUTS and self.max_workers > 0 and \
+            (self.compress is None or self.compress.lower() in GeoTiffWriteFunc.COMPRESSIONS)
 
     def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
         return metadata
@@ -0,0 +1,230 @@
+import os
+from asyncio import get_event_loop
+from pathlib import Path
+from typing import Dict, Optional, Union, Generator, AsyncGenerator, Tuple
+
+import numpy as np
+from drepr import DRepr
+from netCDF4 import Dataset
+from xarray.backends.locks import HDF5_LOCK
+
+from dtran import ArgType
+from dtran.ifunc import IFunc, IFuncType
+from dtran.metadata import Metadata
+from funcs.writers.netcdf_write_func import NetCDFWriteFunc
+
+GT_PROPS = ["dx", "dy", "epsg", "x_slope", "y_slope", "x_0", "y_0"]
+
+
+class NetCDFStreamWriteFunc(IFunc):
+    id = "netcdf4_stream_write_func"
+    description = """Write a stream of datasets to a NetCDF4 file, appending each of them along the timestamp dimension.
+    Following CF 1.0 convention"""
+    func_type = IFuncType.WRITER
+    friendly_name: str = "NetCDF4 Stream Writer"
+    inputs = {
+        "dataset": ArgType.DataSet(None),
+        "output_file": ArgType.String,
+        "output_drepr_file": ArgType.String(optional=True),
+        "append": ArgType.Boolean(optional=True),
+        "compression_level": ArgType.Number(optional=True),
+        "shuffle": ArgType.Boolean(optional=True),
+        "chunk_timestamp": ArgType.Number(optional=True),
+        "chunk_lat": ArgType.Number(optional=True),
+        "chunk_long": ArgType.Number(optional=True),
+    }
+    outputs = {"output_file": ArgType.String}
+    example = {
+        "output_file": "gldas.nc",
+        "append": "False",
+        "compression_level": "4",
+        "shuffle": "True",
+        "chunk_timestamp": "256",
+        "chunk_lat": "16",
+        "chunk_long": "16",
+    }
+
+    def __init__(self, dataset, output_file: Union[str, Path], output_drepr_file: Optional[Union[str, Path]] = None,
+                 append: bool = False, compression_level: int = 4, shuffle: bool = True, chunk_timestamp: int = 256,
+                 chunk_lat: int = 16, chunk_long: int = 16):
+        """
+        :param append: append to the variables of the output file if it exists, instead of overwriting it
+        :param compression_level: zlib compression level (0 to disable the compression)
+        :param chunk_timestamp: chunk shape of the variables (timestamp, lat, long), which is long in time and small
+            in space by default, so reading the time series of a location reads few chunks
+        """
+        self.dataset = dataset
+        self.output_file = str(output_file)
+        if output_drepr_file is None:
+            # put the drepr file to the same folder of the output file with different
+            # extension
+            tmp = Path(output_file)
+            if tmp.name.find(".") != -1:
+                new_name = tmp.name[:tmp.name.rfind(".")] + ".yml"
+            else:
+                new_name = tmp.name + ".yml"
+            self.output_drepr_file = str(tmp.parent / new_name)
+        else:
+            self.output_drepr_file = output_drepr_file
+        self.append = append
+        self.compression_level = int(compression_level)
+        self.shuffle = shuffle
+        self.chunk_shape = (int(chunk_timestamp), int(chunk_lat), int(chunk_long))
+
+        # netcdf variables indexed by the standard name and coordinates of the rasters
+        self.variables: Dict[Tuple[str, bytes, bytes], str] = {}
+        # coordinates (lat, long) dimensions indexed by their values
+        self.coordinates: Dict[Tuple[bytes, bytes], Tuple[str, str]] = {}
+        # index of the timestamps in the timestamp dimension
+        self.timestamps: Dict[float, int] = {}
+        self.missing_values: Dict[str, Union[int, float]] = {}
+
+    def validate(self) -> bool:
+        return 0 <= self.compression_level <= 9 and all(x > 0 for x in self.chunk_shape)
+
+    async def exec(self) -> Union[dict, Generator[dict, None, None], AsyncGenerator[dict, None]]:
+        loop = get_event_loop()
+        ds = await loop.run_in_executor(self.executor, self.open)
+        try:
+            async for dataset in self.iter_datasets():
+                variables = await loop.run_in_executor(self.executor, NetCDFWriteFunc.extract_variables, dataset)
+                await loop.run_in_executor(self.executor, self.write, ds, variables)
+        finally:
+            with HDF5_LOCK:
+                ds.close()
+        # the model covers every variable of the stream, so it is written once at the end
+        await loop.run_in_executor(self.executor, self.write_drepr)
+        yield {"output_file": self.output_file}
+
+    async def iter_datasets(self):
+        if hasattr(self.dataset, '__anext__'):
+            while True:
+                try:
+                    yield await self.dataset.__anext__()
+                except StopAsyncIteration:
+                    break
+        else:
+            yield self.dataset
+
+    def open(self) -> Dataset:
+        with HDF5_LOCK:
+            if self.append and os.path.exists(self.output_file):
+                ds = Dataset(self.output_file, "a")
+                # recover the variables, coordinates and timestamps written previously
+                for i, t in enumerate(np.ma.filled(ds.variables["timestamp"][:], np.nan)):
+                    self.timestamps[float(t)] = i
+                for vid, var in ds.variables.items():
+                    if len(var.dimensions) != 3:
+                        continue
+                    lat, long = (np.asarray(ds.variables[dim][:], dtype=np.float64) for dim in var.dimensions[1:])
+                    self.coordinates[(lat.tobytes(), long.tobytes())] = var.dimensions[1:]
+                    self.variables[(var.getncattr("standard_name"), lat.tobytes(), long.tobytes())] = vid
+                    self.missing_values[vid] = var.getncattr("missing_values")
+                return ds
+
+            ds = Dataset(self.output_file, "w", format="NETCDF4")
+            ds.setncattr("conventions", "CF-1.6")
+            ds.createDimension("timestamp", None)
+            ds.createVariable("timestamp", np.float64, ("timestamp",), chunksizes=(self.chunk_shape[0],))
+            return ds
+
+    def write(self, ds: Dataset, variables: Dict[str, dict]):
+        with HDF5_LOCK:
+            for var in variables.values():
+                assert var['timestamp'][0] is not None, "Variables need a timestamp to be appended to the file"
+                lat = np.asarray(var['lat'], dtype=np.float64)
+                long = np.asarray(var['long'], dtype=np.float64)
+                key = (var['metadata']['standard_name'], lat.tobytes(), long.tobytes())
+                if key not in self.variables:
+                    self.variables[key] = self.create_variable(ds, var, lat, long)
+
+                timestamp = float(var['timestamp'][0])
+                if timestamp not in self.timestamps:
+                    self.timestamps[timestamp] = len(self.timestamps)
+                    ds.variables["timestamp"][self.timestamps[timestamp]] = timestamp
+                ds.variables[self.variables[key]][self.timestamps[timestamp], :, :] = var['data'][0]
+
+    def create_variable(self, ds: Dataset, var: dict, lat: np.ndarray, long: np.ndarray) -> str:
+        vid = f"var_{len(self.variables)}"
+        coord_key = (lat.tobytes(), long.tobytes())
+        if coord_key not in self.coordinates:
+            # variables on the same grid share their coordinates
+            dims = ("lat", "long") if len(self.coordinates) == 0 else (f"{vid}_lat", f"{vid}_long")
+            for dim, values in zip(dims, (lat, long)):
+                ds.createDimension(dim, len(values))
+                ds.createVariable(dim, np.float64, (dim,))[:] = values
+            self.coordinates[coord_key] = dims
+        lat_dim, long_dim = self.coordinates[coord_key]
+
+        metadata = var['metadata']
+        chunk_shape = (self.chunk_shape[0], min(self.chunk_shape[1], len(lat)), min(self.chunk_shape[2], len(long)))
+        nc_var = ds.createVariable(vid, var['data'].dtype, ("timestamp", lat_dim, long_dim),
+                                   zlib=self.compression_level > 0, complevel=max(self.compression_level, 1),
+                                   shuffle=self.shuffle, chunksizes=chunk_shape, fill_value=metadata['_FillValue'])
+        for k, v in metadata.items():
+            if k != "_FillValue":
+                nc_var.setncattr(k, v)
+        self.missing_values[vid] = metadata['missing_values']
+        return vid
+
+    def write_drepr(self):
+        assert len(self.variables) > 0
+        drepr = {
+            "version": "2",
+            "resources": "netcdf4",
+            "attributes": {
+                "timestamp": "$.timestamp.data[:]"
+            },
+            "alignments": [],
+            "semantic_model": {
+                "prefixes": {
+                    "mint": "https://mint.isi.edu/",
+                    "mint-geo": "https://mint.isi.edu/geo"
+                }
+            }
+        }
+        for (standard_name, lat, long), vid in self.variables.items():
+            lat_dim, long_dim = self.coordinates[(lat, long)]
+            idx = int(vid[len("var_"):]) + 1
+            missing_value = self.missing_values[vid]
+            drepr['attributes'][vid] = {
+                "path": f"$.{vid}.data[:][:][:]",
+                "missing_values": [missing_value.item() if isinstance(missing_value, np.generic) else missing_value]
+            }
+            drepr['attributes'][f"{vid}_standard_name"] = f"$.{vid}.@.standard_name"
+            for dim in (lat_dim, long_dim):
+                drepr['attributes'][dim] = f"$.{dim}.data[:]"
+            for gt_k in GT_PROPS:
+                drepr['attributes'][f"{vid}_{gt_k}"] = f"$.{vid}.@.{gt_k}"
+            drepr['alignments'].extend([
+                {"type": "dimension", "value": f"{vid}:2 <-> timestamp:2"},
+                {"type": "dimension", "value": f"{vid}:3 <-> {lat_dim}:2"},
+                {"type": "dimension", "value": f"{vid}:4 <-> {long_dim}:2"},
+            ] + [
+                {"type": "dimension", "source": vid, "target": f"{vid}_{x}", "aligned_dims": []}
+                for x in ["standard_name"] + GT_PROPS
+            ])
+            drepr['semantic_model'][f"mint:Variable:{idx}"] = {
+                "properties": [
+                    ("rdf:value", vid),
+                    ("mint:standardName", f"{vid}_standard_name"),
+                    ("mint:timestamp", "timestamp"),
+                    ("mint-geo:lat", lat_dim),
+                    ("mint-geo:long", long_dim),
+                ],
+                "links": [
+                    ("mint-geo:raster", f"mint-geo:Raster:{idx}")
+                ]
+            }
+            drepr['semantic_model'][f"mint-geo:Raster:{idx}"] = {
+                "properties": [
+                    (f"mint-geo:{gt_k}", f"{vid}_{gt_k}")
+                    for gt_k in GT_PROPS
+                ]
+            }
+
+        with open(self.output_drepr_file, 'w') as f:
+            f.write(DRepr.parse(drepr).to_lang_yml(use_json_path=True))
+
+    def change_metadata(self, metadata: Optional[Dict[str, Metadata]]) -> Dict[str, Metadata]:
+        return metadata
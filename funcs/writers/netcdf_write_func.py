@@ -6,7 +6,7 @@ from drepr import outputs, DRepr
 from drepr.outputs.base_output_sm import BaseOutputSM
 
 from dtran import ArgType
-from dtran.ifunc import IFunc, IFuncType
+from dtran.ifunc import IFunc, IFuncType, IFuncExecMode
 import xarray as xr, numpy as np
 
 
@@ -19,6 +19,8 @@ class NetCDFWriteFunc(IFunc):
         "output_drepr_file": ArgType.String(optional=True),
     }
     outputs = {}
+    # xarray serializes the access to the HDF5 library with its own lock, so it is safe to write in a thread
+    exec_mode = IFuncExecMode.THREAD
 
     def __init__(self, dataset: BaseOutputSM, output_file: Union[str, Path],
                  output_drepr_file: Optional[Union[str, Path]] = None):
@@ -39,13 +41,17 @@ class NetCDFWriteFunc(IFunc):
     def validate(self) -> bool:
         return True
 
-    def exec(self) -> dict:
-        mint = self.dataset.ns("https://mint.isi.edu/")
-        mint_geo = self.dataset.ns("https://mint.isi.edu/geo")
-        rdf = self.dataset.ns(outputs.Namespace.RDF)
+    @staticmethod
+    def extract_variables(dataset: BaseOutputSM) -> Dict[str, dict]:
+        """
+        Get the rasters of the variables of a dataset, with their coordinates and metadata
+        """
+        mint = dataset.ns("https://mint.isi.edu/")
+        mint_geo = dataset.ns("https://mint.isi.edu/geo")
+        rdf = dataset.ns(outputs.Namespace.RDF)
 
         variables = {}
-        for c in self.dataset.c(mint.Variable):
+        for c in dataset.c(mint.Variable):
             # TODO: automatically discover properties and write them accordingly
             standard_name = c.p(mint.standardName).as_ndarray([]).data
             assert standard_name.size == 1
@@ -59,7 +65,7 @@ class NetCDFWriteFunc(IFunc):
                 timestamp = None
 
             for raster_id, sc in c.group_by(mint_geo.raster):
-                gt = self.dataset.get_record_by_id(raster_id)
+                gt = dataset.get_record_by_id(raster_id)
                 val = sc.p(rdf.value).as_ndarray([c.p(mint_geo.lat), c.p(mint_geo.long)])
 
                 assert len(val.data.shape) == 2
@@ -92,6 +98,10 @@ class NetCDFWriteFunc(IFunc):
                         "y_0": gt.s("mint-geo:y_0")
                     }
                 }
+        return variables
+
+    def exec(self) -> dict:
+        variables = NetCDFWriteFunc.extract_variables(self.dataset)
 
         assert len(variables) > 0
         drepr = {
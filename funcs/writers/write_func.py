@@ -3,11 +3,14 @@
 import csv
 import datetime
 from collections import defaultdict
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import List, Union, Dict, Optional
+from typing import List, Union, Dict, Optional, Iterable, Any
 
+import numpy as np
 import ujson as json
 from drepr.models import SemanticModel, Node, LiteralNode, DataNode
+from drepr.outputs import ArrayBackend
 from drepr.outputs.base_output_sm import BaseOutputSM
 from drepr.outputs.namespace import PrefixedNamespace
 
@@ -16,6 +19,47 @@ from dtran.backend import ShardedBackend
 from dtran.ifunc import IFunc, IFuncType
 from dtran.metadata import Metadata
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # parquet and arrow outputs are only available if pyarrow is installed
+    pyarrow = None
+
+
+@dataclass
+class ColumnarTable:
+    """
+    Rows of a dataset whose main class is an array indexed by other predicates: each row is a cell of the array
+    (except the missing values), with the values of the index predicates at that cell and the scalar values
+    (including the values of the linked records) shared by all rows
+    """
+    attrs: List[str]
+    value_attr: str
+    value: np.ndarray
+    nodata: Any
+    index_attrs: List[str]
+    index_values: List[np.ndarray]
+    scalars: Dict[str, Any]
+
+    def iter_chunks(self, chunk_size: int) -> Iterable[Dict[str, np.ndarray]]:
+        for start in range(0, self.value.size, chunk_size):
+            cells = np.unravel_index(np.arange(start, min(start + chunk_size, self.value.size)), self.value.shape)
+            values = self.value[cells]
+            if self.nodata is not None:
+                mask = values != self.nodata
+                values = values[mask]
+                cells = tuple(x[mask] for x in cells)
+            if values.size == 0:
+                continue
+            columns = {self.value_attr: values}
+            for attr, index_value, cell in zip(self.index_attrs, self.index_values, cells):
+                columns[attr] = index_value[cell]
+            for attr, value in self.scalars.items():
+                columns[attr] = np.full(values.size, value, dtype=object if not isinstance(value, np.generic)
+                                        else type(value))
+            yield columns
+
 
 class CSVWriteFunc(IFunc):
     id = "graph_write_func"
@@ -27,24 +71,41 @@ class CSVWriteFunc(IFunc):
     inputs = {
         "data": ArgType.DataSet(None),
         "output_file": ArgType.String,
+        "chunk_size": ArgType.Number(optional=True),
     }
     outputs = {"output_file": ArgType.String}
     example = {
         "output_file": "example.csv",
+        "chunk_size": "100000",
     }
 
     def __init__(
-        self, data: Union[BaseOutputSM, ShardedBackend], output_file: Union[str, Path]
+        self, data: Union[BaseOutputSM, ShardedBackend], output_file: Union[str, Path], chunk_size: int = 100000
     ):
-
+        """
+        :param output_file: csv or json file, or parquet/arrow file if pyarrow is installed
+        :param chunk_size: number of rows which are tabularized and written at once
+        """
         self.data = data
         self.output_file = Path(output_file)
+        self.chunk_size = int(chunk_size)
 
         self.sm: SemanticModel = self.data.get_sm()
 
         self.uri2label = {}
 
     def exec(self) -> dict:
+        if self.output_file.suffix in {".csv", ".parquet", ".arrow"}:
+            tables = self.tabularize_columnar()
+            if tables is not None:
+                if self.output_file.suffix == ".csv":
+                    CSVWriteFunc._dump_chunks_to_csv(tables, self.chunk_size, self.output_file)
+                else:
+                    CSVWriteFunc._dump_chunks_to_arrow(tables, self.chunk_size, self.output_file)
+                return {"output_file": str(self.output_file)}
+        assert self.output_file.suffix in {".csv", ".json"}, \
+            f"Cannot write {self.output_file.suffix} files (parquet and arrow files need a columnar dataset and pyarrow)"
+
         data_tuples, attr_names = self.tabularize_data()
         print("Finish tabularizing")
         if self.output_file.suffix == ".csv":
@@ -70,6 +131,50 @@ class CSVWriteFunc(IFunc):
         with open(file_path, "w", newline="") as f:
             json.dump(tabular_rows, f)
 
+    @staticmethod
+    def _dump_chunks_to_csv(tables: List[ColumnarTable], chunk_size: int, file_path):
+        file_exists = file_path.exists()
+        with open(file_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if not file_exists:
+                writer.writerow(tables[0].attrs)
+            for table in tables:
+                # the index and scalar values are repeated in many rows, so they are converted to text only once
+                table = replace(
+                    table,
+                    index_values=[np.asarray(["" if x is None else str(x) for x in CSVWriteFunc._to_csv_column(values)],
+                                             dtype=object) for values in table.index_values],
+                    scalars={k: "" if v is None else str(v) for k, v in table.scalars.items()})
+                for columns in table.iter_chunks(chunk_size):
+                    columns = [CSVWriteFunc._to_csv_column(columns[attr]) for attr in table.attrs]
+                    writer.writerows(zip(*columns))
+
+    @staticmethod
+    def _to_csv_column(column: np.ndarray) -> list:
+        if column.dtype.kind == "f" and column.dtype != np.float64:
+            # keeping the shortest representation of float32 values, as when they are written one by one
+            return column.astype(str).tolist()
+        return column.tolist()
+
+    @staticmethod
+    def _dump_chunks_to_arrow(tables: List[ColumnarTable], chunk_size: int, file_path):
+        assert pyarrow is not None, "pyarrow is required to write parquet and arrow files"
+        writer = None
+        try:
+            for table in tables:
+                for columns in table.iter_chunks(chunk_size):
+                    batch = pyarrow.Table.from_arrays([pyarrow.array(columns[attr]) for attr in table.attrs],
+                                                      names=table.attrs)
+                    if writer is None:
+                        if file_path.suffix == ".parquet":
+                            writer = pyarrow.parquet.ParquetWriter(str(file_path), batch.schema)
+                        else:
+                            writer = pyarrow.ipc.new_file(str(file_path), batch.schema)
+                    writer.write_table(batch.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+
     def tabularize_data(self) -> (list, set):
         main_class_node = self._find_main_class()
 
@@ -113,6 +218,91 @@ class CSVWriteFunc(IFunc):
 
         return data_tuples, main_attrs
 
+    def tabularize_columnar(self) -> Optional[List[ColumnarTable]]:
+        """
+        Tabularize the data by whole arrays instead of record by record. None is returned if a dataset is not an
+        array backend whose main class is an array indexed by its other predicates, or if the datasets do not have the
+        same attributes
+        """
+        main_class_node = self._find_main_class()
+        datasets = self.data.datasets if isinstance(self.data, ShardedBackend) else [self.data]
+        tables = []
+        for dataset in datasets:
+            if not isinstance(dataset, ArrayBackend):
+                return None
+            table = self._columnar_table(dataset, main_class_node)
+            if table is None or (len(tables) > 0 and table.attrs != tables[0].attrs):
+                return None
+            tables.append(table)
+        return tables if len(tables) > 0 else None
+
+    def _columnar_table(self, dataset: ArrayBackend, node: Node) -> Optional[ColumnarTable]:
+        c = dataset.cid(node.node_id)
+        first_record = next(c.iter_records(), None)
+        if first_record is None:
+            return None
+
+        scalars = {}
+        value_pred, index_preds = None, []
+        for edge in self.sm.iter_outgoing_edges(node.node_id):
+            child_node = self.sm.nodes[edge.target_id]
+            predicate_url = edge.label
+            predicate_label = self._resolve_predicate_label(predicate_url)
+            p = c.p(predicate_url)
+            if p is None or len(p.edges) > 1:
+                return None
+
+            if isinstance(child_node, LiteralNode) or isinstance(child_node, DataNode):
+                if p.ndarray_size() == 1:
+                    val = first_record.m(predicate_url)
+                    if len(val) != 1:
+                        return None
+                    if predicate_url == "mint:timestamp":
+                        val = [datetime.datetime.fromtimestamp(v, tz=datetime.timezone.utc) for v in val]
+                    scalars[predicate_label] = val[0]
+                elif p.attr(0).id == c.pk_attr.id:
+                    value_pred = (predicate_label, p)
+                else:
+                    index_preds.append((predicate_label, p))
+            else:
+                # linked records are shared by all rows, and they are tabularized record by record
+                if child_node == node or p.ndarray_size() != 1:
+                    return None
+                child2tuples, child_attrs = self._sm_traverse(dataset, child_node, [node, child_node])
+                for child_idx, rid in enumerate(first_record.m(predicate_url)):
+                    child_record = dataset.get_record_by_id(rid)
+                    for attr, vals in child2tuples[child_record.id].items():
+                        if len(vals) != 1:
+                            return None
+                        scalars[f"{predicate_label}_{attr}{'_' + str(child_idx) if child_idx > 0 else ''}"] = vals[0]
+
+        if value_pred is None:
+            return None
+        try:
+            value = value_pred[1].as_ndarray([p for _, p in index_preds])
+        except Exception:
+            return None
+        # every dimension of the array must be indexed by a single one-dimension predicate
+        if len(value.data.shape) != len(index_preds) or any(
+                r.end - r.start != 1 or len(x.shape) != 1 or x.shape[0] != value.data.shape[i]
+                for i, (r, x) in enumerate(zip(value.index_props_range, value.index_props))):
+            return None
+
+        index_values = []
+        for (label, p), x in zip(index_preds, value.index_props):
+            if p.uri == "mint:timestamp":
+                x = np.asarray([datetime.datetime.fromtimestamp(v, tz=datetime.timezone.utc) for v in x], dtype=object)
+            index_values.append(x)
+        return ColumnarTable(
+            attrs=sorted([value_pred[0]] + [label for label, _ in index_preds] + list(scalars.keys())),
+            value_attr=value_pred[0],
+            value=value.data,
+            nodata=value.nodata.value if value.nodata is not None else None,
+            index_attrs=[label for label, _ in index_preds],
+            index_values=index_values,
+            scalars=scalars
+        )
+
     def _find_main_class(self):
         for class_ in self.sm.iter_class_nodes():
             is_main_class = True
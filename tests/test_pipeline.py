@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import gc
+import csv
+import threading
+from asyncio import all_tasks, get_event_loop
+
+import pytest
+import ujson
+
+from dtran import ArgType, IFunc, Pipeline
+from dtran.ifunc import IFuncExecMode
+
+
+class Source(IFunc):
+    id = "source"
+    inputs = {"n": ArgType.Number}
+    outputs = {"x": ArgType.Number}
+    # order in which the items are produced and consumed, shared with the consumers below
+    log = []
+
+    def __init__(self, n: int):
+        self.n = n
+
+    async def exec(self):
+        for i in range(self.n):
+            Source.log.append(("produce", i))
+            yield {"x": i}
+
+    def validate(self) -> bool:
+        return True
+
+    def change_metadata(self, metadata):
+        return metadata
+
+
+class Sink(IFunc):
+    id = "sink"
+    inputs = {"x": ArgType.Number}
+    outputs = {}
+
+    def __init__(self, x: int):
+        self.x = x
+
+    def exec(self) -> dict:
+        Source.log.append(("consume", self.x))
+        return {}
+
+    def validate(self) -> bool:
+        return True
+
+    def change_metadata(self, metadata):
+        return metadata
+
+
+class ThreadSink(Sink):
+    id = "thread_sink"
+    exec_mode = IFuncExecMode.THREAD
+    threads = []
+
+    def exec(self) -> dict:
+        ThreadSink.threads.append(threading.current_thread().name)
+        return super().exec()
+
+
+class Drain(IFunc):
+    """Consume the whole stream a before reading b, which deadlocks if both come from the same producer"""
+    id = "drain"
+    inputs = {"a": ArgType.Number, "b": ArgType.Number}
+    outputs = {}
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    async def exec(self):
+        async for _ in self.a:
+            pass
+        async for _ in self.b:
+            pass
+        yield {}
+
+    def validate(self) -> bool:
+        return True
+
+    def change_metadata(self, metadata):
+        return metadata
+
+
+@pytest.fixture(autouse=True)
+def clear_logs():
+    Source.log.clear()
+    ThreadSink.threads.clear()
+
+
+def test_buffer_size_bounds_buffered_items():
+    pipeline = Pipeline([Source, Sink], [Sink.I.x == Source.O.x], buffer_sizes={("sink", 1, "x"): 3})
+    pipeline.exec({"source__1__n": 10}, collect_stats=True)
+
+    stats = pipeline.get_stats()["sink__1__x"]
+    assert stats["buffer_size"] == 3
+    assert stats["total_items"] == 10
+    assert 0 < stats["peak_items"] <= 3
+    assert stats["n_items"] == 0 and stats["n_bytes"] == 0
+    assert stats["peak_bytes"] > 0
+    # every item is consumed, in order, and the producer is never more than buffer_size items ahead
+    assert [i for event, i in Source.log if event == "consume"] == list(range(10))
+    n_buffered = 0
+    for event, _ in Source.log:
+        n_buffered += 1 if event == "produce" else -1
+        assert 0 <= n_buffered <= 3
+
+
+def test_default_buffer_size_is_one():
+    pipeline = Pipeline([Source, Sink], [Sink.I.x == Source.O.x])
+    pipeline.exec({"source__1__n": 5})
+
+    stats = pipeline.get_stats()["sink__1__x"]
+    assert stats["buffer_size"] == 1
+    assert stats["peak_items"] == 1
+    assert Source.log == [(event, i) for i in range(5) for event in ["produce", "consume"]]
+
+
+def test_deadlock_is_reported_and_adapters_are_closed(recwarn):
+    pipeline = Pipeline([Source, Drain], [Drain.I.a == Source.O.x, Drain.I.b == Source.O.x])
+    with pytest.raises(RuntimeError) as exc_info:
+        pipeline.exec({"source__1__n": 3})
+
+    assert str(exc_info.value) == "Pipeline went into a deadlock: " \
+                                  "drain__1 waits for drain__1__a to be produced by source__1; " \
+                                  "source__1 waits for drain__1__b to be received by drain__1"
+    # no task is left pending, and no suspended generator is finalized by the garbage collector
+    assert len(all_tasks(get_event_loop())) == 0
+    gc.collect()
+    assert [str(w.message) for w in recwarn if "asynchronous generator" in str(w.message)] == []
+
+    # the same pipeline runs once the producer never waits for b, i.e., its buffer can hold all the items and one more
+    pipeline = Pipeline([Source, Drain], [Drain.I.a == Source.O.x, Drain.I.b == Source.O.x],
+                        buffer_sizes={("drain", 1, "b"): 4})
+    pipeline.exec({"source__1__n": 3})
+
+
+def test_thread_adapter_runs_in_pipeline_thread_pool():
+    pipeline = Pipeline([Source, ThreadSink], [ThreadSink.I.x == Source.O.x], max_workers=2)
+    pipeline.exec({"source__1__n": 4})
+
+    assert [i for event, i in Source.log if event == "consume"] == list(range(4))
+    assert len(ThreadSink.threads) == 4
+    assert all(name.startswith("dtran") for name in ThreadSink.threads)
+    # the thread pool is shut down at the end of the run
+    assert pipeline.executors == {}
+
+
+@pytest.mark.parametrize("report_name", ["report.json", "report.csv"])
+def test_report_and_trace_files(tmp_path, report_name):
+    report_file = tmp_path / report_name
+    trace_file = tmp_path / "trace.json"
+    pipeline = Pipeline([Source, Sink], [Sink.I.x == Source.O.x])
+    pipeline.exec({"source__1__n": 5}, report_file=report_file, trace_file=trace_file)
+
+    if report_name.endswith(".csv"):
+        with open(report_file, newline="") as f:
+            rows = list(csv.DictReader(f))
+        assert [row["adapter"] for row in rows] == ["source__1", "sink__1"]
+        assert ujson.loads(rows[0]["n_items"]) == {"x": 5}
+    else:
+        with open(report_file) as f:
+            report = ujson.load(f)
+        assert report["total_time"] > 0
+        assert [adapter["adapter"] for adapter in report["adapters"]] == ["source__1", "sink__1"]
+        assert report["adapters"][0]["n_items"] == {"x": 5}
+        assert all(adapter["exec_time"] >= 0 for adapter in report["adapters"])
+        assert report["buffers"]["sink__1__x"]["total_items"] == 5
+
+    with open(trace_file) as f:
+        trace = ujson.load(f)
+    events = trace["traceEvents"]
+    assert {event["tid"] for event in events} == {"source__1", "sink__1"}
+    assert {"init", "run", "wait_received"} <= {event["cat"] for event in events}
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pytest
+
+pytest.importorskip("drepr")
+pytest.importorskip("gdal")
+
+from funcs.topoflow import write_topoflow4_climate_func
+from funcs.topoflow.rts_manifest import RTSManifest, GridRecord
+from funcs.topoflow.topoflow.utils import rti_files, rts_files
+
+NROWS, NCOLS = 4, 3
+PARAMS = dict(var_name="precipitation", rts_nodata=-9999.0, DEM_bounds=[0.0, 0.0, 0.3, 0.4], DEM_xres=0.1,
+              DEM_yres=0.1)
+
+
+def make_info(rts_file: str, byte_order: str = rti_files.get_rti_byte_order()):
+    return rti_files.make_info(rts_file, ncols=NCOLS, nrows=NROWS, xres=0.1, yres=0.1, byte_order=byte_order)
+
+
+def read_grids(rts_file: str, dtype: str = "<f4") -> np.ndarray:
+    return np.fromfile(rts_file, dtype=dtype).reshape(-1, NROWS, NCOLS)
+
+
+def test_rts_memmap_new_file(tmp_path):
+    rts_file = str(tmp_path / "test.rts")
+    rts = rts_files.rts_memmap()
+    assert rts.open_new_file(rts_file, 3, info=make_info(rts_file))
+    assert os.path.exists(str(tmp_path / "test.rti"))
+    # the file is allocated with zeros
+    assert rts.number_of_grids() == 3
+    assert os.path.getsize(rts_file) == 3 * NROWS * NCOLS * 4
+    grid = np.arange(NROWS * NCOLS, dtype=np.float32).reshape(NROWS, NCOLS)
+    rts.add_grid(grid, 2)
+    rts.add_grid(5.0, 0)
+    rts.close()
+
+    grids = read_grids(rts_file, rts.dtype)
+    np.testing.assert_array_equal(grids[0], np.full((NROWS, NCOLS), 5.0))
+    np.testing.assert_array_equal(grids[1], np.zeros((NROWS, NCOLS)))
+    np.testing.assert_array_equal(grids[2], grid)
+
+
+def test_rts_memmap_open_extend_and_slice(tmp_path):
+    rts_file = str(tmp_path / "test.rts")
+    rts = rts_files.rts_memmap()
+    assert rts.open_new_file(rts_file, 3, info=make_info(rts_file))
+    for i in range(3):
+        rts.add_grid(float(i + 1), i)
+    rts.close()
+
+    rts = rts_files.rts_memmap()
+    assert rts.open_file(rts_file)
+    assert rts.number_of_grids() == 3
+    np.testing.assert_array_equal(rts.get_grid(1), np.full((NROWS, NCOLS), 2.0))
+    # a range of grids is a view of the file
+    grids = rts.get_grids(1, 3)
+    assert grids.shape == (2, NROWS, NCOLS)
+    assert isinstance(grids, np.memmap)
+    np.testing.assert_array_equal(grids[:, 0, 0], [2.0, 3.0])
+    np.testing.assert_array_equal(rts.get_grids(step=2)[:, 0, 0], [1.0, 3.0])
+    rts.close()
+
+    # the file is extended in place with zeros, keeping the existing grids
+    rts = rts_files.rts_memmap()
+    assert rts.open_file(rts_file, UPDATE=True, n_grids=5)
+    assert rts.number_of_grids() == 5
+    rts.add_grid(5.0, 4)
+    rts.close()
+    np.testing.assert_array_equal(read_grids(rts_file)[:, 0, 0], [1.0, 2.0, 3.0, 0.0, 5.0])
+
+    # and truncated
+    rts = rts_files.rts_memmap()
+    assert rts.open_file(rts_file, UPDATE=True, n_grids=2)
+    assert rts.number_of_grids() == 2
+    rts.close()
+    np.testing.assert_array_equal(read_grids(rts_file)[:, 0, 0], [1.0, 2.0])
+
+    # a missing RTI file
+    os.remove(str(tmp_path / "test.rti"))
+    assert not rts_files.rts_memmap().open_file(rts_file)
+
+
+def test_rts_memmap_msb_byte_order(tmp_path):
+    rts_file = str(tmp_path / "test.rts")
+    values = np.arange(2 * NROWS * NCOLS, dtype=">f4").reshape(2, NROWS, NCOLS)
+    values.tofile(rts_file)
+    rti_files.write_info(str(tmp_path / "test.rti"), make_info(rts_file, byte_order="MSB"))
+
+    rts = rts_files.rts_memmap()
+    assert rts.open_file(rts_file, UPDATE=True)
+    assert rts.dtype == np.dtype(">f4")
+    # the values are converted, without swapping the bytes of the file
+    np.testing.assert_array_equal(rts.get_grid(1), values[1].astype(np.float32))
+    rts.add_grid(np.full((NROWS, NCOLS), 1.5, dtype=np.float32), 0)
+    rts.close()
+    np.testing.assert_array_equal(read_grids(rts_file, ">f4")[0], np.full((NROWS, NCOLS), 1.5))
+    np.testing.assert_array_equal(read_grids(rts_file, ">f4")[1], values[1])
+
+
+class Regridder:
+    """Regrid the fake NetCDF files, which only contain the value of their grid, and record the regridded files"""
+
+    def __init__(self):
+        self.files = []
+
+    def __call__(self, nc_file, var_name, rts_nodata, DEM_bounds, DEM_xres, DEM_yres, DEM_shape=None):
+        self.files.append(os.path.basename(nc_file))
+        with open(nc_file, "r") as f:
+            value = float(f.read())
+        return np.full((NROWS, NCOLS), value, dtype=np.float32), value, False
+
+
+@pytest.fixture
+def regridder(monkeypatch):
+    regridder = Regridder()
+    monkeypatch.setattr(write_topoflow4_climate_func, "regrid_nc_file", regridder)
+    # the workers are threads, so they use the fake regridder
+    monkeypatch.setattr(write_topoflow4_climate_func, "Pool", ThreadPool)
+    return regridder
+
+
+class Workspace:
+    def __init__(self, path):
+        self.nc_dir = path / "nc"
+        self.nc_dir.mkdir()
+        self.rts_file = str(path / "test.rts")
+        self.manifest_file = str(path / "test.json")
+
+    def write_nc_file(self, i: int, value: float = None):
+        with open(str(self.nc_dir / f"{i:03d}.nc"), "w") as f:
+            f.write(str(float(i) if value is None else value))
+
+    def nc_files(self):
+        return sorted(str(f) for f in self.nc_dir.iterdir())
+
+    def run(self, **kwargs):
+        params = dict(PARAMS, **kwargs)
+        return write_topoflow4_climate_func.write_nc_files_to_rts(
+            self.nc_files(), self.rts_file, params['var_name'], params['rts_nodata'], params['DEM_bounds'],
+            params['DEM_xres'], params['DEM_yres'], max_workers=2, manifest_file=self.manifest_file)
+
+    def grids(self) -> list:
+        return read_grids(self.rts_file)[:, 0, 0].tolist()
+
+
+def test_resume_after_appending_files(tmp_path, regridder):
+    workspace = Workspace(tmp_path)
+    for i in range(5):
+        workspace.write_nc_file(i)
+    assert workspace.run() == (NROWS, NCOLS, 4.0, 0, True)
+    assert sorted(regridder.files) == ["000.nc", "001.nc", "002.nc", "003.nc", "004.nc"]
+    assert workspace.grids() == [0.0, 1.0, 2.0, 3.0, 4.0]
+
+    # nothing is regridded when the files are unchanged
+    regridder.files.clear()
+    assert workspace.run() == (NROWS, NCOLS, 4.0, 0, False)
+    assert regridder.files == []
+
+    # only the appended files are regridded
+    for i in range(5, 8):
+        workspace.write_nc_file(i)
+    assert workspace.run() == (NROWS, NCOLS, 7.0, 0, True)
+    assert sorted(regridder.files) == ["005.nc", "006.nc", "007.nc"]
+    assert workspace.grids() == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+    manifest = RTSManifest.load(workspace.manifest_file, PARAMS)
+    assert [r.file for r in manifest.grids] == [f"{i:03d}.nc" for i in range(8)]
+
+    # the grids of removed files at the end are truncated
+    regridder.files.clear()
+    os.remove(workspace.nc_files()[-1])
+    assert workspace.run() == (NROWS, NCOLS, 6.0, 0, True)
+    assert regridder.files == []
+    assert workspace.grids() == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+
+def test_resume_after_changing_files(tmp_path, regridder):
+    workspace = Workspace(tmp_path)
+    for i in range(6):
+        workspace.write_nc_file(i)
+    workspace.run()
+
+    # a file whose mtime changed but not its content is still valid, and its new mtime is saved
+    nc_file = workspace.nc_files()[2]
+    stat = os.stat(nc_file)
+    os.utime(nc_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    regridder.files.clear()
+    assert workspace.run()[-1] is False
+    assert regridder.files == []
+    manifest = RTSManifest.load(workspace.manifest_file, PARAMS)
+    assert manifest.grids[2].mtime_ns == stat.st_mtime_ns + 10 ** 9
+
+    # the grids from the first changed file are regridded
+    workspace.write_nc_file(3, 30.0)
+    assert workspace.run()[-1] is True
+    assert sorted(regridder.files) == ["003.nc", "004.nc", "005.nc"]
+    assert workspace.grids() == [0.0, 1.0, 2.0, 30.0, 4.0, 5.0]
+
+    # and from the first grid which is not (or partially) written in the RTS file
+    grids = np.memmap(workspace.rts_file, dtype="<f4", mode="r+", shape=(6, NROWS, NCOLS))
+    grids[4, 1, 1] = -1.0
+    grids.flush()
+    del grids
+    regridder.files.clear()
+    workspace.run()
+    assert sorted(regridder.files) == ["004.nc", "005.nc"]
+    assert workspace.grids() == [0.0, 1.0, 2.0, 30.0, 4.0, 5.0]
+    assert (read_grids(workspace.rts_file)[4] == 4.0).all()
+
+    # every file is regridded with other parameters
+    regridder.files.clear()
+    workspace.run(rts_nodata=0.0)
+    assert len(regridder.files) == 6
+    assert RTSManifest.load(workspace.manifest_file, PARAMS) is None
+    assert RTSManifest.load(workspace.manifest_file, dict(PARAMS, rts_nodata=0.0)) is not None
+
+
+def test_n_valid_grids_is_a_prefix(tmp_path):
+    workspace = Workspace(tmp_path)
+    for i in range(4):
+        workspace.write_nc_file(i)
+    nc_files = workspace.nc_files()
+    rts = rts_files.rts_memmap()
+    assert rts.open_new_file(workspace.rts_file, 4, info=make_info(workspace.rts_file))
+    manifest = RTSManifest(PARAMS, [NROWS, NCOLS])
+    for i, nc_file in enumerate(nc_files):
+        rts.add_grid(float(i), i)
+        manifest.grids.append(GridRecord.create(nc_file, rts.get_grid(i), float(i), False))
+
+    assert manifest.n_valid_grids(nc_files, rts) == 4
+    # limited by the number of files, records and grids
+    assert manifest.n_valid_grids(nc_files[:3], rts) == 3
+    assert RTSManifest(PARAMS, [NROWS, NCOLS], manifest.grids[:2]).n_valid_grids(nc_files, rts) == 2
+    # the grids after an invalid one are invalid, even if they are unchanged
+    workspace.write_nc_file(1, 10.0)
+    assert manifest.n_valid_grids(nc_files, rts) == 1
+    # a different file at the same time index
+    assert manifest.n_valid_grids([nc_files[0], nc_files[2]], rts) == 1
+    rts.close()
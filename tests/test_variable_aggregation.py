@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import warnings
+from types import SimpleNamespace
+from typing import List
+
+import numpy as np
+import pytest
+
+pytest.importorskip("drepr")
+
+from funcs.aggregations.variable_aggregation_func import GroupBy, GroupByProp, Reduction, VariableAggregationFunc
+
+FUNCTIONS = ["sum", "count", "average", "min", "max", "std", "variance", "median", "p90"]
+NODATA = -9999.0
+DAY = 86400
+
+
+class Prop:
+    def __init__(self, size: int, data: np.ndarray = None):
+        self.size = size
+        self.data = data
+
+    def ndarray_size(self) -> int:
+        return self.size
+
+    def as_ndarray(self, index_props: list):
+        return SimpleNamespace(data=self.data, nodata=SimpleNamespace(value=NODATA),
+                               index_props=[np.arange(p.size) for p in index_props])
+
+
+class Variable:
+    """A variable of a semantic model with the few methods used to group it"""
+
+    def __init__(self, record: dict, data: np.ndarray, index_props: List[str]):
+        self.record = record
+        self.props = {p: Prop(1) for p in record}
+        self.props.update({p: Prop(n) for p, n in zip(index_props, data.shape)})
+        self.props["rdf:value"] = Prop(data.size, data)
+        # no carried props, they are not aggregated
+        self.predicates = {}
+
+    def p(self, prop: str):
+        return self.props.get(prop)
+
+    def iter_records(self):
+        yield SimpleNamespace(s=self.record.__getitem__)
+
+
+class SemanticModel:
+    def __init__(self, variables: List[Variable]):
+        self.variables = variables
+
+    def ns(self, uri: str):
+        return SimpleNamespace(value="rdf:value", Variable="mint:Variable")
+
+    def c(self, cls: str):
+        return self.variables
+
+
+def make_shards(shape: tuple, index_props: List[str], n_shards: int = 3, n_times: int = 15):
+    """
+    Generate shards mixing the variables x and y of two days, with some missing values. The values of y are much
+    larger than the ones of x, so mixing the variables of a group would show in every reduction. Each (variable,
+    day) group gets n_shards * n_times values, more than FOLD_SIZE
+    """
+    rng = np.random.default_rng(42)
+    shards, expected = [], {}
+    for shard in range(n_shards):
+        variables = []
+        for day in [1, 2]:
+            for i in range(n_times):
+                for name, offset in [("x", 0.0), ("y", 1e6)]:
+                    data = rng.normal(offset, 10.0, size=shape)
+                    data[rng.random(shape) < 0.2] = NODATA
+                    if len(shape) > 1:
+                        # a cell without any observation
+                        data[0, 0] = NODATA
+                    timestamp = day * DAY + (shard * n_times + i) * 60
+                    record = {"mint:timestamp": timestamp, "mint:place": "place", "mint:standardName": name}
+                    variables.append(Variable(record, data, index_props))
+                    expected.setdefault((name, (day * DAY * 1000, "place")), []).append(data)
+        shards.append(SemanticModel(variables))
+    return shards, expected
+
+
+def aggregate(shards: list, group_by: GroupBy, funcs: List[Reduction]) -> dict:
+    groups = {}
+    # folding the shards one at a time into the same groups, as the streaming aggregation does
+    for shard in shards:
+        VariableAggregationFunc._group_by(shard, group_by, groups, funcs, by_variable=True)
+    return {key: VariableAggregationFunc._finalize(group, funcs) for key, group in groups.items()}
+
+
+def reduce_with_numpy(values: np.ndarray, function: str, axis: int):
+    masked = np.where(values == NODATA, np.nan, values)
+    with warnings.catch_warnings():
+        # cells without any observation
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return {
+            "sum": np.nansum, "count": lambda x, axis: np.sum(~np.isnan(x), axis=axis), "average": np.nanmean,
+            "min": np.nanmin, "max": np.nanmax, "std": np.nanstd, "variance": np.nanvar, "median": np.nanmedian,
+            "p90": lambda x, axis: np.nanpercentile(x, 90, axis=axis)
+        }[function](masked, axis=axis)
+
+
+def test_reductions_of_each_cell_match_numpy():
+    shards, expected = make_shards((3, 4), ["mint-geo:lat", "mint-geo:long"])
+    group_by = GroupBy([GroupByProp("mint:timestamp", "day"), GroupByProp("mint:place", "exact"),
+                        GroupByProp("mint-geo:lat", "exact"), GroupByProp("mint-geo:long", "exact")])
+    funcs = [Reduction.parse(f) for f in FUNCTIONS]
+    results = aggregate(shards, group_by, funcs)
+
+    assert set(results.keys()) == set(expected.keys())
+    for key, values in expected.items():
+        assert len(values) > VariableAggregationFunc.FOLD_SIZE
+        values = np.stack(values)
+        observed = (values != NODATA).any(axis=0)
+        for f, result in zip(FUNCTIONS, results[key]):
+            assert result.shape == (3, 4)
+            np.testing.assert_allclose(result[observed], reduce_with_numpy(values, f, axis=0)[observed],
+                                       rtol=1e-9, err_msg=f"{f} of {key}")
+        # the cell without any observation
+        count = results[key][FUNCTIONS.index("count")]
+        assert count[0, 0] == 0
+        for f in ["min", "max", "std", "variance", "median", "p90"]:
+            assert results[key][FUNCTIONS.index(f)][0, 0] == NODATA, f
+
+
+def test_reductions_of_whole_variables_match_numpy():
+    # the variables have no index props, so every value of their grids is reduced together
+    shards, expected = make_shards((6,), [])
+    group_by = GroupBy([GroupByProp("mint:timestamp", "day"), GroupByProp("mint:place", "exact")])
+    funcs = [Reduction.parse(f) for f in FUNCTIONS]
+    results = aggregate(shards, group_by, funcs)
+
+    assert set(results.keys()) == set(expected.keys())
+    for key, values in expected.items():
+        values = np.concatenate(values)
+        for f, result in zip(FUNCTIONS, results[key]):
+            np.testing.assert_allclose(np.ravel(result)[0], reduce_with_numpy(values, f, axis=0),
+                                       rtol=1e-9, err_msg=f"{f} of {key}")
+
+
+def test_single_reduction_matches_numpy():
+    # the accumulators which are kept depend on the reductions, so each of them is also computed on its own
+    shards, expected = make_shards((3, 4), ["mint-geo:lat", "mint-geo:long"], n_shards=2, n_times=20)
+    group_by = GroupBy([GroupByProp("mint:timestamp", "day"), GroupByProp("mint:place", "exact"),
+                        GroupByProp("mint-geo:lat", "exact"), GroupByProp("mint-geo:long", "exact")])
+    for f in FUNCTIONS:
+        results = aggregate(shards, group_by, [Reduction.parse(f)])
+        for key, values in expected.items():
+            values = np.stack(values)
+            observed = (values != NODATA).any(axis=0)
+            np.testing.assert_allclose(results[key][0][observed], reduce_with_numpy(values, f, axis=0)[observed],
+                                       rtol=1e-9, err_msg=f"{f} of {key}")